@@ -1,47 +1,17 @@
-import json
-import mido
-import os
+import numpy as np
 import random
+from midi_events import midi_to_event_table, event_table_to_frame_events
+from prompt_index import load_prompt_index, sample_prompt
+from keyframes import sparse_keyframes, verify_sparse_keyframes
 
 def midi_to_frame_events(midi_file_path, fps):
-    midi = mido.MidiFile(midi_file_path)
-    
-    # Define total frames for 16 seconds
-    total_frames = 16 * fps
-    
-    # Initialize a list to hold the events for each frame
-    frame_events = [[] for _ in range(total_frames)]
-    
-    # Calculate the number of ticks per frame based on the initial tempo
-    initial_tempo = 500000  # Default tempo is 120 BPM
-    ticks_per_frame = (initial_tempo / 1_000_000) / fps * midi.ticks_per_beat
-    
-    # Track the cumulative time in ticks
-    cumulative_ticks = 0
-    
-    for track in midi.tracks:
-        for msg in track:
-            if not msg.is_meta:
-                cumulative_ticks += msg.time
-                # Convert cumulative ticks to seconds
-                current_time_seconds = mido.tick2second(cumulative_ticks, midi.ticks_per_beat, initial_tempo)
-                # Determine the corresponding frame
-                frame_index = int(current_time_seconds * fps)
-                if frame_index < total_frames and msg.type in ['note_on', 'note_off']:
-                    frame_events[frame_index].append(msg)
-                elif frame_index >= total_frames:
-                    break
-    
-    return frame_events, total_frames
+    # Compatibility shim: per-frame lists of mido messages built from the event table
+    table, total_frames = midi_to_event_table(midi_file_path, fps)
+    return event_table_to_frame_events(table, total_frames), total_frames
 
-def get_random_prompt(prompts_directory):
-    theme_directories = [os.path.join(prompts_directory, d) for d in os.listdir(prompts_directory) if os.path.isdir(os.path.join(prompts_directory, d))]
-    selected_theme = random.choice(theme_directories)
-    prompt_files = [os.path.join(selected_theme, f) for f in os.listdir(selected_theme) if f.startswith('prompt_')]
-    selected_prompt_file = random.choice(prompt_files)
-    with open(selected_prompt_file, 'r') as file:
-        prompt = file.read().strip()
-    return prompt
+def get_random_prompt(prompts_directory, rng=random, theme_weights=None):
+    # The prompts directory is scanned once per process, then served from the index
+    return sample_prompt(load_prompt_index(prompts_directory), rng, theme_weights)
 
 def map_velocity_to_range(velocity, min_value, max_value):
     if not (1 <= velocity <= 127):
@@ -117,20 +87,187 @@ def set_translation_z_frames(translation_z_values, frame_events, total_frames, t
         if translation_z_values[i] == 1.0:
             translation_z_values[i] = translation_z_values[i - 1]
 
-def midi_to_parseq_config(
-    frame_events, total_frames, fps,
+def frame_events_to_onsets(frame_events):
+    # Read the drum channel once into per-note onset frames and velocities
+    onsets = {}
+    for frame_index, events in enumerate(frame_events):
+        for event in events:
+            if event.type == 'note_on' and event.channel == 9:
+                frames, velocities = onsets.setdefault(event.note, ([], []))
+                frames.append(frame_index)
+                velocities.append(event.velocity)
+    return {note: (np.array(frames, dtype=np.int64), np.array(velocities, dtype=np.int64))
+            for note, (frames, velocities) in onsets.items()}
+
+def event_table_to_onsets(table):
+    drum_on = table["is_on"] & (table["channel"] == 9)
+    frames = table["frame"][drum_on].astype(np.int64)
+    notes = table["note"][drum_on]
+    velocities = table["velocity"][drum_on].astype(np.int64)
+    return {note: (frames[notes == note], velocities[notes == note]) for note in np.unique(notes).tolist()}
+
+def _empty_onsets():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+def _map_velocities_to_range(velocities, min_value, max_value):
+    if len(velocities) and (velocities.min() < 1 or velocities.max() > 127):
+        raise ValueError("Velocity must be between 1 and 127")
+    normalized_velocities = (velocities - 1) / 126.0
+    return min_value + normalized_velocities * (max_value - min_value)
+
+def _scatter_last(values, positions, updates):
+    # Later writes win, exactly like the sequential per-frame loops
+    if len(positions) == 0:
+        return
+    positions, first = np.unique(positions[::-1], return_index=True)
+    values[positions] = updates[::-1][first]
+
+def _last_onsets(frames, hold_frames, total_frames):
+    # For every frame, the last onset (in event order) whose hold still covers it
+    all_frames = np.arange(total_frames)
+    if len(frames) == 0:
+        return all_frames, np.zeros(total_frames, dtype=np.int64), np.zeros(total_frames, dtype=bool)
+    last = np.searchsorted(frames, all_frames, side='right') - 1
+    covered = (last >= 0) & (all_frames - frames[last] < hold_frames)
+    return all_frames, last, covered
+
+def _forward_fill(values, empty_value):
+    indices = np.where(values != empty_value, np.arange(len(values)), 0)
+    np.maximum.accumulate(indices, out=indices)
+    return values[indices]
+
+def _cumulative_curve(frames, increments, total_frames, start_value, hold_frames=5):
+    # Each onset adds its increment once per held frame; np.cumsum adds sequentially,
+    # so the running totals are bit-identical to `current += increment`
+    held = np.minimum(hold_frames, total_frames - frames)
+    running = np.cumsum(np.concatenate(([start_value], np.repeat(increments, held))))[1:]
+    first_step = np.concatenate(([0], np.cumsum(held)[:-1]))
+
+    all_frames, last, covered = _last_onsets(frames, hold_frames, total_frames)
+    values = np.full(total_frames, start_value, dtype=np.float64)
+    last = last[covered]
+    values[covered] = running[first_step[last] + all_frames[covered] - frames[last]]
+    return _forward_fill(values, start_value).tolist()
+
+def rotation_curve(frames, velocities, total_frames):
+    increments = _map_velocities_to_range(velocities, 0, 1)
+    return _cumulative_curve(frames, increments, total_frames, 0.0)
+
+def rotation_z_curve(frames, velocities, total_frames, hold_frames=10):
+    levels = _map_velocities_to_range(velocities, 0, 10)
+    _, last, covered = _last_onsets(frames, hold_frames, total_frames)
+    values = np.zeros(total_frames, dtype=np.float64)
+    values[covered] = levels[last[covered]]
+    reset_frames = frames + hold_frames
+    values = values.tolist()
+    # The loop version resets with an int 0; keep it so the JSON output is unchanged
+    for reset_frame in reset_frames[reset_frames < total_frames].tolist():
+        values[reset_frame] = 0
+    return values
+
+def strength_curve(frames, total_frames, fps, strength_kick, strength_default, kick_duration_seconds):
+    kick_frames = int(kick_duration_seconds * fps)
+    values = np.full(total_frames, strength_default, dtype=np.float64)
+    if kick_frames > 0:
+        # A reset can only land before a later onset on the same frame, so onsets always win
+        values[frames] = strength_kick
+    elif kick_frames < 0:
+        reset_frames = frames + kick_frames
+        positions = np.stack([frames, reset_frames], axis=1).ravel()
+        updates = np.tile(np.array([strength_kick, strength_default], dtype=np.float64), len(frames))
+        _scatter_last(values, positions % total_frames, updates)
+    return values.tolist()
+
+def translation_z_curve(frames, velocities, total_frames):
+    return _cumulative_curve(frames, velocities / 5, total_frames, 1.0)
+
+def strength_curves(frame_lists, total_frames, fps, strength_kicks, strength_defaults, kick_durations_seconds):
+    # Strength curves for many variants at once, one row per variant
+    strength_kicks = np.asarray(strength_kicks, dtype=np.float64)
+    strength_defaults = np.asarray(strength_defaults, dtype=np.float64)
+    kick_frames = (np.asarray(kick_durations_seconds, dtype=np.float64) * fps).astype(np.int64)
+    onset_mask = np.zeros((len(frame_lists), total_frames), dtype=bool)
+    for k, frames in enumerate(frame_lists):
+        onset_mask[k, frames] = True
+    # Same rule as strength_curve: kicks win on onset frames, unless a zero-length kick resets them
+    onset_mask &= (kick_frames > 0)[:, None]
+    rows = np.where(onset_mask, strength_kicks[:, None], strength_defaults[:, None]).tolist()
+    for k in np.flatnonzero(kick_frames < 0).tolist():
+        rows[k] = strength_curve(frame_lists[k], total_frames, fps, strength_kicks[k], strength_defaults[k], kick_durations_seconds[k])
+    return rows
+
+def compute_variant_curves(onsets, total_frames, fps, variants):
+    # Curves for several parameter variants of one clip. Each variant has a note_mapping
+    # (field -> note) and strength settings; note curves are shared, strength is batched.
+    note_curves = {}
+
+    def note_curve(curve_function, note):
+        if (curve_function, note) not in note_curves:
+            note_curves[(curve_function, note)] = curve_function(*onsets.get(note, _empty_onsets()), total_frames)
+        return note_curves[(curve_function, note)]
+
+    strength_rows = strength_curves(
+        [onsets.get(variant["note_mapping"].get("strength"), _empty_onsets())[0] for variant in variants],
+        total_frames, fps,
+        [variant["strength_kick"] for variant in variants],
+        [variant["strength_default"] for variant in variants],
+        [variant["kick_duration_seconds"] for variant in variants])
+
+    variant_curves = []
+    for variant, strength_values in zip(variants, strength_rows):
+        note_mapping = variant["note_mapping"]
+        curves = {}
+        if note_mapping.get("rotation_3d_x"):
+            curves["rotation_3d_x"] = note_curve(rotation_curve, note_mapping["rotation_3d_x"])
+        if note_mapping.get("rotation_3d_y"):
+            curves["rotation_3d_y"] = note_curve(rotation_curve, note_mapping["rotation_3d_y"])
+        if note_mapping.get("rotation_3d_z"):
+            curves["rotation_3d_z"] = note_curve(rotation_z_curve, note_mapping["rotation_3d_z"])
+        if note_mapping.get("strength"):
+            curves["strength"] = strength_values
+        if note_mapping.get("translation_z"):
+            curves["translation_z"] = note_curve(translation_z_curve, note_mapping["translation_z"])
+        variant_curves.append(curves)
+    return variant_curves
+
+def compute_parameter_curves(
+    onsets, total_frames, fps,
     rotation_3d_x_note=None, rotation_3d_y_note=None, strength_note=None,
     translation_z_note=None, rotation_3d_z_note=None,
-    strength_default=0.8, strength_kick=0.3, kick_duration_seconds=0.1,
-    prompts_directory='video2midi_prompts'):
+    strength_default=0.8, strength_kick=0.3, kick_duration_seconds=0.1):
+
+    variant = {
+        "note_mapping": {
+            "rotation_3d_x": rotation_3d_x_note,
+            "rotation_3d_y": rotation_3d_y_note,
+            "rotation_3d_z": rotation_3d_z_note,
+            "strength": strength_note,
+            "translation_z": translation_z_note
+        },
+        "strength_default": strength_default,
+        "strength_kick": strength_kick,
+        "kick_duration_seconds": kick_duration_seconds
+    }
+    return compute_variant_curves(onsets, total_frames, fps, [variant])[0]
 
+def midi_events_to_onsets(frame_events):
+    # Either the columnar event table or the legacy per-frame message lists
+    if isinstance(frame_events, dict):
+        return event_table_to_onsets(frame_events)
+    return frame_events_to_onsets(frame_events)
+
+KEYFRAME_FIELD_ORDER = ["rotation_3d_x", "rotation_3d_y", "rotation_3d_z", "translation_z", "strength"]
+
+NEGATIVE_PROMPT = "watermark, logo, text, signature, copyright, writing, letters, low quality, artefacts, cropped, bad art, poorly drawn, lowres, simple, pixelated, grain, noise, blurry, cartoon, computer game, video game, painting, drawing, sketch, disfigured, deformed, mutant, suit, formal, nsfw, nude."
+
+def curves_to_parseq_config(curves, total_frames, positive_prompt, sparse=False, verify_sparse=True):
     parseq_config = {
         "meta": {
             "docName": "MIDI to Parseq"
         },
         "prompts": {
-            "positive": get_random_prompt(prompts_directory),
-            "negative": "watermark, logo, text, signature, copyright, writing, letters, low quality, artefacts, cropped, bad art, poorly drawn, lowres, simple, pixelated, grain, noise, blurry, cartoon, computer game, video game, painting, drawing, sketch, disfigured, deformed, mutant, suit, formal, nsfw, nude."
+            "positive": positive_prompt,
+            "negative": NEGATIVE_PROMPT
         },
         "options": {
             "input_fps": "",
@@ -140,52 +277,45 @@ def midi_to_parseq_config(
             "cc_window_slide_rate": 1,
             "cc_use_input": False
         },
-        "displayFields": [],
+        "displayFields": list(curves),
         "keyframes": []
     }
 
-    keyframes = parseq_config["keyframes"]
-
-    # Initialize value arrays
-    rotation_3d_x_values = [0.0] * total_frames
-    rotation_3d_y_values = [0.0] * total_frames
-    rotation_3d_z_values = [0.0] * total_frames
-    translation_z_values = [1.0] * total_frames
-    strength_values = [strength_default] * total_frames
-
-    # Set frames for each parameter
-    if rotation_3d_x_note:
-        set_rotation_frames(rotation_3d_x_values, frame_events, total_frames, rotation_3d_x_note)
-        parseq_config["displayFields"].append("rotation_3d_x")
-    if rotation_3d_y_note:
-        set_rotation_frames(rotation_3d_y_values, frame_events, total_frames, rotation_3d_y_note)
-        parseq_config["displayFields"].append("rotation_3d_y")
-    if rotation_3d_z_note:
-        set_rotation_z_frames(rotation_3d_z_values, frame_events, total_frames, rotation_3d_z_note)
-        parseq_config["displayFields"].append("rotation_3d_z")
-    if strength_note:
-        set_strength_frames(strength_values, frame_events, total_frames, fps, strength_note, strength_kick, strength_default, kick_duration_seconds)
-        parseq_config["displayFields"].append("strength")
-    if translation_z_note:
-        set_translation_z_frames(translation_z_values, frame_events, total_frames, translation_z_note)
-        parseq_config["displayFields"].append("translation_z")
-
     # Create keyframes with all values grouped
+    keyframes = parseq_config["keyframes"]
+    columns = [(field, curves[field]) for field in KEYFRAME_FIELD_ORDER if field in curves]
     for i in range(total_frames):
         keyframe = {"frame": i}
-        if rotation_3d_x_note:
-            keyframe["rotation_3d_x"] = rotation_3d_x_values[i]
-        if rotation_3d_y_note:
-            keyframe["rotation_3d_y"] = rotation_3d_y_values[i]
-        if rotation_3d_z_note:
-            keyframe["rotation_3d_z"] = rotation_3d_z_values[i]
-        if translation_z_note:
-            keyframe["translation_z"] = translation_z_values[i]
-        if strength_note:
-            keyframe["strength"] = strength_values[i]
+        for field, values in columns:
+            keyframe[field] = values[i]
         keyframes.append(keyframe)
 
+    # Optionally keep only change points; step interpolation reproduces the dense curves
+    if sparse:
+        parseq_config["keyframes"] = sparse_keyframes(keyframes, parseq_config["displayFields"])
+        if verify_sparse:
+            verify_sparse_keyframes(parseq_config["keyframes"], keyframes, parseq_config["displayFields"])
+
     parseq_config["total_frames"] = total_frames
-    
+
     return parseq_config
 
+def midi_to_parseq_config(
+    frame_events, total_frames, fps,
+    rotation_3d_x_note=None, rotation_3d_y_note=None, strength_note=None,
+    translation_z_note=None, rotation_3d_z_note=None,
+    strength_default=0.8, strength_kick=0.3, kick_duration_seconds=0.1,
+    prompts_directory='video2midi_prompts', rng=random, theme_weights=None,
+    sparse=False, verify_sparse=True):
+
+    positive_prompt = get_random_prompt(prompts_directory, rng, theme_weights)
+
+    # Compute every curve from a single read of the events
+    curves = compute_parameter_curves(
+        midi_events_to_onsets(frame_events), total_frames, fps,
+        rotation_3d_x_note=rotation_3d_x_note, rotation_3d_y_note=rotation_3d_y_note,
+        strength_note=strength_note, translation_z_note=translation_z_note,
+        rotation_3d_z_note=rotation_3d_z_note, strength_default=strength_default,
+        strength_kick=strength_kick, kick_duration_seconds=kick_duration_seconds)
+
+    return curves_to_parseq_config(curves, total_frames, positive_prompt, sparse=sparse, verify_sparse=verify_sparse)
@@ -0,0 +1,291 @@
+import argparse
+import cProfile
+import io
+import json
+import math
+import os
+import pstats
+import random
+import resource
+import shutil
+import sys
+import time
+import tracemalloc
+import mido
+from MIDI_to_parseq import midi_to_frame_events, midi_to_parseq_config
+from dataset_creation import NOTE_MAPPING, build_generated_at, derive_file_seed, generate_parseq_configs_for_midi, process_all_midi_files
+from parseq_to_rendered import parseq_to_deforum
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(HERE, "benchmark_baseline.json")
+
+# Drum notes of the synthetic files, the ones NOTE_MAPPING reads
+KICK, SNARE, CLOSED_HAT, PEDAL_HAT, OPEN_HAT = 36, 38, 42, 44, 46
+TICKS_PER_BEAT = 480
+STEP_TICKS = TICKS_PER_BEAT // 4  # 16th notes
+
+STAGES = ("midi_to_frame_events", "midi_to_parseq_config", "parseq_to_deforum", "generate_parseq_configs_for_midi")
+
+# Allowed relative change before a metric counts as a regression (saved with the baseline)
+DEFAULT_THRESHOLDS = {"latency": 0.25, "files_per_second": 0.2, "peak_rss": 0.25, "bytes_per_file": 0.05}
+
+def house_pattern(rng, bars, density):
+    # (step, note, velocity) hits of a four-on-the-floor pattern on a 16th grid; density in [0, 1]
+    # adds ghost kicks and snares, 16th closed hats and pedal hats on top of the basic groove
+    hits = []
+    for bar in range(bars):
+        for beat_step in range(16):
+            step = bar * 16 + beat_step
+            if beat_step % 4 == 0:
+                hits.append((step, KICK, rng.randint(100, 127)))
+            elif rng.random() < 0.15 * density:
+                hits.append((step, KICK, rng.randint(50, 80)))
+            if beat_step in (4, 12):
+                hits.append((step, SNARE, rng.randint(90, 120)))
+            elif rng.random() < 0.1 * density:
+                hits.append((step, SNARE, rng.randint(30, 70)))
+            if beat_step % 4 == 2:
+                if rng.random() < 0.5 + 0.5 * density:
+                    hits.append((step, OPEN_HAT, rng.randint(70, 110)))
+            elif beat_step % 2 == 0 or rng.random() < density:
+                hits.append((step, CLOSED_HAT, rng.randint(40, 100)))
+            if rng.random() < 0.2 * density:
+                hits.append((step, PEDAL_HAT, rng.randint(40, 90)))
+    return hits
+
+def write_house_midi(path, rng, seconds=16, bpm=124, density=0.5, tempo_changes=0, bpm_jitter=6):
+    # Type 0 drum file (channel 10) long enough for `seconds` at the starting tempo, with
+    # tempo_changes set_tempo events at random bar lines
+    bars = max(1, math.ceil(seconds * bpm / 60 / 4))
+    events = [(0, 0, mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(bpm)))]
+    for bar in sorted(rng.sample(range(1, bars), min(tempo_changes, bars - 1))):
+        new_bpm = bpm + rng.uniform(-bpm_jitter, bpm_jitter)
+        events.append((bar * 16 * STEP_TICKS, 0, mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(new_bpm))))
+    for step, note, velocity in house_pattern(rng, bars, density):
+        tick = step * STEP_TICKS
+        # Offs sort before ons at the same tick
+        events.append((tick, 2, mido.Message('note_on', note=note, velocity=velocity, channel=9)))
+        events.append((tick + STEP_TICKS // 2, 1, mido.Message('note_off', note=note, velocity=0, channel=9)))
+
+    track = mido.MidiTrack()
+    previous = 0
+    for tick, _, message in sorted(events, key=lambda event: (event[0], event[1])):
+        track.append(message.copy(time=tick - previous))
+        previous = tick
+    midi_file = mido.MidiFile(type=0, ticks_per_beat=TICKS_PER_BEAT)
+    midi_file.tracks.append(track)
+    midi_file.save(path)
+
+def make_corpus(midi_folder, count, seed=0, seconds=16, density=0.5, tempo_changes=0, bpm_range=(118, 128)):
+    os.makedirs(midi_folder, exist_ok=True)
+    for index in range(count):
+        rng = random.Random(derive_file_seed(seed, f"synthetic_{index}"))
+        write_house_midi(os.path.join(midi_folder, f"house_{index:05d}.mid"), rng, seconds=seconds,
+                         bpm=rng.uniform(*bpm_range), density=density, tempo_changes=tempo_changes)
+
+def make_prompts(prompts_directory, themes=4, prompts_per_theme=8):
+    for theme in range(themes):
+        theme_directory = os.path.join(prompts_directory, f"theme_{theme}")
+        os.makedirs(theme_directory, exist_ok=True)
+        for prompt in range(prompts_per_theme):
+            with open(os.path.join(theme_directory, f"prompt_{prompt}.txt"), 'w') as prompt_file:
+                prompt_file.write(f"synthetic prompt {prompt} of theme {theme}")
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+    return {"n": len(values), "p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": round(values[-1], 3)}
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+def time_stages(midi_paths, prompts_directory, output_dir, fps=24, seed=0, generated_at=None, warmup=2):
+    # Milliseconds per file spent in each stage, run one file at a time in this process
+    note_arguments = {f"{name}_note": note for name, note in NOTE_MAPPING.items()}
+    timings = {stage: [] for stage in STAGES}
+    for index, midi_path in enumerate(midi_paths[:warmup] + midi_paths):
+        rng = random.Random(derive_file_seed(seed, os.path.basename(midi_path)))
+        started = time.perf_counter()
+        frame_events, total_frames = midi_to_frame_events(midi_path, fps)
+        events_done = time.perf_counter()
+        parseq_config = midi_to_parseq_config(frame_events, total_frames, fps, prompts_directory=prompts_directory,
+                                              rng=rng, **note_arguments)
+        parseq_done = time.perf_counter()
+        parseq_to_deforum(parseq_config, rng=rng, generated_at=generated_at)
+        deforum_done = time.perf_counter()
+        generate_parseq_configs_for_midi(midi_path, prompts_directory, output_dir, index + 1, fps=fps,
+                                         seed=rng.getrandbits(64), generated_at=generated_at)
+        generate_done = time.perf_counter()
+        # The first files also pay for imports and the prompt index
+        if index < warmup:
+            continue
+        for stage, (start, end) in zip(STAGES, ((started, events_done), (events_done, parseq_done),
+                                                (parseq_done, deforum_done), (deforum_done, generate_done))):
+            timings[stage].append((end - start) * 1000)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return {stage: percentiles(values) for stage, values in timings.items()}
+
+def time_build(midi_folder, prompts_directory, output_dir, processes=1, fps=24, seed=0, generated_at=None):
+    # A full uncached dataset_creation.py build of the corpus
+    started = time.perf_counter()
+    failures = process_all_midi_files(midi_folder, prompts_directory, output_dir, seed=seed, processes=processes,
+                                      generated_at=generated_at, use_cache=False, fps=fps)
+    seconds = time.perf_counter() - started
+    files = sum(name.endswith('.mid') for name in os.listdir(midi_folder))
+    bytes_written = directory_bytes(output_dir)
+    return {"files": files, "failures": len(failures), "seconds": round(seconds, 3),
+            "files_per_second": round(files / seconds, 2), "bytes_written": bytes_written,
+            "bytes_per_file": round(bytes_written / max(files, 1))}
+
+def run_profiled(args, function, *function_args, **function_kwargs):
+    # Optional cProfile and tracemalloc around a benchmark step; both slow it down
+    profile = cProfile.Profile() if args.profile else None
+    if args.tracemalloc:
+        tracemalloc.start()
+    if profile is not None:
+        profile.enable()
+    try:
+        result = function(*function_args, **function_kwargs)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(25)
+            print(output.getvalue())
+            print(f"Profile saved to {args.profile} (python -m pstats {args.profile})")
+        if args.tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"Peak traced Python memory: {peak / (1 << 20):.1f} MB; top allocations:")
+            for stat in snapshot.statistics('lineno')[:10]:
+                print(f"  {stat}")
+    return result
+
+def regressions(report, baseline):
+    # (metric, baseline value, current value) of every metric worse than the baseline by more than its threshold
+    thresholds = baseline.get("thresholds", DEFAULT_THRESHOLDS)
+    reference = baseline["report"]
+    checks = [("end_to_end.files_per_second", reference["end_to_end"]["files_per_second"],
+               report["end_to_end"]["files_per_second"], -thresholds["files_per_second"]),
+              ("peak_rss_mb.self", reference["peak_rss_mb"]["self"], report["peak_rss_mb"]["self"],
+               thresholds["peak_rss"])]
+    # Medians only: the tail of a few dozen files is too noisy to gate on
+    for stage in STAGES:
+        checks.append((f"stages.{stage}.p50", reference["stages"][stage]["p50"], report["stages"][stage]["p50"],
+                       thresholds["latency"]))
+    regressed = []
+    for metric, old, new, threshold in checks:
+        if not old:
+            continue
+        change = (new - old) / old
+        # A negative threshold means higher is better
+        if change > threshold > 0 or change < threshold < 0:
+            regressed.append((metric, old, new))
+    # The output itself should not change size
+    old, new = reference["end_to_end"]["bytes_per_file"], report["end_to_end"]["bytes_per_file"]
+    if old and abs(new - old) / old > thresholds["bytes_per_file"]:
+        regressed.append(("end_to_end.bytes_per_file", old, new))
+    return regressed
+
+def print_report(report):
+    end_to_end = report["end_to_end"]
+    print(f"Build: {end_to_end['files']} files in {end_to_end['seconds']} s, {end_to_end['files_per_second']} files/s, "
+          f"{end_to_end['bytes_written'] / 1e6:.1f} MB written ({end_to_end['bytes_per_file'] / 1e3:.1f} KB per file)")
+    print("Stage (ms)                              n      p50      p95      p99      max")
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:<34} {stats['n']:>6} {stats['p50']:>8} {stats['p95']:>8} {stats['p99']:>8} {stats['max']:>8}")
+    peak_rss = report["peak_rss_mb"]
+    workers = f", {peak_rss['children']} MB (largest worker)" if peak_rss["children"] is not None else ""
+    print(f"Peak RSS: {peak_rss['self']} MB (benchmark process){workers}")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the MIDI -> Parseq -> Deforum config pipeline stage by stage and end to end, "
+                    "on synthetic house drum files or a MIDI folder")
+    parser.add_argument("--workdir", type=str, default="pipeline_benchmark", help="Scratch directory (wiped)")
+    parser.add_argument("--midi_folder", type=str, help="Benchmark these MIDI files instead of synthetic ones")
+    parser.add_argument("--prompts_directory", type=str, help="Prompt themes (default: synthetic prompts)")
+    parser.add_argument("--count", type=int, default=200, help="Number of synthetic MIDI files")
+    parser.add_argument("--seconds", type=float, default=16, help="Length of the synthetic files")
+    parser.add_argument("--density", type=float, default=0.5, help="Ghost notes and 16th hats, from 0 (basic groove) to 1")
+    parser.add_argument("--tempo_changes", type=int, default=0, help="set_tempo events per synthetic file")
+    parser.add_argument("--stage_files", type=int, default=50, help="Files timed stage by stage")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes of the end-to-end build")
+    parser.add_argument("--fps", type=int, default=24)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", type=str, help="cProfile the stage timings into this file")
+    parser.add_argument("--tracemalloc", action="store_true", help="Report the peak traced memory of the stage timings")
+    parser.add_argument("--output", type=str, help="Also write the report to this JSON file")
+    parser.add_argument("--save_baseline", nargs="?", const=BASELINE_PATH, help="Save the report as the baseline")
+    parser.add_argument("--baseline", nargs="?", const=BASELINE_PATH,
+                        help="Compare with a saved baseline and exit with status 1 on a regression")
+    args = parser.parse_args()
+    if args.save_baseline and (args.profile or args.tracemalloc):
+        parser.error("--profile and --tracemalloc skew the timings; do not save them as a baseline")
+
+    workdir = os.path.abspath(args.workdir)
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    config = {"fps": args.fps, "seed": args.seed, "processes": args.processes, "stage_files": args.stage_files}
+    midi_folder = args.midi_folder
+    if midi_folder is None:
+        midi_folder = os.path.join(workdir, "midi")
+        make_corpus(midi_folder, args.count, args.seed, args.seconds, args.density, args.tempo_changes)
+        config.update(count=args.count, seconds=args.seconds, density=args.density, tempo_changes=args.tempo_changes)
+    else:
+        config["midi_folder"] = os.path.abspath(midi_folder)
+    prompts_directory = args.prompts_directory
+    if prompts_directory is None:
+        prompts_directory = os.path.join(workdir, "prompts")
+        make_prompts(prompts_directory)
+
+    generated_at = build_generated_at(0)
+    midi_paths = sorted(os.path.join(midi_folder, name) for name in os.listdir(midi_folder)
+                        if name.endswith('.mid'))[:args.stage_files]
+    stages = run_profiled(args, time_stages, midi_paths, prompts_directory, os.path.join(workdir, "stages"),
+                          fps=args.fps, seed=args.seed, generated_at=generated_at)
+    end_to_end = time_build(midi_folder, prompts_directory, os.path.join(workdir, "dataset"), processes=args.processes,
+                            fps=args.fps, seed=args.seed, generated_at=generated_at)
+    report = {"config": config, "stages": stages, "end_to_end": end_to_end,
+              "peak_rss_mb": {"self": peak_rss_mb(resource.RUSAGE_SELF),
+                              "children": peak_rss_mb(resource.RUSAGE_CHILDREN) if args.processes > 1 else None}}
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+    if args.save_baseline:
+        thresholds = DEFAULT_THRESHOLDS
+        if os.path.exists(args.save_baseline):
+            # Keep thresholds tuned by hand in the previous baseline
+            with open(args.save_baseline, 'r') as baseline_file:
+                thresholds = json.load(baseline_file).get("thresholds", thresholds)
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({"thresholds": thresholds, "report": report}, baseline_file, indent=4)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["report"]["config"] != config:
+            print(f"Warning: the baseline was measured with {baseline['report']['config']}")
+        regressed = regressions(report, baseline)
+        for metric, old, new in regressed:
+            print(f"Regression: {metric} {old} -> {new}")
+        if regressed:
+            sys.exit(1)
+        print("No regression against the baseline")
+
+if __name__ == "__main__":
+    main()
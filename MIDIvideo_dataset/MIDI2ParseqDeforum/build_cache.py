@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+
+# All live in the output base directory
+SAMPLE_IDS_FILE = 'sample_ids.json'
+BUILD_CACHE_FILE = 'build_cache.json'
+LAYOUT_FILE = 'layout.json'
+
+# Bump when the sampled ranges or the curve code change, so every entry is rebuilt
+CACHE_VERSION = 1
+
+def _load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as file:
+        return json.load(file)
+
+def write_json_atomic(obj, path):
+    # Readers never see a half-written file, even if the build is killed
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w') as file:
+        json.dump(obj, file)
+    os.replace(temporary_path, path)
+
+def load_sample_ids(output_base_dir):
+    return _load_json(os.path.join(output_base_dir, SAMPLE_IDS_FILE), {})
+
+def assign_sample_ids(sample_ids, listing, is_midi_file):
+    # Append-only MIDI file name -> sample id, so adding files never renumbers existing samples.
+    # A first build numbers files like the old enumerate(os.listdir(...), 1) loop did.
+    first_build = not sample_ids
+    next_id = max(sample_ids.values(), default=0) + 1
+    for i, name in enumerate(listing, 1):
+        if not is_midi_file(name) or name in sample_ids:
+            continue
+        if first_build:
+            sample_ids[name] = i
+        else:
+            sample_ids[name] = next_id
+            next_id += 1
+    return sample_ids
+
+def save_sample_ids(sample_ids, output_base_dir):
+    write_json_atomic(sample_ids, os.path.join(output_base_dir, SAMPLE_IDS_FILE))
+
+def check_clips_per_file(clips_per_file, output_base_dir):
+    # Sample indices are (sample id - 1) * clips_per_file + clip, so a dataset keeps the clips_per_file
+    # it was first built with: any other value would give existing samples new indices
+    layout_path = os.path.join(output_base_dir, LAYOUT_FILE)
+    layout = _load_json(layout_path, {})
+    if "clips_per_file" not in layout:
+        write_json_atomic({"clips_per_file": clips_per_file}, layout_path)
+    elif layout["clips_per_file"] != clips_per_file:
+        raise ValueError(f"{output_base_dir} holds {layout['clips_per_file']} clips per MIDI file, not {clips_per_file}: "
+                         f"use the same --variants and --max_windows, or a new directory")
+
+def load_build_cache(output_base_dir):
+    cache = _load_json(os.path.join(output_base_dir, BUILD_CACHE_FILE), {})
+    if cache.get("version") != CACHE_VERSION:
+        return {"version": CACHE_VERSION, "entries": {}}
+    return cache
+
+def save_build_cache(cache, output_base_dir):
+    write_json_atomic(cache, os.path.join(output_base_dir, BUILD_CACHE_FILE))
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def midi_file_state(cache, name, path):
+    # Size and mtime match the cached entry: reuse its hash instead of reading the file again
+    stat = os.stat(path)
+    entry = cache["entries"].get(name)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        midi_sha256 = entry["midi_sha256"]
+    else:
+        midi_sha256 = file_digest(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "midi_sha256": midi_sha256}
+
+def prompt_index_digest(index):
+    return hashlib.sha256(json.dumps(index["themes"], sort_keys=True).encode('utf-8')).hexdigest()
+
+def build_key(midi_sha256, seed, parameters, prompts_sha256):
+    # Everything a sample's outputs depend on
+    key = {"midi": midi_sha256, "seed": seed, "parameters": parameters, "prompts": prompts_sha256}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
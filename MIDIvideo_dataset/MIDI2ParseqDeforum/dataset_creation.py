@@ -1,69 +1,322 @@
+import argparse
+import hashlib
 import os
 import random
 import json
 import shutil
-from mido import MidiFile
-from MIDI_to_parseq import midi_to_frame_events, midi_to_parseq_config
-from parseq_to_rendered import save_converted_config
-
-def generate_parseq_configs_for_midi(midi_file_path, prompts_directory, output_dir, fps=24):
-    # Extract MIDI file name without extension
-    midi_file_name = os.path.basename(midi_file_path).split('.')[0]
-
-    # Create the output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    # Generate frame events and total frames
-    frame_events, total_frames = midi_to_frame_events(midi_file_path, fps)
-    
-    # Generate 1 Parseq configuration for the MIDI file
-    parseq_config = midi_to_parseq_config(
-        frame_events,
-        total_frames,
-        fps,
-        rotation_3d_x_note=46,  # Hi-Hat Open for rotation_3d_x
-        rotation_3d_y_note=44,  # Pedal Hi-Hat for rotation_3d_y
-        strength_note=36,       # Kick for strength
-        translation_z_note=38,  # Snare for translation_z
-        rotation_3d_z_note=42,  # Closed Hi-Hat for rotation_3d_z
-        strength_default=random.uniform(0.8, 0.9),
-        strength_kick=random.uniform(0.25, 0.5),
-        kick_duration_seconds=random.uniform(0.05, 0.15),
-        prompts_directory=prompts_directory
-    )
-    
-    # Save Parseq config to JSON
-    parseq_config_path = os.path.join(output_dir, f"{midi_file_name}_parseq_config.json")
-    with open(parseq_config_path, 'w') as f:
-        json.dump(parseq_config, f, indent=4)
-    
-    # Render the Parseq config for Deforum
-    rendered_config_path = os.path.join(output_dir, f"{midi_file_name}_parseq_rendered.json")
-    save_converted_config(parseq_config_path, rendered_config_path)
-    
-    # Copy the MIDI file to the output directory
-    shutil.copy(midi_file_path, output_dir)
-
-def process_all_midi_files(midi_folder, prompts_directory, output_base_dir):
+import sys
+import time
+from datetime import datetime
+from multiprocessing import Pool
+from MIDI_to_parseq import get_random_prompt, midi_events_to_onsets, compute_variant_curves, curves_to_parseq_config
+from midi_events import midi_to_event_table, iter_midi_windows, CLIP_SECONDS
+from parseq_to_rendered import parseq_to_deforum, dump_json, GENERATED_AT_FORMAT
+from prompt_index import load_prompt_index
+from build_cache import (assign_sample_ids, build_key, check_clips_per_file, load_build_cache, load_sample_ids,
+                         midi_file_state, prompt_index_digest, save_build_cache, save_sample_ids)
+
+# Samples are named the way the render side reads them
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "video_generation"))
+import dataset_layout
+from job_cost import load_cost_index, save_cost_index, strength_profile
+
+# Windows kept per file with window_hop_seconds, so every file gets the same number of sample indices
+MAX_WINDOWS = 8
+
+def derive_file_seed(master_seed, midi_file_name):
+    # Seed depends only on the master seed and the file, never on scheduling order
+    digest = hashlib.sha256(f"{master_seed}:{midi_file_name}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+# MIDI note driving each visual parameter
+NOTE_MAPPING = {
+    "rotation_3d_x": 46,  # Hi-Hat Open
+    "rotation_3d_y": 44,  # Pedal Hi-Hat
+    "strength": 36,       # Kick
+    "translation_z": 38,  # Snare
+    "rotation_3d_z": 42   # Closed Hi-Hat
+}
+
+def variant_seed(seed, variant_index):
+    # Variant 0 keeps the file seed, so single-variant builds are unchanged
+    if seed is None or variant_index == 0:
+        return seed
+    return derive_file_seed(seed, f"variant_{variant_index}")
+
+def sample_variant(rng, remap_notes=False):
+    variant = {
+        "strength_default": rng.uniform(0.8, 0.9),
+        "strength_kick": rng.uniform(0.25, 0.5),
+        "kick_duration_seconds": rng.uniform(0.05, 0.15),
+        "note_mapping": dict(NOTE_MAPPING)
+    }
+    # Optionally shuffle which drum drives which parameter
+    if remap_notes:
+        variant["note_mapping"] = dict(zip(NOTE_MAPPING, rng.sample(list(NOTE_MAPPING.values()), len(NOTE_MAPPING))))
+    return variant
+
+def window_seed(seed, window_index):
+    # Window 0 keeps the file seed, so it matches the single-clip build
+    if seed is None or window_index == 0:
+        return seed
+    return derive_file_seed(seed, f"window_{window_index}")
+
+def clip_configs(event_table, total_frames, prompts_directory, fps=24, seed=None, generated_at=None, theme_weights=None,
+                 rendered_frames_layout='rows', sparse_keyframes=False, variants=1, remap_notes=False):
+    # (sample, parseq_config, rendered_config) of every variant of a clip, built in memory
+    # Every variant reuses the onsets of the decoded clip
+    onsets = midi_events_to_onsets(event_table)
+
+    # All random draws for a variant come from its own generator
+    rngs, samples, prompts = [], [], []
+    for variant_index in range(variants):
+        rng = random.Random(variant_seed(seed, variant_index))
+        samples.append(sample_variant(rng, remap_notes))
+        prompts.append(get_random_prompt(prompts_directory, rng, theme_weights))
+        rngs.append(rng)
+
+    # Build the curves of all variants in one batch
+    variant_curves = compute_variant_curves(onsets, total_frames, fps, samples)
+
+    # Variants are rendered in order, each drawing its ids from its own generator
+    for rng, sample, prompt, curves in zip(rngs, samples, prompts, variant_curves):
+        parseq_config = curves_to_parseq_config(curves, total_frames, prompt, sparse=sparse_keyframes)
+        rendered_config = parseq_to_deforum(parseq_config, rng=rng, generated_at=generated_at,
+                                            rendered_frames_layout=rendered_frames_layout,
+                                            sparse_rendered_frames=sparse_keyframes)
+        yield sample, parseq_config, rendered_config
+
+def write_clip_configs(midi_file_path, event_table, total_frames, prompts_directory, dataset_dir, first_index, fps=24,
+                       seed=None, write_parseq_config=True, compact=False, variants=1, window=None, cost_profiles=None,
+                       **config_options):
+    # config_options are passed on to clip_configs (generated_at, remap_notes, ...)
+    # Variant k of the clip is sample first_index + k, in the directory dataset_layout.py names.
+    # cost_profiles, if given, gets the render cost profile of each sample written (job_cost.py)
+    bytes_written = 0
+    configs = clip_configs(event_table, total_frames, prompts_directory, fps=fps, seed=seed, variants=variants,
+                           **config_options)
+    for variant_index, (sample, parseq_config, rendered_config) in enumerate(configs):
+        index = first_index + variant_index
+        sample_dir = dataset_layout.sample_dir(dataset_dir, index)
+
+        # Create the output directory if it doesn't exist
+        if not os.path.exists(sample_dir):
+            os.makedirs(sample_dir)
+
+        # The Parseq config rendered for Deforum straight from memory
+        rendered_config_path = dataset_layout.config_path(dataset_dir, index)
+        bytes_written += dump_json(rendered_config, rendered_config_path, compact=compact)
+        if cost_profiles is not None:
+            cost_profiles[index] = strength_profile(rendered_config)
+
+        # Optionally save the intermediate Parseq config to JSON
+        if write_parseq_config:
+            parseq_config_path = f"{os.path.splitext(rendered_config_path)[0]}_config.json"
+            bytes_written += dump_json(parseq_config, parseq_config_path, compact=compact)
+
+        # Record how each variant was drawn so it can be regenerated on its own
+        if variants > 1:
+            seed_record = {"midi_file": os.path.basename(midi_file_path), "file_seed": seed, "variant": variant_index,
+                           "variant_seed": variant_seed(seed, variant_index), **sample}
+            bytes_written += dump_json(seed_record, os.path.join(sample_dir, "seed.json"))
+
+        # The MIDI file is copied whole, so record which part of it the clip covers
+        if window is not None:
+            bytes_written += dump_json(window, os.path.join(sample_dir, "window.json"))
+
+        # Copy the MIDI file to the output directory
+        shutil.copy(midi_file_path, dataset_layout.midi_path(dataset_dir, index))
+        bytes_written += os.path.getsize(midi_file_path)
+
+    return bytes_written
+
+def iter_midi_clips(midi_file_path, fps=24, seed=None, clip_seconds=CLIP_SECONDS, window_hop_seconds=None,
+                    keep_partial_windows=False):
+    # (window record, event table, total frames, seed) of every clip cut from the file
+    if window_hop_seconds is None:
+        # First clip_seconds of the file only
+        event_table, total_frames = midi_to_event_table(midi_file_path, fps, clip_seconds)
+        yield None, event_table, total_frames, seed
+        return
+
+    # Every window of the file from a single streaming parse
+    windows = iter_midi_windows(midi_file_path, fps, clip_seconds, window_hop_seconds, keep_partial_windows)
+    for window_index, start_frame, event_table, total_frames in windows:
+        window = {"window": window_index, "start_seconds": start_frame / fps, "duration_seconds": total_frames / fps,
+                  "hop_seconds": window_hop_seconds}
+        yield window, event_table, total_frames, window_seed(seed, window_index)
+
+def clips_per_file(variants=1, window_hop_seconds=None, max_windows=MAX_WINDOWS, **_):
+    # Sample indices given to each MIDI file: one per variant of every window kept
+    return variants * (max_windows if window_hop_seconds is not None else 1)
+
+def generate_parseq_configs_for_midi(midi_file_path, prompts_directory, dataset_dir, sample_id, fps=24, seed=None,
+                                     clip_seconds=CLIP_SECONDS, window_hop_seconds=None, keep_partial_windows=False,
+                                     max_windows=MAX_WINDOWS, variants=1, **clip_options):
+    # clip_options are passed on to write_clip_configs (compact, remap_notes, ...); variant v of window w
+    # is clip w * variants + v of the file's sample indices
+    file_clips = clips_per_file(variants, window_hop_seconds, max_windows)
+    bytes_written = 0
+    clips = iter_midi_clips(midi_file_path, fps, seed, clip_seconds, window_hop_seconds, keep_partial_windows)
+    for window_index, (window, event_table, total_frames, clip_seed) in enumerate(clips):
+        if window_index == max_windows:
+            print(f"{midi_file_path}: windows past the first {max_windows} are dropped")
+            break
+        first_index = dataset_layout.sample_index(sample_id, window_index * variants, file_clips)
+        bytes_written += write_clip_configs(midi_file_path, event_table, total_frames, prompts_directory, dataset_dir,
+                                            first_index, fps=fps, seed=clip_seed, variants=variants, window=window,
+                                            **clip_options)
+    return bytes_written
+
+def _generate_task(task):
+    midi_file_path, prompts_directory, output_base_dir, sample_id, seed, generation_options = task
+    cost_profiles = {}
+    try:
+        bytes_written = generate_parseq_configs_for_midi(
+            midi_file_path, prompts_directory, output_base_dir, sample_id, seed=seed, cost_profiles=cost_profiles,
+            **generation_options)
+    except Exception as e:
+        return midi_file_path, 0, None, f"{type(e).__name__}: {e}"
+    return midi_file_path, bytes_written, cost_profiles, None
+
+def build_generated_at(source_date_epoch=None):
+    # One timestamp per build (SOURCE_DATE_EPOCH when set) keeps reruns byte-identical
+    if source_date_epoch is None:
+        source_date_epoch = os.getenv("SOURCE_DATE_EPOCH")
+    if source_date_epoch is None:
+        return datetime.utcnow().strftime(GENERATED_AT_FORMAT)
+    return datetime.utcfromtimestamp(int(source_date_epoch)).strftime(GENERATED_AT_FORMAT)
+
+def is_midi_file(name):
+    return name.endswith('.mid') or name.endswith('.midi')
+
+def process_all_midi_files(midi_folder, prompts_directory, output_base_dir, seed=0, processes=1, chunksize=16,
+                           generated_at=None, report_every=500, use_cache=True, **generation_options):
+    # generation_options are passed on to generate_parseq_configs_for_midi (fps, compact, ...)
     # Ensure the output base directory exists
     if not os.path.exists(output_base_dir):
         os.makedirs(output_base_dir)
-    
-    # Process each MIDI file in the midi_folder
-    for i, midi_file in enumerate(os.listdir(midi_folder), 1):
-        if midi_file.endswith('.mid') or midi_file.endswith('.midi'):
+
+    # Key the cache before generated_at is added, so a new timestamp alone does not force a rebuild
+    cache_parameters = {**generation_options, "note_mapping": NOTE_MAPPING}
+
+    if generated_at is None:
+        generated_at = build_generated_at()
+    generation_options = {**generation_options, "generated_at": generated_at}
+
+    # Scan the prompts once; workers reload the saved index instead of walking the directory
+    prompts_sha256 = prompt_index_digest(load_prompt_index(prompts_directory, refresh=True))
+
+    # Sample ids are kept across runs, so new files never shift existing output directories
+    file_clips = clips_per_file(**generation_options)
+    check_clips_per_file(file_clips, output_base_dir)
+    listing = os.listdir(midi_folder)
+    sample_ids = assign_sample_ids(load_sample_ids(output_base_dir), listing, is_midi_file)
+    save_sample_ids(sample_ids, output_base_dir)
+    cache = load_build_cache(output_base_dir)
+    # Render cost of every sample, so the render side orders them without parsing each config
+    cost_index = load_cost_index(output_base_dir)
+
+    # One task per new or changed MIDI file in the midi_folder
+    tasks = []
+    cache_updates = {}
+    skipped = 0
+    for midi_file in listing:
+        if is_midi_file(midi_file):
             midi_file_path = os.path.join(midi_folder, midi_file)
-            output_dir = os.path.join(output_base_dir, f"midi_parseq_rendered_{i}")
-            generate_parseq_configs_for_midi(midi_file_path, prompts_directory, output_dir)
+            sample_id = sample_ids[midi_file]
+            file_seed = derive_file_seed(seed, midi_file)
+
+            entry = midi_file_state(cache, midi_file, midi_file_path)
+            entry["key"] = build_key(entry["midi_sha256"], file_seed, cache_parameters, prompts_sha256)
+            cached = cache["entries"].get(midi_file)
+            # Every build of the file writes its first clip
+            first_config = dataset_layout.config_path(output_base_dir, dataset_layout.sample_index(sample_id, 0, file_clips))
+            if use_cache and cached is not None and cached["key"] == entry["key"] and os.path.exists(first_config):
+                skipped += 1
+                continue
+            cache_updates[midi_file_path] = (midi_file, entry)
+            tasks.append((midi_file_path, prompts_directory, output_base_dir, sample_id, file_seed, generation_options))
+    print(f"{len(tasks)} MIDI files to generate, {skipped} unchanged")
+
+    start_time = time.time()
+    total_bytes = 0
+    failures = []
+    pool = Pool(processes) if processes > 1 else None
+    try:
+        results = pool.imap_unordered(_generate_task, tasks, chunksize) if pool else map(_generate_task, tasks)
+        for done, (midi_file_path, bytes_written, cost_profiles, error) in enumerate(results, 1):
+            total_bytes += bytes_written
+            if error is not None:
+                failures.append((midi_file_path, error))
+                print(f"Failed {midi_file_path}: {error}")
+            else:
+                midi_file, entry = cache_updates[midi_file_path]
+                cache["entries"][midi_file] = entry
+                cost_index.update(cost_profiles)
+            if done % report_every == 0 or done == len(tasks):
+                # Saving with the progress line means an interrupted build keeps most of its work
+                save_build_cache(cache, output_base_dir)
+                save_cost_index(cost_index, output_base_dir)
+                elapsed = max(time.time() - start_time, 1e-9)
+                print(f"{done}/{len(tasks)} MIDI files processed, {done / elapsed:.1f} files/s, "
+                      f"{total_bytes / 1e6:.1f} MB written ({total_bytes / max(done, 1) / 1e3:.1f} KB per MIDI file)")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        save_build_cache(cache, output_base_dir)
+        save_cost_index(cost_index, output_base_dir)
+
+    return failures
+
+if __name__ == "__main__":
+    # Paths
+    base_path = '/Users/dieny/Desktop/1706_newTests'
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--midi_folder", type=str, default=os.path.join(base_path, 'House_MIDI_16s_2'), help="Folder of MIDI files")
+    parser.add_argument("--prompts_directory", type=str, default=os.path.join(base_path, 'video2midi_prompts'), help="Folder of prompt themes")
+    parser.add_argument("--output_base_dir", type=str, default=os.path.join(base_path, 'midi_parseq_dataset'), help="Where to write the dataset")
+    parser.add_argument("--fps", type=int, default=24, help="Frames per second of the generated configs")
+    parser.add_argument("--seed", type=int, default=0, help="Master seed; each file gets its own seed derived from it")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("SLURM_CPUS_PER_TASK", os.cpu_count() or 1)), help="Number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=16, help="MIDI files handed to a worker per dispatch")
+    parser.add_argument("--skip_parseq_config", action="store_true", help="Do not write the intermediate _parseq_config.json")
+    parser.add_argument("--compact_json", action="store_true", help="Write compact JSON instead of indented JSON")
+    parser.add_argument("--theme_weights", type=str, help="JSON file mapping prompt theme names to sampling weights")
+    parser.add_argument("--rendered_frames_layout", choices=['rows', 'columns'], default='rows',
+                        help="Deforum needs 'rows'; 'columns' stores one list per rendered field")
+    parser.add_argument("--sparse_keyframes", action="store_true", help="Write only change-point keyframes and rendered_frames rows, held until the next one")
+    parser.add_argument("--variants", type=int, default=1, help="Configs generated per MIDI file from a single parse")
+    parser.add_argument("--remap_notes", action="store_true", help="Shuffle the note-to-parameter mapping of each variant")
+    parser.add_argument("--clip_seconds", type=float, default=CLIP_SECONDS, help="Length of each clip in seconds")
+    parser.add_argument("--window_hop_seconds", type=float,
+                        help="Cut every clip_seconds window of each file, this many seconds apart (overlapping if shorter than clip_seconds)")
+    parser.add_argument("--keep_partial_windows", action="store_true", help="Also keep windows running past the end of the file")
+    parser.add_argument("--max_windows", type=int, default=MAX_WINDOWS, help="Windows kept per file with --window_hop_seconds")
+    parser.add_argument("--rebuild", action="store_true", help="Regenerate every MIDI file, ignoring the build cache")
+    args = parser.parse_args()
 
-# Paths
-base_path = '/Users/dieny/Desktop/1706_newTests'
-midi_folder = os.path.join(base_path, 'House_MIDI_16s_2')
-prompts_directory = os.path.join(base_path, 'video2midi_prompts')
-output_base_dir = os.path.join(base_path, 'midi_parseq_dataset')
+    theme_weights = None
+    if args.theme_weights:
+        with open(args.theme_weights, 'r') as f:
+            theme_weights = json.load(f)
 
-# Process all MIDI files
-process_all_midi_files(midi_folder, prompts_directory, output_base_dir)
+    # Process all MIDI files
+    try:
+        failures = process_all_midi_files(args.midi_folder, args.prompts_directory, args.output_base_dir,
+                                          fps=args.fps, seed=args.seed, processes=args.processes, chunksize=args.chunksize,
+                                          write_parseq_config=not args.skip_parseq_config, compact=args.compact_json,
+                                          theme_weights=theme_weights, rendered_frames_layout=args.rendered_frames_layout,
+                                          sparse_keyframes=args.sparse_keyframes, variants=args.variants, remap_notes=args.remap_notes,
+                                          clip_seconds=args.clip_seconds, window_hop_seconds=args.window_hop_seconds,
+                                          keep_partial_windows=args.keep_partial_windows, max_windows=args.max_windows,
+                                          use_cache=not args.rebuild)
+    except ValueError as e:
+        sys.exit(f"Cannot build into {args.output_base_dir}: {e}")
 
-print("All MIDI files processed and Parseq configurations generated successfully.")
+    if failures:
+        print(f"{len(failures)} MIDI files failed.")
+    else:
+        print("All MIDI files processed and Parseq configurations generated successfully.")
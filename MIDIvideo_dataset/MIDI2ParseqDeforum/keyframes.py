@@ -0,0 +1,61 @@
+# Parseq "step" interpolation: a field holds its keyframe value until its next keyframe
+STEP_INTERPOLATION = "S"
+
+def _changed(value, previous):
+    # 0 and 0.0 compare equal but serialize differently, so a type change is a change too
+    return value != previous or type(value) is not type(previous)
+
+def sparse_keyframes(keyframes, fields):
+    # Keep each field only on the frames where its value changes
+    sparse = []
+    previous = {}
+    last_index = len(keyframes) - 1
+    for i, keyframe in enumerate(keyframes):
+        sparse_keyframe = {"frame": keyframe["frame"]}
+        for field in fields:
+            value = keyframe[field]
+            if i == 0 or _changed(value, previous[field]):
+                sparse_keyframe[field] = value
+                previous[field] = value
+        if i == 0:
+            for field in fields:
+                sparse_keyframe[f"{field}_i"] = STEP_INTERPOLATION
+        # The last frame is always kept so the manifest still spans the whole clip
+        if len(sparse_keyframe) > 1 or i == last_index:
+            sparse.append(sparse_keyframe)
+    return sparse
+
+def expand_keyframes(keyframes, fields, total_frames):
+    # Re-expand step-interpolated keyframes into one keyframe per frame
+    dense = []
+    current = {}
+    position = 0
+    for frame in range(total_frames):
+        while position < len(keyframes) and keyframes[position]["frame"] <= frame:
+            for field in fields:
+                if field in keyframes[position]:
+                    current[field] = keyframes[position][field]
+            position += 1
+        missing = [field for field in fields if field not in current]
+        if missing:
+            raise ValueError(f"No keyframe value for {', '.join(missing)} at frame {frame}")
+        dense.append({"frame": frame, **current})
+    return dense
+
+def change_points(keyframes, fields):
+    # Indices of the dense keyframes where any field changes, plus the first and last
+    last_index = len(keyframes) - 1
+    return [i for i, keyframe in enumerate(keyframes)
+            if i == 0 or i == last_index or any(_changed(keyframe[field], keyframes[i - 1][field]) for field in fields)]
+
+def is_sparse(keyframes, fields, total_frames):
+    return len(keyframes) != total_frames or any(field not in keyframe for keyframe in keyframes for field in fields)
+
+def verify_sparse_keyframes(sparse, dense, fields):
+    expanded = expand_keyframes(sparse, fields, len(dense))
+    for expanded_keyframe, keyframe in zip(expanded, dense):
+        for field in fields:
+            if _changed(expanded_keyframe[field], keyframe[field]):
+                raise AssertionError(
+                    f"Sparse keyframes give {field}={expanded_keyframe[field]!r} at frame {keyframe['frame']}, "
+                    f"expected {keyframe[field]!r}")
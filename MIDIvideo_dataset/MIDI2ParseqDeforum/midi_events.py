@@ -0,0 +1,192 @@
+import heapq
+from array import array
+
+import mido
+import numpy as np
+
+DEFAULT_TEMPO = 500000  # 120 BPM, until the file's first set_tempo
+CLIP_SECONDS = 16
+
+# Data bytes following each channel message status (high nibble)
+CHANNEL_MESSAGE_LENGTHS = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+SYSTEM_COMMON_LENGTHS = {0xF1: 1, 0xF2: 2, 0xF3: 1}
+
+def _read_variable_length(data, position):
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, position
+
+def _read_header(data):
+    if data[:4] != b'MThd':
+        raise ValueError("Not a standard MIDI file")
+    header_length = int.from_bytes(data[4:8], 'big')
+    track_count = int.from_bytes(data[10:12], 'big')
+    ticks_per_beat = int.from_bytes(data[12:14], 'big')
+    if ticks_per_beat & 0x8000:
+        raise ValueError("SMPTE time division is not supported")
+
+    tracks = []
+    position = 8 + header_length
+    while position + 8 <= len(data) and len(tracks) < track_count:
+        chunk_type = data[position:position + 4]
+        chunk_length = int.from_bytes(data[position + 4:position + 8], 'big')
+        start = position + 8
+        position = start + chunk_length
+        if chunk_type == b'MTrk':
+            tracks.append((start, min(position, len(data))))
+    return ticks_per_beat, tracks
+
+def _iter_track(data, start, end, track_index):
+    # Lazily decode one track into (absolute_tick, track_index, order, type, a, b, channel)
+    position = start
+    tick = 0
+    order = 0
+    running_status = None
+    while position < end:
+        delta, position = _read_variable_length(data, position)
+        tick += delta
+        order += 1
+        status = data[position]
+        if status < 0x80:
+            if running_status is None:
+                raise ValueError("Running status without a previous status byte")
+            status = running_status
+        else:
+            position += 1
+
+        if status == 0xFF:
+            meta_type = data[position]
+            length, position = _read_variable_length(data, position + 1)
+            payload = data[position:position + length]
+            position += length
+            if meta_type == 0x51 and length == 3:
+                yield tick, track_index, order, 'set_tempo', int.from_bytes(payload, 'big'), 0, 0
+            elif meta_type == 0x2F:
+                yield tick, track_index, order, 'end_of_track', 0, 0, 0
+                return
+        elif status in (0xF0, 0xF7):
+            length, position = _read_variable_length(data, position)
+            position += length
+        elif status >= 0xF0:
+            position += SYSTEM_COMMON_LENGTHS.get(status, 0)
+        else:
+            running_status = status
+            kind = status & 0xF0
+            length = CHANNEL_MESSAGE_LENGTHS[kind]
+            if kind in (0x80, 0x90):
+                message_type = 'note_on' if kind == 0x90 else 'note_off'
+                yield tick, track_index, order, message_type, data[position], data[position + 1], status & 0x0F
+            position += length
+    yield tick, track_index, order + 1, 'end_of_track', 0, 0, 0
+
+def iter_midi_events(midi_file_path):
+    # Yield (seconds, type, note, velocity, channel) for note and end_of_track events.
+    # Tracks are merged by absolute tick and timed with the file's tempo map; decoding
+    # is lazy, so stopping the iteration stops the parse.
+    with open(midi_file_path, 'rb') as file:
+        data = file.read()
+    ticks_per_beat, tracks = _read_header(data)
+
+    tempo = DEFAULT_TEMPO
+    tempo_tick = 0
+    tempo_seconds = 0.0
+    merged = heapq.merge(*(_iter_track(data, start, end, index) for index, (start, end) in enumerate(tracks)))
+    for tick, _, _, message_type, a, b, channel in merged:
+        if message_type == 'set_tempo':
+            tempo_seconds += mido.tick2second(tick - tempo_tick, ticks_per_beat, tempo)
+            tempo_tick = tick
+            tempo = a
+            continue
+        seconds = tempo_seconds + mido.tick2second(tick - tempo_tick, ticks_per_beat, tempo)
+        yield seconds, message_type, a, b, channel
+
+def new_event_table():
+    return {
+        "frame": array('i'),
+        "note": array('B'),
+        "velocity": array('B'),
+        "channel": array('B'),
+        "is_on": array('B'),
+    }
+
+def append_event(table, frame_index, message_type, note, velocity, channel):
+    table["frame"].append(frame_index)
+    table["note"].append(note)
+    table["velocity"].append(velocity)
+    table["channel"].append(channel)
+    table["is_on"].append(message_type == 'note_on')
+
+def finalize_event_table(table):
+    return {
+        "frame": np.frombuffer(table["frame"], dtype=np.int32),
+        "note": np.frombuffer(table["note"], dtype=np.uint8),
+        "velocity": np.frombuffer(table["velocity"], dtype=np.uint8),
+        "channel": np.frombuffer(table["channel"], dtype=np.uint8),
+        "is_on": np.frombuffer(table["is_on"], dtype=np.bool_),
+    }
+
+def midi_to_event_table(midi_file_path, fps, clip_seconds=CLIP_SECONDS):
+    # Columnar frame/note/velocity/channel/is_on arrays for the first clip_seconds, in time order
+    total_frames = int(clip_seconds * fps)
+    table = new_event_table()
+    for seconds, message_type, note, velocity, channel in iter_midi_events(midi_file_path):
+        frame_index = int(seconds * fps)
+        if frame_index >= total_frames:
+            break
+        if message_type != 'end_of_track':
+            append_event(table, frame_index, message_type, note, velocity, channel)
+    return finalize_event_table(table), total_frames
+
+def event_table_to_frame_events(table, total_frames):
+    # Compatibility shape: one list of mido messages per frame
+    frame_events = [[] for _ in range(total_frames)]
+    for frame_index, note, velocity, channel, is_on in zip(
+            table["frame"].tolist(), table["note"].tolist(), table["velocity"].tolist(),
+            table["channel"].tolist(), table["is_on"].tolist()):
+        message_type = 'note_on' if is_on else 'note_off'
+        frame_events[frame_index].append(mido.Message(message_type, note=note, velocity=velocity, channel=channel))
+    return frame_events
+
+def _window_table(pending, start_frame, window_frames):
+    table = new_event_table()
+    for frame_index, message_type, note, velocity, channel in pending:
+        if frame_index >= start_frame + window_frames:
+            break
+        if frame_index >= start_frame:
+            append_event(table, frame_index - start_frame, message_type, note, velocity, channel)
+    return finalize_event_table(table)
+
+def iter_midi_windows(midi_file_path, fps, window_seconds=CLIP_SECONDS, hop_seconds=None, keep_partial=False):
+    # One streaming pass over a long MIDI file, yielding (window_index, start_frame, table, total_frames)
+    # for every window_seconds window, hop_seconds apart, with frames rebased to the window start.
+    # The first window always comes out (like midi_to_event_table); later ones only if they fit
+    # in the file, unless keep_partial is set.
+    window_frames = int(window_seconds * fps)
+    hop_frames = int(round((hop_seconds or window_seconds) * fps))
+    if window_frames <= 0 or hop_frames <= 0:
+        raise ValueError("Window and hop must both be at least one frame")
+
+    pending = []
+    window_index = 0
+    last_frame = 0
+    for seconds, message_type, note, velocity, channel in iter_midi_events(midi_file_path):
+        frame_index = int(seconds * fps)
+        last_frame = max(last_frame, frame_index)
+        # An event past a window's end means that window has all its events
+        while frame_index >= window_index * hop_frames + window_frames:
+            start_frame = window_index * hop_frames
+            yield window_index, start_frame, _window_table(pending, start_frame, window_frames), window_frames
+            window_index += 1
+            next_start = window_index * hop_frames
+            pending = [event for event in pending if event[0] >= next_start]
+        if message_type != 'end_of_track':
+            pending.append((frame_index, message_type, note, velocity, channel))
+
+    while window_index == 0 or (keep_partial and window_index * hop_frames < last_frame):
+        start_frame = window_index * hop_frames
+        yield window_index, start_frame, _window_table(pending, start_frame, window_frames), window_frames
+        window_index += 1
@@ -1,44 +1,118 @@
 import json
 from datetime import datetime
 import uuid
+import numpy as np
+from keyframes import change_points, expand_keyframes, is_sparse
 
-def parseq_to_deforum(parseq_config):
-    def get_max_min_values(keyframes, field):
-        values = [kf[field] for kf in keyframes]
-        return max(values), min(values)
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-    with open(parseq_config, 'r') as file:
-        data = json.load(file)
+GENERATED_AT_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
 
-    keyframes = data['keyframes']
+def _random_uuid(rng):
+    # Draw ids from the sample's RNG when given, so seeded builds are reproducible
+    if rng is None:
+        return uuid.uuid4()
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+def render_frame_columns(keyframes, display_fields):
+    # Min/max, deltas and percentages for every display field at once, one column per field
+    columns = [[keyframe[field] for keyframe in keyframes] for field in display_fields]
+    values = np.array(columns, dtype=np.float64).reshape(len(display_fields), len(keyframes))
+    previous = np.zeros_like(values)
+    previous[:, 1:] = values[:, :-1]
+    deltas = values - previous
+    max_indices = values.argmax(axis=1).tolist()
+    min_indices = values.argmin(axis=1).tolist()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pcs = 100 * (values / values[np.arange(len(display_fields)), max_indices][:, None])
+
+    rendered_columns = {}
     rendered_frames_meta = {}
-    for field in data['displayFields']:
-        max_val, min_val = get_max_min_values(keyframes, field)
+    for k, field in enumerate(display_fields):
+        column = columns[k]
+        # argmax/argmin return the first extreme like max()/min(), so the original value is kept
+        max_val, min_val = column[max_indices[k]], column[min_indices[k]]
         rendered_frames_meta[field] = {"max": max_val, "min": min_val, "isFlat": max_val == min_val}
 
+        field_deltas = deltas[k].tolist()
+        # int - int stays an int in the row-by-row version (e.g. rotation_3d_z resets)
+        for i, value in enumerate(column):
+            if type(value) is int and type(column[i - 1] if i > 0 else 0) is int:
+                field_deltas[i] = value - (column[i - 1] if i > 0 else 0)
+        field_pcs = [0] * len(column) if max_val == 0 else pcs[k].tolist()
+        rendered_columns[field] = (column, field_deltas, field_pcs)
+
+    return rendered_columns, rendered_frames_meta
+
+def rendered_columns_to_rows(frames, deforum_prompt, rendered_columns):
     rendered_frames = []
-    for i, frame in enumerate(keyframes):
-        prev_frame = keyframes[i - 1] if i > 0 else {field: 0 for field in data['displayFields']}
-        rendered_frame = {
-            "frame": frame['frame'],
-            "deforum_prompt": f"{data['prompts']['positive']} --neg {data['prompts']['negative']}"
-        }
-        for field in data['displayFields']:
-            delta = frame[field] - prev_frame[field]
-            max_val = rendered_frames_meta[field]['max']
-            pc = 0 if max_val == 0 else 100 * (frame[field] / max_val)
-            rendered_frame[field] = frame[field]
-            rendered_frame[f"{field}_delta"] = delta
-            rendered_frame[f"{field}_pc"] = pc
+    for i, frame in enumerate(frames):
+        rendered_frame = {"frame": frame, "deforum_prompt": deforum_prompt}
+        for field, (values, deltas, pcs) in rendered_columns.items():
+            rendered_frame[field] = values[i]
+            rendered_frame[f"{field}_delta"] = deltas[i]
+            rendered_frame[f"{field}_pc"] = pcs[i]
         rendered_frames.append(rendered_frame)
+    return rendered_frames
+
+def rendered_columns_to_layout(frames, deforum_prompt, rendered_columns):
+    # Column-oriented rendered_frames: one list per key instead of one dict per frame
+    layout = {"frame": list(frames), "deforum_prompt": [deforum_prompt] * len(frames)}
+    for field, (values, deltas, pcs) in rendered_columns.items():
+        layout[field] = values
+        layout[f"{field}_delta"] = deltas
+        layout[f"{field}_pc"] = pcs
+    return layout
+
+def keep_rows(frames, rendered_columns, indices):
+    # Only the given frames of every column
+    kept_columns = {field: tuple([column[i] for i in indices] for column in columns)
+                    for field, columns in rendered_columns.items()}
+    return [frames[i] for i in indices], kept_columns
+
+def parseq_to_deforum(parseq_config, rng=None, generated_at=None, rendered_frames_layout='rows',
+                      sparse_rendered_frames=False):
+    # With sparse_rendered_frames, rendered_frames only has the frames where a value changes and
+    # the last frame; a row holds until the next one (with zero deltas), as step keyframes do
+    # Accept the config object itself, or a path to a saved Parseq config
+    if isinstance(parseq_config, dict):
+        data = parseq_config
+    else:
+        with open(parseq_config, 'r') as file:
+            data = json.load(file)
+
+    keyframes = data['keyframes']
+    # Sparse (change-point) keyframes are expanded back to one per frame for rendering
+    total_frames = data.get('total_frames', keyframes[-1]['frame'] + 1)
+    if is_sparse(keyframes, data['displayFields'], total_frames):
+        dense_keyframes = expand_keyframes(keyframes, data['displayFields'], total_frames)
+    else:
+        dense_keyframes = keyframes
+    rendered_columns, rendered_frames_meta = render_frame_columns(dense_keyframes, data['displayFields'])
+
+    # The prompt is the same for every frame, so build it once
+    deforum_prompt = f"{data['prompts']['positive']} --neg {data['prompts']['negative']}"
+    frames = [keyframe['frame'] for keyframe in dense_keyframes]
+    if sparse_rendered_frames:
+        frames, rendered_columns = keep_rows(frames, rendered_columns,
+                                             change_points(dense_keyframes, data['displayFields']))
+    if rendered_frames_layout == 'rows':
+        rendered_frames = rendered_columns_to_rows(frames, deforum_prompt, rendered_columns)
+    elif rendered_frames_layout == 'columns':
+        rendered_frames = rendered_columns_to_layout(frames, deforum_prompt, rendered_columns)
+    else:
+        raise ValueError(f"Unknown rendered_frames layout: {rendered_frames_layout}")
 
     result = {
         "meta": {
             "generated_by": "sd_parseq",
             "version": "0.1.112",
-            "generated_at": datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT"),
-            "doc_id": f"doc-{uuid.uuid4()}",
-            "version_id": f"version-{uuid.uuid4()}"
+            "generated_at": generated_at or datetime.utcnow().strftime(GENERATED_AT_FORMAT),
+            "doc_id": f"doc-{_random_uuid(rng)}",
+            "version_id": f"version-{_random_uuid(rng)}"
         },
         "prompts": {
             "format": "v2",
@@ -93,10 +167,23 @@ def parseq_to_deforum(parseq_config):
 
     return result
 
-def save_converted_config(input_file, output_file):
-    converted_config = parseq_to_deforum(input_file)
-    with open(output_file, 'w') as file:
-        json.dump(converted_config, file, indent=4)
+def dump_json(obj, output_file, compact=False):
+    # Compact output skips indentation and uses orjson when it is installed; returns bytes written
+    if not compact:
+        data = json.dumps(obj, indent=4).encode('utf-8')
+    elif orjson is not None:
+        data = orjson.dumps(obj)
+    else:
+        data = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    with open(output_file, 'wb') as file:
+        file.write(data)
+    return len(data)
+
+def save_converted_config(input_file, output_file, rng=None, generated_at=None, compact=False, rendered_frames_layout='rows',
+                          sparse_rendered_frames=False):
+    converted_config = parseq_to_deforum(input_file, rng=rng, generated_at=generated_at, rendered_frames_layout=rendered_frames_layout,
+                                         sparse_rendered_frames=sparse_rendered_frames)
+    return dump_json(converted_config, output_file, compact=compact)
 
 # Example usage:
 # input_file = '/Users/dieny/Desktop/Parseq_Rendered/parseq_config_1.json'
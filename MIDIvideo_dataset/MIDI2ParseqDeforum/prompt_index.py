@@ -0,0 +1,83 @@
+import json
+import os
+import random
+
+# Stored next to the prompts directory, so writing it does not touch the mtimes it records
+PROMPT_INDEX_SUFFIX = '.index.json'
+
+# Indexes already loaded by this process, keyed by prompts directory
+_loaded_indexes = {}
+
+def _directory_mtimes(prompts_directory, themes):
+    return {theme: os.stat(os.path.join(prompts_directory, theme)).st_mtime_ns for theme in themes}
+
+def build_prompt_index(prompts_directory):
+    themes = {}
+    theme_mtimes = {}
+    for theme in sorted(os.listdir(prompts_directory)):
+        theme_directory = os.path.join(prompts_directory, theme)
+        if not os.path.isdir(theme_directory):
+            continue
+        theme_mtimes[theme] = os.stat(theme_directory).st_mtime_ns
+        prompts = []
+        for prompt_file in sorted(os.listdir(theme_directory)):
+            if prompt_file.startswith('prompt_'):
+                with open(os.path.join(theme_directory, prompt_file), 'r') as file:
+                    prompts.append(file.read().strip())
+        if prompts:
+            themes[theme] = prompts
+
+    return {
+        "root_mtime": os.stat(prompts_directory).st_mtime_ns,
+        "theme_mtimes": theme_mtimes,
+        "themes": themes
+    }
+
+def _is_fresh(index, prompts_directory):
+    # Adding/removing a theme or prompt file changes a directory mtime
+    try:
+        return (index["root_mtime"] == os.stat(prompts_directory).st_mtime_ns
+                and index["theme_mtimes"] == _directory_mtimes(prompts_directory, index["theme_mtimes"]))
+    except (OSError, KeyError):
+        return False
+
+def _write_index(index, index_path):
+    temporary_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, 'w') as file:
+            json.dump(index, file)
+        os.replace(temporary_path, index_path)
+    except OSError:
+        # An unwritable location still gets an in-memory index
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def load_prompt_index(prompts_directory, index_path=None, refresh=False):
+    if not refresh and prompts_directory in _loaded_indexes:
+        return _loaded_indexes[prompts_directory]
+
+    if index_path is None:
+        index_path = os.path.normpath(prompts_directory) + PROMPT_INDEX_SUFFIX
+
+    index = None
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as file:
+            index = json.load(file)
+        if not _is_fresh(index, prompts_directory):
+            index = None
+
+    if index is None:
+        index = build_prompt_index(prompts_directory)
+        _write_index(index, index_path)
+
+    _loaded_indexes[prompts_directory] = index
+    return index
+
+def sample_prompt(index, rng=random, theme_weights=None):
+    # Same two-level draw as before: a theme first, then one of its prompts
+    themes = list(index["themes"])
+    if theme_weights:
+        selected_theme = rng.choices(themes, weights=[theme_weights.get(theme, 1.0) for theme in themes])[0]
+    else:
+        selected_theme = rng.choice(themes)
+    return rng.choice(index["themes"][selected_theme])
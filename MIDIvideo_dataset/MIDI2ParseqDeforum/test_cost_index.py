@@ -0,0 +1,61 @@
+import json
+import os
+import random
+import pytest
+from dataset_creation import process_all_midi_files
+from test_parameter_curves import write_random_midi
+import dataset_layout
+from job_cost import estimate_works, load_cost_index, lpt_order
+
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "video_generation",
+                             "new_deforum_settings.txt")
+
+def reference_work(config, settings):
+    # Sampling steps of every frame, straight from the strength curve of the written manifest
+    with open(config, 'r') as config_file:
+        rendered_frames = json.load(config_file)["rendered_frames"]
+    steps = settings.get("steps", 15)
+    work = steps
+    for frame in rendered_frames[1:]:
+        strength = frame.get("strength", settings.get("strength", 0.8))
+        work += max(1.0, steps * (1 - strength))
+    return work * settings.get("W", 512) * settings.get("H", 512) / (512 * 512)
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    # Random drum files cut to the default 16 s clip: every config renders the same number of frames
+    midi_folder = tmp_path_factory.mktemp("midi")
+    for index in range(20):
+        write_random_midi(str(midi_folder / f"random_{index}.mid"), random.Random(index))
+    prompts = tmp_path_factory.mktemp("prompts")
+    (prompts / "theme").mkdir()
+    (prompts / "theme" / "prompt_1.txt").write_text("a prompt")
+    dataset_path = str(tmp_path_factory.mktemp("dataset"))
+    failures = process_all_midi_files(str(midi_folder), str(prompts), dataset_path, variants=2, remap_notes=True)
+    assert not failures
+    return dataset_path
+
+def test_cost_index_orders_by_strength_curves(dataset):
+    with open(SETTINGS_PATH, 'r') as settings_file:
+        settings = json.load(settings_file)
+    cost_index = load_cost_index(dataset)
+    indices = sorted(cost_index)
+    assert len(indices) == 40
+    configs = [dataset_layout.config_path(dataset, index) for index in indices]
+    expected = {config: reference_work(config, settings) for config in configs}
+    # Same frame count everywhere, so only the strength curves tell the configs apart
+    assert len(set(expected.values())) > 1
+
+    works = estimate_works(configs, indices, settings, cost_index)
+    assert works == pytest.approx([expected[config] for config in configs])
+    ordered, _ = lpt_order(configs, works)
+    ordered_works = [expected[config] for config in ordered]
+    assert all(a >= b - 1e-9 for a, b in zip(ordered_works, ordered_works[1:]))
+
+def test_configs_missing_from_the_index_are_parsed(dataset):
+    with open(SETTINGS_PATH, 'r') as settings_file:
+        settings = json.load(settings_file)
+    indices = sorted(load_cost_index(dataset))
+    configs = [dataset_layout.config_path(dataset, index) for index in indices]
+    works = estimate_works(configs, indices, settings, {})
+    assert works == pytest.approx([reference_work(config, settings) for config in configs])
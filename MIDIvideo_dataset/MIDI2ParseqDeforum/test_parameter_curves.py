@@ -0,0 +1,126 @@
+import json
+import random
+import mido
+import pytest
+from MIDI_to_parseq import (midi_to_frame_events, midi_to_parseq_config, set_rotation_frames, set_rotation_z_frames,
+                            set_strength_frames, set_translation_z_frames, NEGATIVE_PROMPT)
+from midi_events import midi_to_event_table
+
+FPS = 24
+NOTES = {"rotation_3d_x_note": 46, "rotation_3d_y_note": 44, "strength_note": 36, "translation_z_note": 38,
+         "rotation_3d_z_note": 42}
+
+def write_random_midi(path, rng, beats=40):
+    # Drum hits on the mapped notes and a few others, some off channel 10, often several per frame
+    events = []
+    for _ in range(rng.randint(0, 12 * beats)):
+        tick = rng.randint(0, beats * 480)
+        note = rng.choice([36, 38, 42, 44, 46, 36, 42, 49, 51])
+        channel = 9 if rng.random() < 0.9 else rng.randint(0, 8)
+        events.append((tick, mido.Message('note_on', note=note, velocity=rng.randint(1, 127), channel=channel)))
+        events.append((tick + rng.randint(1, 240), mido.Message('note_off', note=note, velocity=0, channel=channel)))
+    track = mido.MidiTrack()
+    if rng.random() < 0.5:
+        track.append(mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(rng.uniform(90, 140))))
+    previous = 0
+    for tick, message in sorted(events, key=lambda event: event[0]):
+        track.append(message.copy(time=tick - previous))
+        previous = tick
+    midi_file = mido.MidiFile(type=0, ticks_per_beat=480)
+    midi_file.tracks.append(track)
+    midi_file.save(path)
+
+def reference_parseq_config(frame_events, total_frames, fps, positive_prompt, rotation_3d_x_note=None,
+                            rotation_3d_y_note=None, strength_note=None, translation_z_note=None,
+                            rotation_3d_z_note=None, strength_default=0.8, strength_kick=0.3, kick_duration_seconds=0.1):
+    # The per-frame loop implementation the curve engine replaced
+    parseq_config = {
+        "meta": {"docName": "MIDI to Parseq"},
+        "prompts": {"positive": positive_prompt, "negative": NEGATIVE_PROMPT},
+        "options": {"input_fps": "", "bpm": 120, "output_fps": 24, "cc_window_width": 0,
+                    "cc_window_slide_rate": 1, "cc_use_input": False},
+        "displayFields": [],
+        "keyframes": []
+    }
+    rotation_3d_x_values = [0.0] * total_frames
+    rotation_3d_y_values = [0.0] * total_frames
+    rotation_3d_z_values = [0.0] * total_frames
+    translation_z_values = [1.0] * total_frames
+    strength_values = [strength_default] * total_frames
+    if rotation_3d_x_note:
+        set_rotation_frames(rotation_3d_x_values, frame_events, total_frames, rotation_3d_x_note)
+        parseq_config["displayFields"].append("rotation_3d_x")
+    if rotation_3d_y_note:
+        set_rotation_frames(rotation_3d_y_values, frame_events, total_frames, rotation_3d_y_note)
+        parseq_config["displayFields"].append("rotation_3d_y")
+    if rotation_3d_z_note:
+        set_rotation_z_frames(rotation_3d_z_values, frame_events, total_frames, rotation_3d_z_note)
+        parseq_config["displayFields"].append("rotation_3d_z")
+    if strength_note:
+        set_strength_frames(strength_values, frame_events, total_frames, fps, strength_note, strength_kick,
+                            strength_default, kick_duration_seconds)
+        parseq_config["displayFields"].append("strength")
+    if translation_z_note:
+        set_translation_z_frames(translation_z_values, frame_events, total_frames, translation_z_note)
+        parseq_config["displayFields"].append("translation_z")
+    for i in range(total_frames):
+        keyframe = {"frame": i}
+        if rotation_3d_x_note:
+            keyframe["rotation_3d_x"] = rotation_3d_x_values[i]
+        if rotation_3d_y_note:
+            keyframe["rotation_3d_y"] = rotation_3d_y_values[i]
+        if rotation_3d_z_note:
+            keyframe["rotation_3d_z"] = rotation_3d_z_values[i]
+        if translation_z_note:
+            keyframe["translation_z"] = translation_z_values[i]
+        if strength_note:
+            keyframe["strength"] = strength_values[i]
+        parseq_config["keyframes"].append(keyframe)
+    parseq_config["total_frames"] = total_frames
+    return parseq_config
+
+def first_difference(config, expected):
+    # A short report instead of a diff of two full configs
+    for key in expected:
+        if key != "keyframes" and json.dumps(config.get(key)) != json.dumps(expected[key]):
+            return f"{key}: {config.get(key)} != {expected[key]}"
+    for keyframe, expected_keyframe in zip(config["keyframes"], expected["keyframes"]):
+        if json.dumps(keyframe) != json.dumps(expected_keyframe):
+            return f"keyframe {keyframe} != {expected_keyframe}"
+    return "key order or keyframe count differs"
+
+@pytest.fixture(scope="module")
+def prompts_directory(tmp_path_factory):
+    prompts = tmp_path_factory.mktemp("prompts")
+    (prompts / "theme").mkdir()
+    (prompts / "theme" / "prompt_1.txt").write_text("a prompt")
+    return str(prompts)
+
+@pytest.fixture(scope="module")
+def midi_corpus(tmp_path_factory):
+    corpus = tmp_path_factory.mktemp("midi")
+    paths = []
+    for index in range(40):
+        path = str(corpus / f"random_{index}.mid")
+        write_random_midi(path, random.Random(index))
+        paths.append(path)
+    return paths
+
+@pytest.mark.parametrize("case", range(4))
+def test_curves_match_reference_loops(midi_corpus, prompts_directory, case):
+    rng = random.Random(case)
+    for path in midi_corpus:
+        # A random subset of the parameters and random strength settings
+        notes = {name: note for name, note in NOTES.items() if case == 0 or rng.random() < 0.7}
+        options = {"strength_default": rng.uniform(0.8, 0.9), "strength_kick": rng.uniform(0.25, 0.5),
+                   "kick_duration_seconds": rng.uniform(0.05, 0.15)}
+        frame_events, total_frames = midi_to_frame_events(path, FPS)
+        event_table, _ = midi_to_event_table(path, FPS)
+
+        for events in (frame_events, event_table):
+            config = midi_to_parseq_config(events, total_frames, FPS, prompts_directory=prompts_directory,
+                                           **notes, **options)
+            expected = reference_parseq_config(frame_events, total_frames, FPS, config["prompts"]["positive"],
+                                               **notes, **options)
+            if json.dumps(config) != json.dumps(expected):
+                pytest.fail(f"{path}: {first_difference(config, expected)}")
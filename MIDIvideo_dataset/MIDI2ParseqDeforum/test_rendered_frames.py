@@ -0,0 +1,107 @@
+import json
+import random
+import pytest
+from dataset_creation import clip_configs
+from MIDI_to_parseq import midi_to_parseq_config
+from midi_events import midi_to_event_table
+from parseq_to_rendered import parseq_to_deforum
+from test_parameter_curves import FPS, NOTES, write_random_midi
+from job_cost import strength_profile
+from manifest_prefetch import expand_rendered_frames
+
+def reference_rendered_frames(data):
+    # The per-frame renderer parseq_to_deforum replaced: (rendered_frames, rendered_frames_meta)
+    keyframes = data['keyframes']
+    rendered_frames_meta = {}
+    for field in data['displayFields']:
+        values = [kf[field] for kf in keyframes]
+        max_val, min_val = max(values), min(values)
+        rendered_frames_meta[field] = {"max": max_val, "min": min_val, "isFlat": max_val == min_val}
+
+    rendered_frames = []
+    for i, frame in enumerate(keyframes):
+        prev_frame = keyframes[i - 1] if i > 0 else {field: 0 for field in data['displayFields']}
+        rendered_frame = {
+            "frame": frame['frame'],
+            "deforum_prompt": f"{data['prompts']['positive']} --neg {data['prompts']['negative']}"
+        }
+        for field in data['displayFields']:
+            delta = frame[field] - prev_frame[field]
+            max_val = rendered_frames_meta[field]['max']
+            pc = 0 if max_val == 0 else 100 * (frame[field] / max_val)
+            rendered_frame[field] = frame[field]
+            rendered_frame[f"{field}_delta"] = delta
+            rendered_frame[f"{field}_pc"] = pc
+        rendered_frames.append(rendered_frame)
+
+    if 'strength' in rendered_frames_meta:
+        rendered_frames_meta['strength']['max'] = round(rendered_frames_meta['strength']['max'], 14)
+        rendered_frames_meta['strength']['min'] = round(rendered_frames_meta['strength']['min'], 14)
+    return rendered_frames, rendered_frames_meta
+
+def columns_to_rows(layout):
+    keys = list(layout)
+    return [{key: layout[key][i] for key in keys} for i in range(len(layout["frame"]))]
+
+def first_difference(rows, expected_rows):
+    # A short report instead of a diff of two full frame lists
+    for row, expected_row in zip(rows, expected_rows):
+        if json.dumps(row) != json.dumps(expected_row):
+            return f"{row} != {expected_row}"
+    return f"{len(rows)} rows != {len(expected_rows)} rows"
+
+@pytest.fixture(scope="module")
+def parseq_configs(tmp_path_factory):
+    # Parseq configs of random drum files, with random parameter subsets and strength settings
+    prompts = tmp_path_factory.mktemp("prompts")
+    (prompts / "theme").mkdir()
+    (prompts / "theme" / "prompt_1.txt").write_text("a prompt")
+    corpus = tmp_path_factory.mktemp("midi")
+    configs = []
+    for index in range(40):
+        rng = random.Random(index)
+        path = str(corpus / f"random_{index}.mid")
+        write_random_midi(path, rng)
+        notes = {name: note for name, note in NOTES.items() if index % 4 == 0 or rng.random() < 0.7}
+        event_table, total_frames = midi_to_event_table(path, FPS)
+        configs.append(midi_to_parseq_config(event_table, total_frames, FPS, prompts_directory=str(prompts), rng=rng,
+                                             strength_kick=rng.uniform(0.25, 0.5), **notes))
+    return configs
+
+def test_rows_match_reference_renderer(parseq_configs):
+    for index, parseq_config in enumerate(parseq_configs):
+        rendered = parseq_to_deforum(parseq_config, rng=random.Random(index))
+        expected_rows, expected_meta = reference_rendered_frames(parseq_config)
+        if json.dumps(rendered["rendered_frames"]) != json.dumps(expected_rows):
+            pytest.fail(f"config {index}: {first_difference(rendered['rendered_frames'], expected_rows)}")
+        assert json.dumps(rendered["rendered_frames_meta"]) == json.dumps(expected_meta), f"config {index}"
+
+def test_columns_convert_back_to_rows(parseq_configs):
+    for index, parseq_config in enumerate(parseq_configs):
+        rows = parseq_to_deforum(parseq_config, rng=random.Random(index))
+        columns = parseq_to_deforum(parseq_config, rng=random.Random(index), rendered_frames_layout='columns')
+        converted = columns_to_rows(columns["rendered_frames"])
+        if json.dumps(converted) != json.dumps(rows["rendered_frames"]):
+            pytest.fail(f"config {index}: {first_difference(converted, rows['rendered_frames'])}")
+        # Everything but the layout of rendered_frames is the same
+        columns["rendered_frames"] = rows["rendered_frames"]
+        assert json.dumps(columns) == json.dumps(rows), f"config {index}"
+
+def test_sparse_rows_expand_to_dense_rows(tmp_path):
+    (tmp_path / "theme").mkdir()
+    (tmp_path / "theme" / "prompt_1.txt").write_text("a prompt")
+    for index in range(20):
+        path = str(tmp_path / f"random_{index}.mid")
+        write_random_midi(path, random.Random(index))
+        event_table, total_frames = midi_to_event_table(path, FPS)
+        options = {"fps": FPS, "seed": index, "generated_at": "now", "variants": 2, "remap_notes": True}
+        dense = [rendered for _, _, rendered in clip_configs(event_table, total_frames, str(tmp_path), **options)]
+        sparse = [rendered for _, _, rendered in clip_configs(event_table, total_frames, str(tmp_path),
+                                                              sparse_keyframes=True, **options)]
+        for dense_config, sparse_config in zip(dense, sparse):
+            rows, dense_rows = sparse_config["rendered_frames"], dense_config["rendered_frames"]
+            expanded = expand_rendered_frames(rows)
+            if json.dumps(expanded) != json.dumps(dense_rows):
+                pytest.fail(f"file {index}: {first_difference(expanded, dense_rows)}")
+            # The cost model weighs each sparse row by the frames it holds
+            assert strength_profile(sparse_config) == strength_profile(dense_config), f"file {index}"
@@ -0,0 +1,217 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from queue import Queue
+from threading import Thread
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "MIDI2ParseqDeforum"), os.path.join(HERE, "video_generation")]
+
+from build_cache import assign_sample_ids, check_clips_per_file, load_sample_ids, save_sample_ids
+from dataset_creation import (MAX_WINDOWS, build_generated_at, clip_configs, clips_per_file, derive_file_seed,
+                              is_midi_file, iter_midi_clips)
+from midi_events import CLIP_SECONDS
+from prompt_index import load_prompt_index
+import dataset_layout
+import main_video_generation as render
+from manifest_prefetch import expand_rendered_frames, serialize_request
+
+
+def link_or_copy(source, target):
+    # A hard link costs no data; fall back to a copy across filesystems
+    if os.path.exists(target):
+        return
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy(source, target)
+
+
+def file_samples(midi_file_path, sample_id, file_seed, done, options):
+    # (index, serialized manifest) of every clip of a MIDI file not rendered yet
+    file_clips = clips_per_file(options["variants"], options["window_hop_seconds"], options["max_windows"])
+    clips = iter_midi_clips(midi_file_path, options["fps"], file_seed, options["clip_seconds"],
+                            options["window_hop_seconds"], options["keep_partial_windows"])
+    for window_index, (_, event_table, total_frames, clip_seed) in enumerate(clips):
+        if window_index == options["max_windows"]:
+            print(f"{midi_file_path}: windows past the first {options['max_windows']} are dropped")
+            break
+        configs = clip_configs(event_table, total_frames, options["prompts_directory"], fps=options["fps"],
+                               seed=clip_seed, generated_at=options["generated_at"],
+                               theme_weights=options["theme_weights"], variants=options["variants"],
+                               remap_notes=options["remap_notes"], sparse_keyframes=options["sparse_keyframes"])
+        for variant_index, (_, _, rendered_config) in enumerate(configs):
+            index = dataset_layout.sample_index(sample_id, window_index * options["variants"] + variant_index,
+                                                file_clips)
+            if index in done:
+                continue
+            manifest = json.dumps(rendered_config)
+            # The dataset directory always gets the MIDI file (copied next to the video once rendered)
+            # and, as an optional side output, the manifest in the layout main_video_generation.py reads
+            os.makedirs(dataset_layout.sample_dir(options["dataset_dir"], index), exist_ok=True)
+            link_or_copy(midi_file_path, dataset_layout.midi_path(options["dataset_dir"], index))
+            if options["persist_configs"]:
+                with open(dataset_layout.config_path(options["dataset_dir"], index), 'w') as config_file:
+                    config_file.write(manifest)
+            if options["sparse_keyframes"]:
+                # Deforum renders from one row per frame
+                rendered_config["rendered_frames"] = expand_rendered_frames(rendered_config["rendered_frames"])
+                manifest = json.dumps(rendered_config)
+            yield index, manifest
+
+
+def produce(task_queue, sample_queue, options):
+    # Producer process: MIDI files in, samples out through the bounded queue, then a None
+    task = task_queue.get()
+    while task is not None:
+        midi_file_path, sample_id, file_seed, done = task
+        try:
+            for sample in file_samples(midi_file_path, sample_id, file_seed, done, options):
+                sample_queue.put(sample)
+        except Exception as e:
+            print(f"Failed {midi_file_path}: {type(e).__name__}: {e}")
+        task = task_queue.get()
+    sample_queue.put(None)
+
+
+def start_producers(args, sample_ids, file_clips, ledger, options):
+    task_queue = multiprocessing.Queue()
+    sample_queue = multiprocessing.Queue(maxsize=args.queue_size)
+    for midi_file, sample_id in sorted(sample_ids.items(), key=lambda item: item[1]):
+        midi_file_path = os.path.join(args.midi_folder, midi_file)
+        if not os.path.exists(midi_file_path):
+            continue
+        indices = range(dataset_layout.sample_index(sample_id, 0, file_clips),
+                        dataset_layout.sample_index(sample_id + 1, 0, file_clips))
+        done = set(index for index in indices if ledger is not None and ledger.is_done(index))
+        task_queue.put((midi_file_path, sample_id, derive_file_seed(args.seed, midi_file), done))
+
+    producers = []
+    for _ in range(args.processes):
+        task_queue.put(None)
+        process = multiprocessing.Process(target=produce, args=(task_queue, sample_queue, options), daemon=True)
+        process.start()
+        producers.append(process)
+    return producers, sample_queue
+
+
+def dispatch(args, sample_queue, producer_count, live_workers, ledger, telemetry):
+    # Turn produced samples into ready-to-send requests for the GPU workers, in arrival order
+    started = time.time()
+    job = 0
+    finished = 0
+    while finished < producer_count:
+        sample = sample_queue.get()
+        if sample is None:
+            finished += 1
+            continue
+        index, manifest = sample
+        if ledger is not None and ledger.is_done(index):
+            continue
+        name = dataset_layout.batch_name(index)
+        # Serialized here, off the GPU workers' path
+        payload = serialize_request(render.request_payload([render.manifest_settings(manifest, name, args)]))
+        if telemetry is not None:
+            telemetry.mark([name], "queued")
+        live_workers.put((job, [dataset_layout.config_path(args.dataset_path, index)], payload))
+        if job == 0:
+            print(f"First config queued for rendering after {time.time() - started:.1f} s")
+        job += 1
+    return job
+
+
+def main(args):
+    # Sample ids are kept across runs next to the streamed dataset, as in dataset_creation.py
+    os.makedirs(args.dataset_path, exist_ok=True)
+    file_clips = clips_per_file(args.variants, args.window_hop_seconds, args.max_windows)
+    try:
+        # A rerun with other --variants or --max_windows would give every sample a new index
+        check_clips_per_file(file_clips, args.dataset_path)
+    except ValueError as e:
+        sys.exit(f"Cannot resume in {args.dataset_path}: {e}")
+    sample_ids = assign_sample_ids(load_sample_ids(args.dataset_path), os.listdir(args.midi_folder), is_midi_file)
+    save_sample_ids(sample_ids, args.dataset_path)
+    args.count = max(sample_ids.values(), default=0) * file_clips
+
+    theme_weights = None
+    if args.theme_weights:
+        with open(args.theme_weights, 'r') as f:
+            theme_weights = json.load(f)
+    # Scan the prompts once; producers reload the saved index
+    load_prompt_index(args.prompts_directory, refresh=True)
+    options = {"dataset_dir": args.dataset_path, "prompts_directory": args.prompts_directory, "fps": args.fps,
+               "clip_seconds": args.clip_seconds, "window_hop_seconds": args.window_hop_seconds,
+               "keep_partial_windows": args.keep_partial_windows, "max_windows": args.max_windows,
+               "variants": args.variants, "remap_notes": args.remap_notes, "theme_weights": theme_weights,
+               "generated_at": build_generated_at(), "persist_configs": args.persist_configs,
+               "sparse_keyframes": args.sparse_keyframes}
+
+    ledger = render.open_ledger(args)
+    # Producers are forked before any thread is started
+    producers, sample_queue = start_producers(args, sample_ids, file_clips, ledger, options)
+
+    ports, local_world_size = render.get_ports(args)
+    supervisor = render.start_backends(args, ports, external=bool(args.backend_ports))
+    telemetry = render.open_telemetry(args)
+    packer = render.open_packer(args)
+    try:
+        render.pack_leftovers(args, ledger, packer)
+        task_queue = Queue(maxsize=local_world_size)
+        live_workers = render.LiveWorkers(task_queue, local_world_size, telemetry)
+        workers = []
+        for gpu_id in range(local_world_size):
+            thread = Thread(target=render.worker,
+                            args=(gpu_id, ports, task_queue, args, ledger, supervisor, None, telemetry, packer, None,
+                                  live_workers))
+            thread.start()
+            workers.append(thread)
+
+        jobs = dispatch(args, sample_queue, len(producers), live_workers, ledger, telemetry)
+        if not live_workers.join():
+            for process in producers:
+                process.join()
+            sys.exit(1)
+        print(f"{jobs} configs rendered")
+
+        for _ in range(local_world_size):
+            task_queue.put(None)
+        for thread in workers:
+            thread.join()
+        for process in producers:
+            process.join()
+    finally:
+        render.close_render_stage(supervisor, telemetry, packer)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate Parseq configs from a MIDI folder and render them as they are produced, "
+                    "without writing the config dataset first")
+    parser.add_argument("--midi_folder", type=str, required=True, help="Folder of MIDI files")
+    parser.add_argument("--prompts_directory", type=str, required=True, help="Folder of prompt themes")
+    parser.add_argument("--dataset_path", type=str, required=True,
+                        help="Streamed dataset directory: sample ids, MIDI files and, with --persist_configs, the configs")
+    parser.add_argument("--persist_configs", action="store_true",
+                        help="Also write each config as <dataset_path>/midi_parseq_<n>/parseq_<n>.json")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("SLURM_CPUS_PER_TASK", os.cpu_count() or 1)) // 2 or 1,
+                        help="Config producer processes")
+    parser.add_argument("--queue_size", type=int, default=64, help="Produced configs buffered ahead of the GPUs")
+    parser.add_argument("--fps", type=int, default=24, help="Frames per second of the generated configs")
+    parser.add_argument("--seed", type=int, default=0, help="Master seed; each file gets its own seed derived from it")
+    parser.add_argument("--theme_weights", type=str, help="JSON file mapping prompt theme names to sampling weights")
+    parser.add_argument("--variants", type=int, default=1, help="Configs generated per clip")
+    parser.add_argument("--remap_notes", action="store_true", help="Shuffle the note-to-parameter mapping of each variant")
+    parser.add_argument("--sparse_keyframes", action="store_true",
+                        help="Keep only change-point keyframes (and rendered_frames rows in persisted configs)")
+    parser.add_argument("--clip_seconds", type=float, default=CLIP_SECONDS, help="Length of each clip in seconds")
+    parser.add_argument("--window_hop_seconds", type=float, help="Cut every clip_seconds window of each file, this many seconds apart")
+    parser.add_argument("--keep_partial_windows", action="store_true", help="Also keep windows running past the end of the file")
+    parser.add_argument("--max_windows", type=int, default=MAX_WINDOWS, help="Windows kept per file with --window_hop_seconds")
+    render.add_render_arguments(parser)
+    parsed_args = parser.parse_args()
+    render.check_render_arguments(parser, parsed_args)
+    main(parsed_args)
@@ -0,0 +1,191 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+class BackendSupervisor:
+    """Runs one render backend per GPU as a child process and keeps it serving.
+
+    Readiness is probed over HTTP with exponential backoff after every launch. A backend whose
+    process exits, or that stops answering once ready, is restarted (up to max_restarts times).
+    Workers wait on wait_ready() and use generation() to tell that the backend they submitted
+    to has been restarted since, and resubmit their in-flight configs. A None command means a
+    backend started elsewhere: it is probed the same way but never launched or restarted.
+    """
+
+    def __init__(self, commands, ports, env=None, probe_path="/deforum_api/jobs", ready_timeout=1800,
+                 max_restarts=5, health_interval=30, health_failures=3, metrics_path=None, log_dir=None):
+        self.commands = commands
+        self.ports = ports
+        self.env = env
+        self.probe_path = probe_path
+        self.ready_timeout = ready_timeout
+        self.max_restarts = max_restarts
+        self.health_interval = health_interval
+        self.health_failures = health_failures
+        self.metrics_path = metrics_path
+        self.log_dir = log_dir
+
+        count = len(commands)
+        self.processes = [None] * count
+        self.launched_at = [0.0] * count
+        self.next_probe_at = [0.0] * count
+        self.probe_delay = [1.0] * count
+        self.failed_probes = [0] * count
+        self.restarts = [0] * count
+        self.generations = [0] * count
+        self.ready = [threading.Event() for _ in range(count)]
+        self.given_up = [False] * count
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+
+    def start(self):
+        for gpu_id in range(len(self.commands)):
+            self._launch(gpu_id)
+        self.monitor.start()
+
+    def _launch(self, gpu_id):
+        self.launched_at[gpu_id] = time.time()
+        self.next_probe_at[gpu_id] = time.time()
+        self.probe_delay[gpu_id] = 1.0
+        self.failed_probes[gpu_id] = 0
+        if self.commands[gpu_id] is None:
+            return
+        output = subprocess.DEVNULL
+        if self.log_dir is not None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            output = open(os.path.join(self.log_dir, f"backend_{gpu_id}.log"), 'ab')
+        # Own process group, so stopping the backend also stops anything it started
+        self.processes[gpu_id] = subprocess.Popen(self.commands[gpu_id], env=self.env, stdout=output,
+                                                  stderr=subprocess.STDOUT, start_new_session=True)
+        if output is not subprocess.DEVNULL:
+            output.close()
+
+    def _probe(self, gpu_id):
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.ports[gpu_id]}{self.probe_path}", timeout=5) as response:
+                return response.status == 200
+        except (urllib.error.URLError, OSError):
+            return False
+
+    def _kill(self, gpu_id):
+        process = self.processes[gpu_id]
+        if process is not None and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+            except ProcessLookupError:
+                pass
+
+    def _record_startup(self, gpu_id, startup_seconds):
+        print(f"Backend {gpu_id} on port {self.ports[gpu_id]} ready after {startup_seconds:.1f} s")
+        if self.metrics_path is None:
+            return
+        record = {"event": "backend_ready", "host": socket.gethostname(), "gpu": gpu_id, "port": self.ports[gpu_id],
+                  "restart": self.restarts[gpu_id], "launched_at": self.launched_at[gpu_id],
+                  "startup_seconds": startup_seconds}
+        os.makedirs(os.path.dirname(self.metrics_path) or ".", exist_ok=True)
+        with open(self.metrics_path, 'a') as metrics_file:
+            metrics_file.write(json.dumps(record) + "\n")
+
+    def _restart(self, gpu_id, reason):
+        with self.condition:
+            self.ready[gpu_id].clear()
+            self.generations[gpu_id] += 1
+        if self.commands[gpu_id] is None:
+            # Not ours to restart: wait for it to answer again
+            print(f"Backend {gpu_id} {reason}; waiting for it to come back")
+            self._launch(gpu_id)
+            return
+        self._kill(gpu_id)
+        if self.restarts[gpu_id] >= self.max_restarts:
+            print(f"Backend {gpu_id} {reason}; out of restarts, leaving GPU {gpu_id} idle")
+            with self.condition:
+                self.given_up[gpu_id] = True
+                self.condition.notify_all()
+            return
+        self.restarts[gpu_id] += 1
+        print(f"Backend {gpu_id} {reason}; restarting ({self.restarts[gpu_id]}/{self.max_restarts})")
+        self._launch(gpu_id)
+
+    def _check(self, gpu_id, now):
+        if self.given_up[gpu_id]:
+            return
+        exit_code = None if self.processes[gpu_id] is None else self.processes[gpu_id].poll()
+        if exit_code is not None:
+            self._restart(gpu_id, f"exited with code {exit_code}")
+            return
+        if now < self.next_probe_at[gpu_id]:
+            return
+
+        healthy = self._probe(gpu_id)
+        if not self.ready[gpu_id].is_set():
+            if healthy:
+                self._record_startup(gpu_id, now - self.launched_at[gpu_id])
+                with self.condition:
+                    self.ready[gpu_id].set()
+                    self.condition.notify_all()
+                self.next_probe_at[gpu_id] = now + self.health_interval
+            elif now - self.launched_at[gpu_id] > self.ready_timeout and self.commands[gpu_id] is not None:
+                self._restart(gpu_id, f"not ready after {self.ready_timeout} s")
+            else:
+                # Exponential backoff while the model loads
+                self.next_probe_at[gpu_id] = now + self.probe_delay[gpu_id]
+                self.probe_delay[gpu_id] = min(self.probe_delay[gpu_id] * 2, 30.0)
+            return
+
+        self.failed_probes[gpu_id] = 0 if healthy else self.failed_probes[gpu_id] + 1
+        if self.failed_probes[gpu_id] >= self.health_failures:
+            self._restart(gpu_id, f"stopped answering ({self.failed_probes[gpu_id]} failed probes)")
+        else:
+            self.next_probe_at[gpu_id] = now + (self.health_interval if healthy else 5.0)
+
+    def _monitor_loop(self):
+        while not self.stopped.wait(1.0):
+            for gpu_id in range(len(self.commands)):
+                try:
+                    self._check(gpu_id, time.time())
+                except Exception as e:
+                    print(f"Supervising backend {gpu_id} failed: {e}")
+
+    def is_alive(self, gpu_id):
+        process = self.processes[gpu_id]
+        if self.commands[gpu_id] is not None and (process is None or process.poll() is not None):
+            return False
+        return self.ready[gpu_id].is_set()
+
+    def generation(self, gpu_id):
+        return self.generations[gpu_id]
+
+    def restart_count(self, gpu_id):
+        return self.restarts[gpu_id]
+
+    def wait_ready(self, gpu_id, timeout=None):
+        # True once the backend serves requests, False if it will not come back
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while not self.ready[gpu_id].is_set():
+                if self.given_up[gpu_id] or self.stopped.is_set():
+                    return False
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining if remaining is not None else 5.0)
+        return True
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        for gpu_id in range(len(self.commands)):
+            self._kill(gpu_id)
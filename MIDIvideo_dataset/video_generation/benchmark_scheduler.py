@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+from dataset_layout import config_path, midi_path, sample_dir
+from job_cost import estimate_work, save_cost_index, strength_profile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SETTINGS_PATH = os.path.join(HERE, "new_deforum_settings.txt")
+
+
+def make_dataset(dataset_path, count, seed=0, min_frames=96, max_frames=384):
+    # Synthetic configs with the dataset layout main_video_generation.py expects; returns their work
+    rng = random.Random(seed)
+    with open(SETTINGS_PATH, 'r') as settings_file:
+        settings = json.load(settings_file)
+    works = []
+    cost_index = {}
+    for index in range(count):
+        os.makedirs(sample_dir(dataset_path, index), exist_ok=True)
+        frames = rng.randint(min_frames, max_frames)
+        base, kick = rng.uniform(0.8, 0.9), rng.uniform(0.25, 0.5)
+        rendered_frames = [{"frame": f, "strength": kick if f % 12 == 0 else base} for f in range(frames)]
+        manifest = {"rendered_frames": rendered_frames}
+        with open(config_path(dataset_path, index), 'w') as config_file:
+            json.dump(manifest, config_file)
+        with open(midi_path(dataset_path, index), 'wb') as midi_file:
+            midi_file.write(b'MThd\x00\x00\x00\x06\x00\x00\x00\x00\x01\xe0')
+        works.append(estimate_work(manifest, settings))
+        cost_index[index] = strength_profile(manifest)
+    # As dataset_creation.py does, so the scheduler orders configs without parsing them
+    save_cost_index(cost_index, dataset_path)
+    return works
+
+
+def fetch(port, path, timeout=5):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=timeout) as response:
+        return json.load(response)
+
+
+def read_port(path):
+    # The port a fake backend listens on, or None before it has bound one
+    try:
+        with open(path, 'r') as port_file:
+            return int(port_file.read())
+    except FileNotFoundError:
+        return None
+
+
+def start_fake_backends(count, output_dir, fake_args, log_dir):
+    # Each backend binds a free port and writes it to a file, so a stale server on a fixed port
+    # is never measured in its place; returns the processes and their ports
+    processes, port_files, log_paths = [], [], []
+    for index in range(count):
+        port_files.append(os.path.join(log_dir, f"fake_{index}.port"))
+        log_paths.append(os.path.join(log_dir, f"fake_{index}.log"))
+        command = [sys.executable, os.path.join(HERE, "fake_deforum_server.py"), "--port", "0",
+                   "--port_file", port_files[index], "--output_dir", output_dir, "--seed", str(index)] + fake_args
+        with open(log_paths[index], 'w') as log:
+            processes.append(subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT))
+    ports = []
+    deadline = time.time() + 30
+    for process, port_file, log_path in zip(processes, port_files, log_paths):
+        while True:
+            if process.poll() is not None:
+                with open(log_path, 'r') as log:
+                    output = log.read()
+                for other in processes:
+                    other.terminate()
+                raise RuntimeError(f"Fake backend exited with code {process.returncode}:\n{output}")
+            port = read_port(port_file)
+            if port is not None:
+                try:
+                    fetch(port, "/deforum_api/jobs")
+                    ports.append(port)
+                    break
+                except OSError:
+                    pass
+            if time.time() > deadline:
+                for other in processes:
+                    other.terminate()
+                raise RuntimeError(f"Fake backend did not start, see {log_path}")
+            time.sleep(0.1)
+    return processes, ports
+
+
+def run_scheduler(command, log_path, preempt_after=None):
+    # Wall time of one scheduler run, killed after preempt_after seconds if given
+    started = time.time()
+    with open(log_path, 'a') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=HERE, start_new_session=True)
+        try:
+            process.wait(timeout=preempt_after)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+    return started, time.time()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(jobs, ports, started, finished):
+    # Scheduler metrics over one run window, from the fake backends' own job records
+    window = [job for job in jobs if job["started_at"] is not None and started <= job["started_at"] <= finished]
+    wall = finished - started
+    busy = sum(min(job["finished_at"], finished) - job["started_at"] for job in window)
+    gaps = [job["submit_gap"] for job in window if job.get("submit_gap") is not None]
+    succeeded = sum(job["status"] == "SUCCEEDED" for job in window)
+    # Jobs left queued on a backend by a killed run start in the next one but were not submitted by it
+    accepted = [job["accepted_at"] for job in window if job["accepted_at"] >= started]
+    return {
+        "wall_seconds": round(wall, 2),
+        "jobs": len(window),
+        "succeeded": succeeded,
+        "jobs_per_hour": round(succeeded / wall * 3600, 1) if wall > 0 else None,
+        "gpu_idle_fraction": round(1 - busy / (wall * len(ports)), 3) if wall > 0 else None,
+        "submit_gap_p50": percentile(gaps, 0.5),
+        "submit_gap_p95": percentile(gaps, 0.95),
+        "first_job_after_seconds": round(min(accepted) - started, 2) if accepted else None,
+    }
+
+
+def collect_jobs(ports):
+    jobs = []
+    for port in ports:
+        jobs.extend(fetch(port, "/fake/stats")["jobs"])
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run main_video_generation.py against local fake Deforum backends and report scheduler metrics. "
+                    "Arguments not listed here are passed on to main_video_generation.py (e.g. --async_client).")
+    parser.add_argument("--workdir", type=str, default="scheduler_benchmark", help="Scratch directory (wiped)")
+    parser.add_argument("--count", type=int, default=40, help="Number of synthetic configs")
+    parser.add_argument("--backends", type=int, default=4, help="Number of fake backends (GPUs)")
+    parser.add_argument("--render_time", type=str, default="lognormal:2,0.2", help="Fake render time for a config of average work")
+    parser.add_argument("--failure_rate", type=float, default=0.0)
+    parser.add_argument("--preempt_after", type=float, help="Kill the first run after this many seconds, then resume")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, help="Also write the report to this JSON file")
+    args, scheduler_args = parser.parse_known_args()
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    dataset_path = os.path.join(args.workdir, "dataset")
+    output_path = os.path.join(args.workdir, "outputs")
+    os.makedirs(output_path)
+    works = make_dataset(dataset_path, args.count, args.seed)
+
+    fake_args = ["--render_time", args.render_time, "--reference_work", str(statistics.mean(works)),
+                 "--failure_rate", str(args.failure_rate)]
+    backends, ports = start_fake_backends(args.backends, os.path.abspath(output_path), fake_args, args.workdir)
+
+    command = [sys.executable, os.path.join(HERE, "main_video_generation.py"),
+               "--dataset_path", os.path.abspath(dataset_path), "--settings_path", SETTINGS_PATH,
+               "--path", os.path.abspath(output_path), "--count", str(args.count),
+               "--backend_ports", ",".join(map(str, ports)), "--backend_ready_timeout", "60"] + scheduler_args
+    log_path = os.path.join(args.workdir, "scheduler.log")
+    report = {"count": args.count, "backends": args.backends, "render_time": args.render_time,
+              "scheduler_args": scheduler_args}
+    try:
+        started, finished = run_scheduler(command, log_path, args.preempt_after)
+        report["run"] = summarize(collect_jobs(ports), ports, started, finished)
+        # A second run over the same outputs: how long until it is back at work (or done)
+        started, finished = run_scheduler(command, log_path)
+        resume = summarize(collect_jobs(ports), ports, started, finished)
+        report["resume"] = resume
+        report["resume_seconds"] = resume["first_job_after_seconds"] or resume["wall_seconds"]
+    finally:
+        for backend in backends:
+            backend.terminate()
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from work_queue import process_exited
+
+# Top-level boxes of an mp4 file: 4-byte size, 4-byte type
+MP4_BOX_HEADER = 8
+
+
+def mp4_is_complete(path):
+    # A finished mp4 is a run of top-level boxes that ends exactly at the end of the file and
+    # includes the moov box, which the muxer writes last. An interrupted write fails one of the two.
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as mp4_file:
+            position = 0
+            box_types = set()
+            while position < file_size:
+                mp4_file.seek(position)
+                header = mp4_file.read(MP4_BOX_HEADER)
+                if len(header) < MP4_BOX_HEADER:
+                    return False
+                box_size = int.from_bytes(header[:4], 'big')
+                box_types.add(header[4:8])
+                if box_size == 1:
+                    box_size = int.from_bytes(mp4_file.read(8), 'big')
+                elif box_size == 0:
+                    box_size = file_size - position
+                if box_size < MP4_BOX_HEADER:
+                    return False
+                position += box_size
+    except OSError:
+        return False
+    return position == file_size and b'moov' in box_types
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as output_file:
+        for chunk in iter(lambda: output_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CompletionLedger:
+    """Append-only record of finished config indices, loaded into a bitmap on start.
+
+    Every process appends one JSON line per finished config to its own ledger_<host>_<pid>.jsonl,
+    so writers never interleave. A line cut short by a crash fails to parse and is ignored, which
+    leaves that config to be rendered again.
+    """
+
+    def __init__(self, ledger_dir, count):
+        self.ledger_dir = ledger_dir
+        self.count = count
+        self.done = bytearray(count)
+        self.lock = threading.Lock()
+        os.makedirs(ledger_dir, exist_ok=True)
+        self.reload()
+
+        path = os.path.join(ledger_dir, f"ledger_{socket.gethostname()}_{os.getpid()}.jsonl")
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _load(self, path):
+        with open(path, 'r') as ledger_file:
+            for line in ledger_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 0 <= record["index"] < self.count:
+                    self.done[record["index"]] = 1
+
+    def reload(self):
+        # Read every process's ledger file, including records appended since the last read
+        self.ledger_files = [name for name in os.listdir(self.ledger_dir) if name.endswith(".jsonl")]
+        for name in self.ledger_files:
+            self._load(os.path.join(self.ledger_dir, name))
+
+    def is_done(self, index):
+        return index < self.count and self.done[index] == 1
+
+    def completed(self):
+        return sum(self.done)
+
+    def record(self, index, path):
+        record = {"index": index, "path": path, "size": os.path.getsize(path), "sha256": file_sha256(path),
+                  "time": time.time()}
+        line = (json.dumps(record) + "\n").encode('utf-8')
+        with self.lock:
+            # One write per record on an O_APPEND descriptor
+            os.write(self.fd, line)
+            os.fsync(self.fd)
+            if index < self.count:
+                self.done[index] = 1
+
+    def reconcile(self, output_root, batch_index, heartbeat=None):
+        # One-time scan of existing outputs: record every config with a complete mp4 that the
+        # ledger does not know about yet. batch_index maps an output directory name to its index;
+        # heartbeat, if given, is called before each directory.
+        recorded = 0
+        if not os.path.isdir(output_root):
+            return recorded
+        for name in os.listdir(output_root):
+            if heartbeat is not None:
+                heartbeat()
+            index = batch_index(name)
+            if index is None or self.is_done(index):
+                continue
+            batch_dir = os.path.join(output_root, name)
+            for file_name in os.listdir(batch_dir):
+                path = os.path.join(batch_dir, file_name)
+                if file_name.endswith(".mp4") and mp4_is_complete(path):
+                    self.record(index, path)
+                    recorded += 1
+                    break
+        return recorded
+
+    def _write_reconcile_lock(self, lock_path):
+        temporary_path = f"{lock_path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as lock_file:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid(), "heartbeat": time.time()}, lock_file)
+        os.replace(temporary_path, lock_path)
+
+    def _read_reconcile_lock(self, lock_path):
+        # Holder and heartbeat of the lock, None if there is none. A lock caught between its creation
+        # and first write has no holder yet and counts from its mtime
+        try:
+            modified = os.path.getmtime(lock_path)
+            with open(lock_path, 'r') as lock_file:
+                return json.load(lock_file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return {"heartbeat": modified}
+
+    def _is_stale(self, holder, stale_seconds):
+        if time.time() - holder["heartbeat"] > stale_seconds:
+            return True
+        return "pid" in holder and process_exited(holder["host"], holder["pid"])
+
+    def _acquire_reconcile_lock(self, lock_path, stale_seconds):
+        # True if this process now holds the lock: it created it, or took over a stale one
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            holder = self._read_reconcile_lock(lock_path)
+            if holder is None or not self._is_stale(holder, stale_seconds):
+                return False
+            # Move the stale lock aside first: only one node can win the rename
+            stale_path = f"{lock_path}.stale.{socket.gethostname()}_{os.getpid()}"
+            try:
+                os.rename(lock_path, stale_path)
+            except FileNotFoundError:
+                return False
+            holder = self._read_reconcile_lock(stale_path)
+            if holder is not None and not self._is_stale(holder, stale_seconds):
+                # Its holder wrote a heartbeat between our check and the rename: put it back
+                try:
+                    os.link(stale_path, lock_path)
+                except FileExistsError:
+                    pass
+                os.remove(stale_path)
+                return False
+            os.remove(stale_path)
+            print(f"Taking over the ledger reconciliation of {holder.get('host')}:{holder.get('pid')}")
+            return self._acquire_reconcile_lock(lock_path, stale_seconds)
+        os.close(fd)
+        self._write_reconcile_lock(lock_path)
+        return True
+
+    def reconcile_once(self, output_root, batch_index, poll_seconds=5, stale_seconds=120):
+        # First scan of a new ledger, done by a single node: the one holding reconcile.lock, whose
+        # heartbeat it refreshes while scanning. The others wait for its reconciled marker and reload
+        # the ledger instead of scanning too; a lock left by a crashed node (no heartbeat for
+        # stale_seconds, or an exited process of this host) is taken over.
+        # Returns the number of videos recorded, or None if this node did not scan.
+        marker_path = os.path.join(self.ledger_dir, "reconciled")
+        lock_path = os.path.join(self.ledger_dir, "reconcile.lock")
+        while not os.path.exists(marker_path):
+            if not self._acquire_reconcile_lock(lock_path, stale_seconds):
+                time.sleep(poll_seconds)
+                continue
+            if os.path.exists(marker_path):
+                # Finished by the previous holder just before its lock went stale
+                break
+            last_heartbeat = time.time()
+
+            def heartbeat():
+                nonlocal last_heartbeat
+                if time.time() - last_heartbeat >= stale_seconds / 4:
+                    self._write_reconcile_lock(lock_path)
+                    last_heartbeat = time.time()
+
+            recorded = self.reconcile(output_root, batch_index, heartbeat)
+            with open(marker_path, 'w') as marker_file:
+                marker_file.write(json.dumps({"recorded": recorded, "time": time.time()}))
+            return recorded
+        self.reload()
+        return None
+
+    def close(self):
+        os.close(self.fd)
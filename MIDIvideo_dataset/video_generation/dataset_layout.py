@@ -0,0 +1,34 @@
+import os
+
+# Where the render side finds sample <index> (0-based) and names its outputs. Sample n = index + 1
+# lives in <dataset>/midi_parseq_<n>/ as parseq_<n>.json (the rendered Parseq manifest) and
+# midi_<n>.mid, and renders to <output root>/batch_<n>/.
+
+
+def sample_dir(dataset_path, index):
+    return os.path.join(dataset_path, f"midi_parseq_{index + 1}")
+
+
+def config_path(dataset_path, index):
+    return os.path.join(sample_dir(dataset_path, index), f"parseq_{index + 1}.json")
+
+
+def midi_path(dataset_path, index):
+    return os.path.join(sample_dir(dataset_path, index), f"midi_{index + 1}.mid")
+
+
+def batch_name(index):
+    return f"batch_{index + 1}"
+
+
+def batch_index(name):
+    # batch_<n> output directory -> 0-based sample index
+    if name.startswith("batch_") and name[len("batch_"):].isdigit():
+        return int(name[len("batch_"):]) - 1
+    return None
+
+
+def sample_index(sample_id, clip, clips_per_file):
+    # Clip <clip> of the MIDI file with (1-based) sample id <sample_id>, when every file is given
+    # clips_per_file consecutive indices (windows x variants)
+    return (sample_id - 1) * clips_per_file + clip
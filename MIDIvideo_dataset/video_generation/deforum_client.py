@@ -0,0 +1,213 @@
+import asyncio
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+TERMINAL_STATUSES = ("SUCCEEDED", "FAILED", "CANCELLED")
+
+
+class AdaptivePoller:
+    """Poll interval for a backend, from a moving average of its job turnaround.
+
+    Jobs are polled rarely while far from their expected end and every min_interval once
+    they are due, instead of on a fixed 5 s period.
+    """
+
+    def __init__(self, min_interval=0.25, max_interval=5.0, alpha=0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.alpha = alpha
+        self.expected = None
+
+    def interval(self, elapsed):
+        if self.expected is None:
+            return 1.0
+        remaining = self.expected - elapsed
+        if remaining <= 0:
+            return self.min_interval
+        return min(self.max_interval, max(self.min_interval, remaining / 2))
+
+    def update(self, turnaround):
+        if self.expected is None:
+            self.expected = turnaround
+        else:
+            self.expected = self.alpha * turnaround + (1 - self.alpha) * self.expected
+
+
+class WaitForWork:
+    """Yielded by a source that has no item now but may have one later (chunks held by other nodes).
+
+    The slot runs wait() in a worker thread, outside the source lock, then asks the source again.
+    """
+
+    def __init__(self, wait):
+        self.wait = wait
+
+
+async def _next_item(source, lock):
+    # The source may block (work queue claims), so it is read in a thread, one caller at a time
+    loop = asyncio.get_running_loop()
+    while True:
+        async with lock:
+            item = await loop.run_in_executor(None, next, source, None)
+        if not isinstance(item, WaitForWork):
+            return item
+        await loop.run_in_executor(None, item.wait)
+
+
+async def _wait_until_ready(session, url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{url}/deforum_api/jobs") as response:
+                if response.status == 200:
+                    return True
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        await asyncio.sleep(5)
+    return False
+
+
+async def _submit(session, url, payload, max_attempts):
+    for attempt in range(max_attempts):
+        try:
+            async with session.post(f"{url}/deforum_api/batches", json=payload) as response:
+                response.raise_for_status()
+                return (await response.json(content_type=None)).get("job_ids", [])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Submitting to {url} failed (attempt {attempt + 1}/{max_attempts}): {e}")
+            if attempt + 1 == max_attempts:
+                raise
+            await asyncio.sleep(5)
+
+
+class JobLost(Exception):
+    """The backend answered but no longer knows a job it was given: it restarted and lost its queue."""
+
+
+async def _wait_for_job(session, url, job_id, poller, max_attempts):
+    started = time.monotonic()
+    errors = 0
+    while True:
+        try:
+            async with session.get(f"{url}/deforum_api/jobs/{job_id}") as response:
+                if response.status == 404:
+                    raise JobLost(f"{url} does not know job {job_id}")
+                response.raise_for_status()
+                status = await response.json(content_type=None)
+            errors = 0
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            errors += 1
+            if errors == max_attempts:
+                raise
+            status = {"status": None}
+        if status["status"] in TERMINAL_STATUSES:
+            poller.update(time.monotonic() - started)
+            return status
+        await asyncio.sleep(poller.interval(time.monotonic() - started))
+
+
+async def _render(session, url, payload, poller, max_attempts, ready_timeout, restart_count):
+    # One (batch_name, job_id, status) per entry of deforum_settings, or None after max_attempts
+    # errors. A settings entry is only submitted again if the backend lost its job, because it was
+    # restarted or no longer knows the job ID; after any other error its job is polled again
+    all_settings = payload["deforum_settings"]
+    names = [settings["batch_name"] for settings in all_settings]
+    results = {}  # settings index -> (batch_name, job_id, status)
+    job_ids = {}  # settings index -> ID of its submitted, unfinished job
+    restarts = restart_count(url)
+    for attempt in range(max_attempts):
+        try:
+            unsubmitted = [i for i in range(len(all_settings)) if i not in results and i not in job_ids]
+            if unsubmitted:
+                restarts = restart_count(url)
+                batch = dict(payload, deforum_settings=[all_settings[i] for i in unsubmitted])
+                submitted = await _submit(session, url, batch, max_attempts)
+                # One job per entry of deforum_settings, in the same order
+                if len(submitted) != len(unsubmitted):
+                    raise ValueError(f"Got {len(submitted)} job IDs for {len(unsubmitted)} settings")
+                job_ids.update(zip(unsubmitted, submitted))
+            for i in sorted(job_ids):
+                status = await _wait_for_job(session, url, job_ids[i], poller, max_attempts)
+                results[i] = (names[i], job_ids.pop(i), status)
+            return [results[i] for i in range(len(all_settings))]
+        except JobLost as e:
+            print(f"Resubmitting {names} to {url} (attempt {attempt + 1}/{max_attempts}): {e}")
+            job_ids.clear()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error on {names} with {url} (attempt {attempt + 1}/{max_attempts}): {e}")
+            if not await _wait_until_ready(session, url, ready_timeout):
+                return None
+            if restart_count(url) != restarts:
+                # Restarted under the jobs, which are gone with it
+                print(f"{url} restarted, resubmitting its unfinished jobs")
+                job_ids.clear()
+    return None
+
+
+async def _slot(session, url, source, lock, prepare, on_finished, poller, max_attempts, ready_timeout, restart_count):
+    # One of the jobs kept in flight on a backend: take a config, submit it, wait for it, repeat
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _next_item(source, lock)
+        if item is None:
+            return
+        results = None
+        try:
+            payload = await loop.run_in_executor(None, prepare, item, url)
+            if payload is None:
+                results = []
+            else:
+                results = await _render(session, url, payload, poller, max_attempts, ready_timeout, restart_count)
+        except Exception as e:
+            print(f"Error on {item} with {url}: {e}")
+        try:
+            await loop.run_in_executor(None, on_finished, item, results, url)
+        except Exception as e:
+            print(f"Handling the result of {item} failed: {e}")
+
+
+async def _run_backend(url, source, lock, prepare, on_finished, depth, max_attempts, ready_timeout, restart_count):
+    # A single keep-alive session per backend, shared by its slots
+    connector = aiohttp.TCPConnector(limit=depth + 1)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        if not await _wait_until_ready(session, url, ready_timeout):
+            print(f"Backend {url} never came up, it takes no work")
+            return
+        poller = AdaptivePoller()
+        await asyncio.gather(*(_slot(session, url, source, lock, prepare, on_finished, poller, max_attempts, ready_timeout,
+                                     restart_count)
+                               for _ in range(depth)))
+
+
+def run_async_client(urls, items, prepare, on_finished, depth=2, max_attempts=3, ready_timeout=1800, restart_count=None):
+    """Render every item of `items` on the Deforum backends at `urls`.
+
+    Each backend keeps `depth` jobs submitted, so its next render is already queued when one
+    finishes. Backends pull from the shared iterator as they free up; it may yield a WaitForWork
+    to have a backend wait for more items without holding up the others. `prepare(item, url)` returns
+    the batch payload (or None to skip) and `on_finished(item, results, url)` receives one
+    (batch_name, job_id, status) triple per submitted settings entry, or None if the item
+    failed; both run in worker threads and get the URL of the backend the item went to.
+
+    `restart_count(url)` tells how often the backend at `url` has been restarted. Jobs are only
+    resubmitted after it changes or when the backend no longer knows their ID; otherwise, after an
+    error, the jobs already submitted are polled again rather than rendered twice.
+    """
+    if aiohttp is None:
+        raise ImportError("The asyncio Deforum client needs aiohttp: pip install aiohttp")
+    source = iter(items)
+    if restart_count is None:
+        restart_count = lambda url: 0
+
+    async def run():
+        lock = asyncio.Lock()
+        await asyncio.gather(*(_run_backend(url, source, lock, prepare, on_finished, depth, max_attempts, ready_timeout,
+                                            restart_count)
+                               for url in urls))
+
+    asyncio.run(run())
@@ -0,0 +1,190 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from job_cost import estimate_work
+
+
+def parse_render_time(spec):
+    # "fixed:10", "uniform:8,12", "lognormal:10,0.3" (median seconds, sigma) -> sampler
+    kind, _, values = spec.partition(":")
+    numbers = [float(value) for value in values.split(",")] if values else []
+    if kind == "fixed":
+        return lambda rng: numbers[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(numbers[0], numbers[1])
+    if kind == "lognormal":
+        return lambda rng: numbers[0] * rng.lognormvariate(0, numbers[1])
+    raise ValueError(f"Unknown render time distribution: {spec}")
+
+
+def box(box_type, payload):
+    return (8 + len(payload)).to_bytes(4, 'big') + box_type + payload
+
+
+def fake_mp4(frames):
+    # Smallest file that still looks complete to completion_ledger.mp4_is_complete
+    return box(b'ftyp', b'isom\x00\x00\x02\x00isomiso2mp41') + box(b'mdat', bytes(frames)) + box(b'moov', b'\x00' * 8)
+
+
+class FakeDeforum:
+    """One GPU's worth of Deforum: batches are queued and rendered one job at a time."""
+
+    def __init__(self, output_dir, render_time, failure_rate=0.0, crash_after=None, reference_work=None, seed=0):
+        self.output_dir = output_dir
+        self.render_time = render_time
+        self.failure_rate = failure_rate
+        self.crash_after = crash_after
+        self.reference_work = reference_work
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.wakeup = threading.Condition(self.lock)
+        self.jobs = {}
+        self.batch_ids = itertools.count()
+        self.finished_at = None  # when the GPU last went idle
+        self.records = []
+        threading.Thread(target=self._render_loop, daemon=True).start()
+
+    def submit(self, payload):
+        with self.lock:
+            batch_id = f"batch({next(self.batch_ids)})"
+            job_ids = []
+            for index, settings in enumerate(payload["deforum_settings"]):
+                job_id = f"{batch_id}-{index}"
+                seconds = self.render_time(self.rng)
+                if self.reference_work:
+                    parseq_data = json.loads(settings.get("parseq_manifest") or "{}")
+                    seconds *= estimate_work(parseq_data, settings) / self.reference_work
+                self.jobs[job_id] = {"id": job_id, "status": "ACCEPTED", "phase": "QUEUED",
+                                     "batch_name": settings.get("batch_name", job_id), "render_seconds": seconds,
+                                     "accepted_at": time.time(), "queue_was_empty": not self.pending}
+                self.pending.append(job_id)
+                job_ids.append(job_id)
+            self.wakeup.notify()
+        return {"batch_id": batch_id, "job_ids": job_ids}
+
+    def _render_loop(self):
+        rendered = 0
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.wakeup.wait()
+                job = self.jobs[self.pending.popleft()]
+                job["phase"] = "GENERATING"
+                job["started_at"] = time.time()
+                # Gap the client left between the previous render ending and this job arriving
+                if job["queue_was_empty"] and self.finished_at is not None:
+                    job["submit_gap"] = max(0.0, job["accepted_at"] - self.finished_at)
+            time.sleep(job["render_seconds"])
+            rendered += 1
+            if self.crash_after is not None and rendered >= self.crash_after:
+                os._exit(1)
+            self._finish(job)
+
+    def _finish(self, job):
+        failed = self.rng.random() < self.failure_rate
+        outdir = os.path.join(self.output_dir, job["batch_name"])
+        if not failed:
+            os.makedirs(outdir, exist_ok=True)
+            with open(os.path.join(outdir, f"{job['batch_name']}.mp4"), 'wb') as video:
+                video.write(fake_mp4(int(job["render_seconds"] * 10)))
+            with open(os.path.join(outdir, f"{job['batch_name']}.srt"), 'w') as subtitles:
+                subtitles.write("1\n00:00:00,000 --> 00:00:00,041\nF#: 0\n")
+        with self.lock:
+            job["finished_at"] = self.finished_at = time.time()
+            job["status"] = "FAILED" if failed else "SUCCEEDED"
+            job["phase"] = "DONE"
+            job["outdir"] = outdir
+            self.records.append({key: job.get(key) for key in
+                                 ("batch_name", "status", "accepted_at", "started_at", "finished_at", "submit_gap")})
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            status = {key: job[key] for key in ("id", "status", "phase", "outdir") if key in job}
+            # Like Deforum: started_at is when the job was accepted, last_updated its last phase change
+            status["started_at"] = job["accepted_at"]
+            status["last_updated"] = job.get("finished_at") or job.get("started_at") or job["accepted_at"]
+            status["execution_time"] = status["last_updated"] - status["started_at"]
+            return status
+
+    def list_jobs(self):
+        with self.lock:
+            return {job_id: job["status"] for job_id, job in self.jobs.items()}
+
+    def stats(self):
+        with self.lock:
+            return {"jobs": list(self.records), "pending": len(self.pending)}
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path != "/deforum_api/batches":
+                return self._send(404, {"detail": "Not Found"})
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            self._send(202, fake.submit(payload))
+
+        def do_GET(self):
+            if self.path == "/deforum_api/jobs":
+                return self._send(200, fake.list_jobs())
+            if self.path == "/fake/stats":
+                return self._send(200, fake.stats())
+            if self.path.startswith("/deforum_api/jobs/"):
+                status = fake.status(self.path[len("/deforum_api/jobs/"):])
+                if status is not None:
+                    return self._send(200, status)
+            self._send(404, {"detail": "Not Found"})
+
+    return Handler
+
+
+def serve(port, fake):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(fake))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in for a Deforum API backend, for testing the scheduler without a GPU")
+    parser.add_argument("--port", type=int, default=0, help="0 lets the OS pick a free port")
+    parser.add_argument("--port_file", type=str, help="Write the port the server listens on here once it is bound")
+    parser.add_argument("--output_dir", type=str, required=True, help="Where fake videos are written, like img2img-images")
+    parser.add_argument("--render_time", type=str, default="lognormal:10,0.2", help="fixed:S, uniform:A,B or lognormal:MEDIAN,SIGMA seconds")
+    parser.add_argument("--reference_work", type=float, help="Scale render times by estimated work / this (see job_cost.py)")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Fraction of jobs that end FAILED")
+    parser.add_argument("--crash_after", type=int, help="Exit after rendering this many jobs")
+    parser.add_argument("--startup_seconds", type=float, default=0.0, help="Delay before the API answers, like model loading")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    time.sleep(args.startup_seconds)
+    fake = FakeDeforum(args.output_dir, parse_render_time(args.render_time), failure_rate=args.failure_rate,
+                       crash_after=args.crash_after, reference_work=args.reference_work, seed=args.seed)
+    server = serve(args.port, fake)
+    if args.port_file:
+        # Written whole, so a reader never sees a partial port number
+        with open(args.port_file + ".tmp", 'w') as port_file:
+            port_file.write(str(server.server_address[1]))
+        os.replace(args.port_file + ".tmp", args.port_file)
+    server.serve_forever()
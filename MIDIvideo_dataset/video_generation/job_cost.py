@@ -0,0 +1,202 @@
+import heapq
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+# Work units are normalized to one sampling step on a 512x512 frame
+REFERENCE_PIXELS = 512 * 512
+# Written by dataset_creation.py next to sample_ids.json
+COST_INDEX_FILE = 'cost_index.json'
+
+
+def _strength_runs(rendered_frames):
+    # (frame, strength) of every row; a row of a sparse manifest holds until the next row's frame
+    if isinstance(rendered_frames, dict):
+        # Column layout: one list per field
+        frames = rendered_frames["frame"]
+        return list(zip(frames, rendered_frames.get("strength") or [None] * len(frames)))
+    return [(frame["frame"], frame.get("strength")) for frame in rendered_frames]
+
+
+def strength_profile(parseq_data):
+    # What estimate_work needs from a manifest, whatever the settings: its frame count (None without
+    # rendered_frames: the settings' max_frames) and how many frames after the first have each
+    # strength (None: the settings' strength). Strength curves hold a couple of values, so it is small
+    rendered_frames = parseq_data.get("rendered_frames")
+    if not rendered_frames:
+        return {"frames": None, "strengths": []}
+    runs = _strength_runs(rendered_frames)
+    frames = runs[-1][0] + 1
+    counts = Counter()
+    for (frame, strength), (next_frame, _) in zip(runs, runs[1:] + [(frames, None)]):
+        if next_frame > max(frame, 1):
+            counts[strength] += next_frame - max(frame, 1)
+    return {"frames": frames, "strengths": [[strength, count] for strength, count in counts.items()]}
+
+
+def profile_work(profile, settings):
+    # img2img runs about steps * (1 - strength) sampling steps per frame; the first frame has no
+    # init image and runs all of them
+    steps = settings.get("steps", 15)
+    pixels = settings.get("W", 512) * settings.get("H", 512)
+    strengths = profile["strengths"]
+    if profile["frames"] is None:
+        strengths = [[None, max(0, settings.get("max_frames", 1) - 1)]]
+    default_strength = settings.get("strength", 0.8)
+
+    sampling_steps = steps
+    for strength, count in strengths:
+        strength = default_strength if strength is None else strength
+        sampling_steps += count * max(1.0, steps * (1 - strength))
+    return sampling_steps * pixels / REFERENCE_PIXELS
+
+
+def estimate_work(parseq_data, settings):
+    return profile_work(strength_profile(parseq_data), settings)
+
+
+def estimate_config_work(config, settings):
+    with open(config, 'r') as parseq_file:
+        return estimate_work(json.load(parseq_file), settings)
+
+
+def load_cost_index(dataset_path):
+    # Sample index -> strength_profile of its manifest, saved by dataset_creation.py; {} if there is none
+    try:
+        with open(os.path.join(dataset_path, COST_INDEX_FILE), 'r') as index_file:
+            return {int(index): profile for index, profile in json.load(index_file).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_cost_index(cost_index, dataset_path):
+    index_path = os.path.join(dataset_path, COST_INDEX_FILE)
+    temporary_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w') as index_file:
+        json.dump({str(index): profile for index, profile in sorted(cost_index.items())}, index_file)
+    os.replace(temporary_path, index_path)
+
+
+def estimate_works(configs, indices, settings, cost_index):
+    # Work of each config (sample indices alongside) from the cost index, read once; the manifests
+    # of configs missing from it are parsed. A config that cannot be read gets no work and goes last
+    works = []
+    parsed = 0
+    for config, index in zip(configs, indices):
+        profile = cost_index.get(index)
+        if profile is not None:
+            works.append(profile_work(profile, settings))
+            continue
+        parsed += 1
+        try:
+            works.append(estimate_config_work(config, settings))
+        except (OSError, ValueError):
+            works.append(0.0)
+    if parsed:
+        print(f"Cost index: {parsed} of {len(configs)} configs missing, their manifests were parsed")
+    return works
+
+
+class CostModel:
+    """seconds = intercept + slope * work, refitted by least squares after every observed render."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.n = 0
+        self.sum_x = self.sum_y = self.sum_xx = self.sum_xy = 0.0
+        self.intercept = 0.0
+        self.slope = None
+
+    def observe(self, work, seconds):
+        with self.lock:
+            self.n += 1
+            self.sum_x += work
+            self.sum_y += seconds
+            self.sum_xx += work * work
+            self.sum_xy += work * seconds
+            variance = self.n * self.sum_xx - self.sum_x * self.sum_x
+            slope = None
+            if self.n >= 2 and variance > 1e-9 * self.sum_xx * self.n:
+                slope = (self.n * self.sum_xy - self.sum_x * self.sum_y) / variance
+            if slope is not None and slope > 0:
+                self.slope = slope
+                self.intercept = (self.sum_y - slope * self.sum_x) / self.n
+            else:
+                # Too little spread (or noise) for a line yet: plain seconds per work unit
+                self.slope = self.sum_y / self.sum_x if self.sum_x else None
+                self.intercept = 0.0
+
+    def calibrated(self):
+        return self.slope is not None
+
+    def predict(self, work):
+        return max(0.0, self.intercept + self.slope * work)
+
+
+def lpt_order(items, works):
+    # Longest processing time first: the big jobs start early and the short ones fill the gaps
+    order = sorted(range(len(items)), key=lambda i: works[i], reverse=True)
+    return [items[i] for i in order], [works[i] for i in order]
+
+
+def simulate_makespan(durations, workers, free_at=None):
+    # Finish time of list scheduling: each job goes to the first worker to free up
+    free_at = sorted(free_at) if free_at else [0.0] * workers
+    heapq.heapify(free_at)
+    for duration in durations:
+        heapq.heappush(free_at, heapq.heappop(free_at) + duration)
+    return max(free_at)
+
+
+class MakespanTracker:
+    """Predicted versus actual makespan of a node's run, on the calibrated cost model."""
+
+    def __init__(self, works, workers, model=None, report_every=50):
+        self.works = works
+        self.workers = workers
+        self.model = model or CostModel()
+        self.report_every = report_every
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.next_job = 0
+        self.done = 0
+        self.busy_until = {}  # worker -> predicted time it frees up, relative to start
+        self.first_prediction = None
+
+    def predicted_makespan(self):
+        # Jobs not started yet are dispatched in order to the workers as they free up
+        now = time.time() - self.started
+        free_at = [max(now, self.busy_until.get(worker, now)) for worker in range(self.workers)]
+        remaining = [self.model.predict(work) for work in self.works[self.next_job:]]
+        return simulate_makespan(remaining, self.workers, free_at)
+
+    def job_started(self, worker, job):
+        with self.lock:
+            self.next_job = max(self.next_job, job + 1)
+            if self.model.calibrated():
+                self.busy_until[worker] = time.time() - self.started + self.model.predict(self.works[job])
+
+    def job_finished(self, worker, job, seconds):
+        self.model.observe(self.works[job], seconds)
+        with self.lock:
+            self.done += 1
+            self.busy_until.pop(worker, None)
+            # Predictions start once every worker has finished a job, so the fit has some data
+            if self.done < self.workers:
+                return
+            prediction = self.predicted_makespan()
+            if self.first_prediction is None:
+                self.first_prediction = prediction
+            if self.done % self.report_every == 0:
+                print(f"Cost model: {self.done}/{len(self.works)} jobs done, predicted makespan {prediction:.0f} s "
+                      f"({self.model.intercept:.2f} s + {self.model.slope:.4f} s per work unit)")
+
+    def report(self):
+        actual = time.time() - self.started
+        if self.first_prediction is None:
+            print(f"Makespan: {actual:.0f} s (too few jobs to calibrate the cost model)")
+        else:
+            print(f"Makespan: predicted {self.first_prediction:.0f} s after {self.workers} jobs, actual {actual:.0f} s")
+        return actual
@@ -2,28 +2,46 @@ import argparse
 import os
 import json
 import time
-import torch
-import torch.multiprocessing as mp
+from functools import lru_cache
+from itertools import islice
 from math import ceil
 import requests
 import shutil
-from queue import Queue
-from threading import Thread
+import socket
+import sys
+from queue import Empty, Queue
+from threading import Lock, Thread
+from work_queue import LeaseQueue
+from completion_ledger import CompletionLedger
+from deforum_client import WaitForWork, run_async_client
+from backend_supervisor import BackendSupervisor
+from job_cost import MakespanTracker, estimate_works, load_cost_index, lpt_order
+from telemetry import JobTelemetry
+from shard_packer import SHARD_BYTES, ShardPacker, pack_existing
+from manifest_prefetch import JSON_HEADERS, PREFETCH_BYTES, RequestPrefetcher, read_manifest, serialize_request
+import dataset_layout
+from dataset_layout import batch_index
 
+DEFAULT_OUTPUT_ROOT = "/gpfsscratch/rech/fkc/uhx75if/midi_videos_output/img2img-images"
 
-def get_config(args):
-    number_of_nodes = int(os.getenv("SLURM_ARRAY_TASK_COUNT"))
-    node_id = int(os.getenv("SLURM_ARRAY_TASK_ID"))
+
+def config_path(args, config_index):
+    return dataset_layout.config_path(args.dataset_path, config_index)
+
+
+def node_indices(args):
+    # Runs as a single node outside of a SLURM array
+    number_of_nodes = int(os.getenv("SLURM_ARRAY_TASK_COUNT", 1))
+    node_id = int(os.getenv("SLURM_ARRAY_TASK_ID", 0))
 
     entries_by_node = ceil(args.count / number_of_nodes)
-    print(f"Node configs entries by node: {entries_by_node}")
-    print(f"Node configs node ID: {node_id}")
-    node_configs = []
-    for i in range(entries_by_node):
-        config_index = node_id * entries_by_node + i
-        if config_index < args.count:
-            node_configs.append(f"{args.dataset_path}/midi_parseq_{config_index + 1}/parseq_{config_index + 1}.json")
+    return range(node_id * entries_by_node, min((node_id + 1) * entries_by_node, args.count))
 
+
+def get_config(args):
+    node_configs = [config_path(args, config_index) for config_index in node_indices(args)]
+
+    print(f"Node configs node ID: {int(os.getenv('SLURM_ARRAY_TASK_ID', 0))}")
     print(f"Node configs length: {len(node_configs)}")
     print(f"Node configs start: {node_configs[0]}")
     print(f"Node configs end: {node_configs[-1]}")
@@ -31,7 +49,30 @@ def get_config(args):
     return node_configs
 
 
+def get_output_root(args):
+    return args.path or DEFAULT_OUTPUT_ROOT
+
+
+def open_ledger(args):
+    if args.no_ledger:
+        return None
+    ledger_dir = args.ledger_dir or os.path.join(get_output_root(args), "completion_ledger")
+    ledger = CompletionLedger(ledger_dir, args.count)
+    if args.reconcile_ledger:
+        recorded = ledger.reconcile(get_output_root(args), batch_index)
+    else:
+        # A new ledger starts from the outputs already on disk, scanned by one node for all of them
+        recorded = ledger.reconcile_once(get_output_root(args), batch_index)
+    if recorded is not None:
+        print(f"Ledger reconciliation recorded {recorded} existing videos")
+    print(f"Ledger: {ledger.completed()}/{args.count} configs already done")
+    return ledger
+
+
 def get_device_config():
+    # Imported here so runs against --backend_ports work without PyTorch
+    import torch
+
     if torch.cuda.is_available():
         local_world_size = torch.cuda.device_count()
         backend, device = 'nccl', 'cuda'
@@ -48,147 +89,680 @@ def get_device_config():
     return local_world_size, backend, device
 
 
-def launch_a11_backend(rank, local_world_size, backend, device, args, ports):
-    port = ports[rank]
-    os.system("module load pytorch-gpu/py3/2.1.1")
-    os.system("module load git")
-    os.environ["PYTHONUSERBASE"] = "/gpfswork/rech/fkc/uhx75if/.local_automatic1111"
-    os.environ["PYTHONPATH"] = "/gpfswork/rech/fkc/uhx75if/video2midi/stable-diffusion-webui"
-    os.environ["SD_WEBUI_LOG_LEVEL"] = "CRITICAL"
-    os.environ['PYTHON_LOG_LEVEL'] = 'CRITICAL'
-    commande = f"python /gpfswork/rech/fkc/uhx75if/video2midi/stable-diffusion-webui/launch.py --api --port {port} --device-id {str(rank)} --opt-sdp-attention --disable-model-loading-ram-optimization --deforum-api --disable-console-progressbars"
-    os.system(commande)
+def backend_command(rank, port):
+    return ["python", "/gpfswork/rech/fkc/uhx75if/video2midi/stable-diffusion-webui/launch.py", "--api", "--port", str(port),
+            "--device-id", str(rank), "--opt-sdp-attention", "--disable-model-loading-ram-optimization", "--deforum-api",
+            "--disable-console-progressbars"]
 
 
-def post_request(config, ports, gpu_id, args):
-    url = f"http://127.0.0.1:{ports[gpu_id]}"
-    settings_path = args.settings_path
+def backend_env():
+    # Modules (pytorch-gpu, git) are loaded by the SLURM script before this process starts
+    env = dict(os.environ)
+    env["PYTHONUSERBASE"] = "/gpfswork/rech/fkc/uhx75if/.local_automatic1111"
+    env["PYTHONPATH"] = "/gpfswork/rech/fkc/uhx75if/video2midi/stable-diffusion-webui"
+    env["SD_WEBUI_LOG_LEVEL"] = "CRITICAL"
+    env['PYTHON_LOG_LEVEL'] = 'CRITICAL'
+    return env
+
+
+def get_metrics_dir(args):
+    return args.metrics_dir or os.path.join(get_output_root(args), "metrics")
 
+
+def start_backends(args, ports, external=False):
+    # External backends (--backend_ports) are already running: only probed, never launched
+    metrics_path = os.path.join(get_metrics_dir(args), f"backend_startups_{socket.gethostname()}.jsonl")
+    commands = [None if external else backend_command(rank, port) for rank, port in enumerate(ports)]
+    supervisor = BackendSupervisor(commands, ports,
+                                   env=backend_env(), ready_timeout=args.backend_ready_timeout,
+                                   max_restarts=args.backend_max_restarts, metrics_path=metrics_path,
+                                   log_dir=args.backend_log_dir)
+    supervisor.start()
+    return supervisor
+
+
+def open_telemetry(args):
+    if args.no_telemetry:
+        return None
+    return JobTelemetry(get_metrics_dir(args))
+
+
+@lru_cache(maxsize=None)
+def load_base_settings(settings_path):
+    # Parsed once per process and never modified: each config overlays its own fields on a shallow copy
     with open(settings_path, 'r') as settings_file:
-        deforum_settings = json.load(settings_file)
+        return json.load(settings_file)
+
+
+def config_number(config):
+    # .../parseq_<n>.json -> "<n>", the number used in batch and MIDI file names
+    return config.split('_')[-1].split('.')[0]
+
+
+def batch_name(config):
+    return f"batch_{config_number(config)}"
+
+
+def batch_names(configs):
+    return [batch_name(config) for config in configs]
+
+
+def backend_times(job_status):
+    # Deforum's own view of the job: when it accepted it and when its status last changed (the end)
+    return {"backend_started_at": job_status.get("started_at"), "backend_updated_at": job_status.get("last_updated")}
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
 
+def is_processed(config, args, ledger=None):
+    if ledger is not None:
+        return ledger.is_done(int(config_number(config)) - 1)
+    gen_path = os.path.join(get_output_root(args), f"batch_{config_number(config)}")
+    return os.path.exists(gen_path) and any(".mp4" in file for file in os.listdir(gen_path))
+
+
+def manifest_settings(parseq_manifest, name, args):
+    # Deforum settings of one job from its Parseq manifest, already serialized
+    return {
+        **load_base_settings(args.settings_path),
+        "parseq_manifest": parseq_manifest,
+        "parseq_non_schedule_overrides": True,
+        "batch_name": name
+    }
+
+
+def config_settings(config, args):
     with open(config, 'r') as parseq_file:
         parseq_data = json.load(parseq_file)
 
-    deforum_settings['parseq_manifest'] = json.dumps(parseq_data)
-    deforum_settings["parseq_non_schedule_overrides"] = True
-
-    # Extract the index from the config file path and set the batch_name
-    config_index = config.split('_')[-1].split('.')[0]
-    deforum_settings["batch_name"] = f"batch_{config_index}"
+    return manifest_settings(json.dumps(parseq_data), batch_name(config), args)
 
-    # is file is already processed, skip
-    gen_path = f"/gpfsscratch/rech/fkc/uhx75if/midi_videos_output/img2img-images/batch_{config_index}/"
-    if os.path.exists(gen_path):
-        if any(".mp4" in file for file in os.listdir(gen_path)):
-            print(f"File already processed: {config}")
-            return 'already'
 
-    payload = {
-        "deforum_settings": [deforum_settings],
+def request_payload(settings):
+    return {
+        "deforum_settings": settings,
         "options_overrides": {
             "deforum_save_gen_info_as_srt": True,
             "deforum_save_gen_info_as_srt_params": {}
         }
     }
 
-    response = requests.post(url=f'{url}/deforum_api/batches', json=payload, timeout=(1, 2))
+
+def build_request(configs, args, ledger=None):
+    # One Deforum batch payload for all configs not processed yet, or None if they all are
+    settings = []
+    for config in configs:
+        if is_processed(config, args, ledger):
+            print(f"File already processed: {config}")
+        else:
+            settings.append(config_settings(config, args))
+    if not settings:
+        return None
+
+    return request_payload(settings)
+
+
+def prepare_request(configs, args, ledger=None):
+    # build_request, serialized into the body a GPU worker sends as is. Configs that cannot be read
+    # or hold no Parseq manifest are left out and listed as invalid instead of failing the batch
+    settings = []
+    invalid = []
+    for config in configs:
+        if is_processed(config, args, ledger):
+            print(f"File already processed: {config}")
+            continue
+        try:
+            settings.append(manifest_settings(read_manifest(config), batch_name(config), args))
+        except (OSError, ValueError) as e:
+            print(f"Invalid config {config}: {e}")
+            invalid.append(batch_name(config))
+
+    return serialize_request(request_payload(settings) if settings else None, invalid)
+
+
+def batch_jobs(names, job_ids):
+    # Deforum returns one job per entry of deforum_settings, in the same order
+    if len(job_ids) != len(names):
+        raise ValueError(f"Got {len(job_ids)} job IDs for {len(names)} configs")
+    return list(zip(names, job_ids))
+
+
+def handle_job_status(batch_name, job_id, job_status, args, ledger=None, telemetry=None, packer=None):
+    if job_status["status"] == "SUCCEEDED":
+        print(f"Job {job_id} succeeded")
+        output_dir = job_status["outdir"]
+        print(f"Output directory: {output_dir}")
+
+        midi_index = int(batch_name.split('_')[-1])
+        if packer is None:
+            # Copy the associated MIDI file to the output directory
+            midi_path = dataset_layout.midi_path(args.dataset_path, midi_index - 1)
+            target_midi_path = os.path.join(output_dir, f"midi_{midi_index}.mid")
+            shutil.copy(midi_path, target_midi_path)
+
+            print(f"MIDI file saved to: {target_midi_path}")
+
+        if ledger is not None:
+            videos = [file for file in os.listdir(output_dir) if file.endswith(".mp4")]
+            if videos:
+                ledger.record(midi_index - 1, os.path.join(output_dir, videos[0]))
+                if packer is not None:
+                    # The shard takes the MIDI file from the dataset, no copy needed
+                    packer.add(midi_index - 1, output_dir)
+    else:
+        print(f"Job {job_id} failed with status: {job_status}")
+
+    if telemetry is not None:
+        telemetry.finish([batch_name], job_status["status"].lower(), job_id=job_id)
+
+
+def post_request(configs, ports, gpu_id, args, ledger=None, telemetry=None, packer=None, payload=None):
+    # payload is the PreparedRequest of the configs, built here when it was not prefetched
+    url = f"http://127.0.0.1:{ports[gpu_id]}"
+
+    if payload is None:
+        payload = prepare_request(configs, args, ledger)
+    if not payload.names:
+        return 'already'
+
+    if telemetry is not None:
+        telemetry.mark(payload.names, "submitted")
+    response = requests.post(url=f'{url}/deforum_api/batches', data=payload.body, headers=JSON_HEADERS, timeout=(1, 2))
     response.raise_for_status()
-    job_ids = response.json().get("job_ids", [])
+    jobs = batch_jobs(payload.names, response.json().get("job_ids", []))
+    if telemetry is not None:
+        telemetry.mark(payload.names, "accepted")
 
-    print(f"Config index: {config_index}")
-    print(f"Job IDs: {job_ids}")
+    print(f"Config indices: {[config_number(config) for config in configs]}")
+    print(f"Job IDs: {[job_id for _, job_id in jobs]}")
 
     def wait_for_job_to_complete(job_id):
         status_url = f"{url}/deforum_api/jobs/{job_id}"
         while True:
-            response = requests.get(status_url)
+            response = requests.get(status_url, timeout=30)
             response.raise_for_status()
             status = response.json()
             if status["status"] in ["SUCCEEDED", "FAILED"]:
                 return status
             time.sleep(5)
 
-    for job_id in job_ids:
+    for name, job_id in jobs:
         job_status = wait_for_job_to_complete(job_id)
-        if job_status["status"] == "SUCCEEDED":
-            print(f"Job {job_id} succeeded")
-            output_dir = job_status["outdir"]
-            print(f"Output directory: {output_dir}")
+        if telemetry is not None:
+            telemetry.mark([name], "finished", **backend_times(job_status))
+        handle_job_status(name, job_id, job_status, args, ledger, telemetry, packer)
 
-            # Copy the associated MIDI file to the output directory
-            midi_index = int(config.split('_')[-1].split('.')[0])
-            midi_path = f"{args.dataset_path}/midi_parseq_{midi_index}/midi_{midi_index}.mid"
-            target_midi_path = os.path.join(output_dir, f"midi_{midi_index}.mid")
-            shutil.copy(midi_path, target_midi_path)
+    return 'done'
 
-            print(f"MIDI file saved to: {target_midi_path}")
+
+def submit_with_retries(configs, ports, gpu_id, args, ledger, supervisor, telemetry=None, packer=None, payload=None):
+    # post_request's outcome ('done', 'already') or 'failed'; None if the GPU's backend is gone
+    # for good and the configs need another GPU
+    names = batch_names(configs)
+    if telemetry is not None:
+        telemetry.mark(names, "dequeued", gpu=gpu_id, port=ports[gpu_id])
+    if payload is None:
+        # Read once, not on every attempt
+        payload = prepare_request(configs, args, ledger)
+    outcome = None
+    attempt = 0
+    while attempt < args.max_attempts:
+        if not supervisor.wait_ready(gpu_id):
+            return None
+        generation = supervisor.generation(gpu_id)
+        try:
+            outcome = post_request(configs, ports, gpu_id, args, ledger, telemetry, packer, payload)
+            break
+        except Exception as e:
+            if supervisor.generation(gpu_id) != generation or not supervisor.is_alive(gpu_id):
+                # The backend crashed under the job: resubmit once it has been restarted
+                print(f"Backend {gpu_id} went down during {configs}, resubmitting after restart: {e}")
+                if telemetry is not None:
+                    telemetry.count(names, "restarts")
+                # Give the supervisor time to notice before waiting on readiness again
+                time.sleep(2)
+                continue
+            attempt += 1
+            print(f"Error on {configs} (attempt {attempt}/{args.max_attempts}): {e}")
+            time.sleep(5)
+    if outcome is None:
+        print(f"Giving up on {configs}")
+        outcome = 'failed'
+    if telemetry is not None:
+        if payload.invalid:
+            telemetry.finish(payload.invalid, "invalid")
+        # Configs without a job of their own were skipped as already done, or given up on
+        telemetry.finish(names, "gave_up" if outcome == 'failed' else "skipped", only_open=True)
+    return outcome
+
+
+class LiveWorkers:
+    """The GPU workers still taking jobs from a node's task queue.
+
+    A worker whose backend is gone for good hands its job back and leaves. Once the last one has
+    left, nothing takes the queued jobs anymore: they are drained and recorded as given up, and
+    join() returns False instead of waiting for them forever.
+    """
+
+    def __init__(self, task_queue, count, telemetry=None, prefetcher=None):
+        self.task_queue = task_queue
+        self.count = count
+        self.telemetry = telemetry
+        self.prefetcher = prefetcher
+        self.lock = Lock()
+
+    def alive(self):
+        with self.lock:
+            return self.count > 0
+
+    def lost(self, item):
+        # A worker leaves for good with the item it could not render
+        with self.lock:
+            self.count -= 1
+            last = self.count == 0
+        if last:
+            print("Every GPU backend is down for good, giving up on the queued configs")
+            self.give_up(item)
+            self.task_queue.task_done()
+            self.drain()
         else:
-            print(f"Job {job_id} failed with status: {job_status}")
+            # Hand the configs to the other GPUs of the node
+            self.put(item)
+            self.task_queue.task_done()
+
+    def give_up(self, item):
+        _, configs, payload = item
+        print(f"Giving up on {configs}")
+        if self.prefetcher is not None and payload is not None:
+            self.prefetcher.release(payload)
+        if self.telemetry is not None:
+            self.telemetry.finish(batch_names(configs), "gave_up", only_open=True)
+
+    def drain(self):
+        while True:
+            try:
+                item = self.task_queue.get_nowait()
+            except Empty:
+                return
+            if item is not None:
+                self.give_up(item)
+            self.task_queue.task_done()
+
+    def put(self, item):
+        self.task_queue.put(item)
+        if not self.alive():
+            # The last worker left while this was being queued
+            self.drain()
+
+    def join(self):
+        # True once every queued job has been handled, False if the workers all left first
+        self.task_queue.join()
+        return self.alive()
+
+
+def worker(gpu_id, ports, task_queue, args, ledger=None, supervisor=None, tracker=None, telemetry=None, packer=None,
+           prefetcher=None, live_workers=None):
+    # Queue items are (job, configs, payload); payload is None unless the request was built ahead
+    item = task_queue.get()
+    while item is not None:
+        job, configs, payload = item
+        if tracker is not None:
+            tracker.job_started(gpu_id, job)
+        started = time.time()
+        outcome = submit_with_retries(configs, ports, gpu_id, args, ledger, supervisor, telemetry, packer, payload)
+        if outcome is None:
+            print(f"GPU {gpu_id} backend is down for good, handing back {configs}")
+            if live_workers is not None:
+                live_workers.lost(item)
+                return
+            # Hand the configs to the other GPUs of the node
+            task_queue.put(item)
+            task_queue.task_done()
+            return
+        if prefetcher is not None:
+            prefetcher.release(payload)
+        if tracker is not None and outcome == 'done':
+            tracker.job_finished(gpu_id, job, time.time() - started)
+        task_queue.task_done()
+        item = task_queue.get()
 
-    return 'done'
 
+class ClaimedChunks:
+    """The jobs of the chunks a GPU worker claims one after the other, as (job, configs) pairs.
 
-def worker(gpu_id, ports, task_queue, args):
-    launched = False
-    out = "already"
+    job is the chunk and whether these are its last configs. The next chunk is claimed once at most
+    one job is read ahead, so its requests are built while the last job of the current chunk renders,
+    without holding a chunk that an idle GPU could take. (WaitForWork, None) is yielded while there is
+    nothing to claim yet; the worker calls handed() for every job it gets.
+    """
 
-    while out == "already":
-        try:
-            config = task_queue.get()
-            out = post_request(config, ports, gpu_id, args)
+    def __init__(self, gpu_id, work_queue, args, telemetry=None):
+        self.worker_name = f"gpu{gpu_id}"
+        self.work_queue = work_queue
+        self.args = args
+        self.telemetry = telemetry
+        self.claimed = []  # claimed and not completed yet
+        self.ahead = 0  # jobs yielded but not handed to the worker yet
 
-            if out == 'already' or out == 'done':
-                task_queue.task_done()
+    def handed(self):
+        self.ahead -= 1
 
-        except Exception as e:
-            while not launched:
-                try:
-                    out = post_request(config, ports, gpu_id, args)
-                    if out == 'done':
-                        launched = True
-                    task_queue.task_done()
-                except Exception as e:
-                    print(f"Error: {e}")
-                    time.sleep(5)
-
-    config = task_queue.get()
-    while config is not None:
-        post_request(config, ports, gpu_id, args)
-        task_queue.task_done()
-        config = task_queue.get()
+    def __iter__(self):
+        while True:
+            if self.ahead > 1:
+                yield WaitForWork(lambda: None), None
+                continue
+            chunk = self.work_queue.try_claim(self.worker_name)
+            if chunk is None:
+                if self.work_queue.finished() or self.work_queue.stopped.is_set():
+                    return
+                yield WaitForWork(self.work_queue.wait_for_lease), None
+                continue
+            self.claimed.append(chunk)
+            chunk_configs = [config_path(self.args, config_index) for config_index in self.work_queue.chunk_indices(chunk)]
+            if self.telemetry is not None:
+                self.telemetry.mark(batch_names(chunk_configs), "queued", chunk=chunk)
+            batches = list(batched(chunk_configs, self.args.configs_per_batch))
+            for number, configs in enumerate(batches, 1):
+                self.ahead += 1
+                yield (chunk, number == len(batches)), configs
+
+
+def lease_worker(gpu_id, ports, work_queue, args, ledger=None, supervisor=None, telemetry=None, packer=None,
+                 prefetcher=None):
+    if not supervisor.wait_ready(gpu_id):
+        print(f"Backend on port {ports[gpu_id]} never came up, GPU {gpu_id} takes no work")
+        return
+
+    chunks = ClaimedChunks(gpu_id, work_queue, args, telemetry)
+    if prefetcher is not None:
+        # One stream of requests over the worker's lifetime, built ahead across chunk boundaries
+        jobs = prefetcher.prefetch(chunks)
+    else:
+        jobs = ((job, configs, None) for job, configs in chunks)
+    for job, configs, payload in jobs:
+        if configs is None:
+            job.wait()
+            continue
+        chunks.handed()
+        chunk, last = job
+        outcome = submit_with_retries(configs, ports, gpu_id, args, ledger, supervisor, telemetry, packer, payload)
+        if prefetcher is not None:
+            prefetcher.release(payload)
+        if outcome is None:
+            # A dead backend: hand its chunks back, including one claimed ahead, so other GPUs pick them up now
+            print(f"Backend on port {ports[gpu_id]} is down for good, releasing chunks {chunks.claimed}")
+            for claimed_chunk in chunks.claimed:
+                work_queue.release(claimed_chunk)
+            return
+        if last:
+            work_queue.complete(chunk)
+            chunks.claimed.remove(chunk)
+
+
+def report_unfinished_chunks(work_queue):
+    # Workers take over the chunks of dead workers, so chunks are only left when this node's backends
+    # all gave up or the run was stopped
+    if not work_queue.finished():
+        print(f"Some chunks of {work_queue.queue_dir} are not done; rerun with the same --work_queue_dir to finish them")
+
+
+def main_lease_queue(args, ports, local_world_size, ledger=None, supervisor=None, telemetry=None, packer=None):
+    # Every GPU of every node claims small chunks from the shared queue until none are left
+    work_queue = LeaseQueue(args.work_queue_dir, args.count, chunk_size=args.chunk_size, lease_seconds=args.lease_seconds)
+    prefetcher = open_prefetcher(args, ledger)
+    workers = []
+    for gpu_id in range(local_world_size):
+        thread = Thread(target=lease_worker,
+                        args=(gpu_id, ports, work_queue, args, ledger, supervisor, telemetry, packer, prefetcher))
+        thread.start()
+        workers.append(thread)
 
+    for thread in workers:
+        thread.join()
+    work_queue.stop()
+    report_unfinished_chunks(work_queue)
+    if prefetcher is not None:
+        prefetcher.close()
 
-def main(args):
-    node_configs = get_config(args)
-    local_world_size, backend, device = get_device_config()
-    ports = [52361 + i for i in range(local_world_size)]
 
-    context = mp.spawn(
-        fn=launch_a11_backend,
-        args=(local_world_size, backend, device, args, ports),
-        nprocs=local_world_size,
-        join=False
-    )
+def lease_config_batches(work_queue, worker_name, batch_size, config_of):
+    # Batches of up to batch_size (chunk, config) pairs from chunks claimed one after the other, and the
+    # callback that marks a chunk done once all of its configs have finished. While every chunk left is
+    # held elsewhere, a WaitForWork is yielded so the lease wait does not hold the client's source lock
+    remaining = {}
+    lock = Lock()
+
+    def batches():
+        while True:
+            chunk = work_queue.try_claim(worker_name)
+            if chunk is None:
+                if work_queue.finished() or work_queue.stopped.is_set():
+                    return
+                yield WaitForWork(work_queue.wait_for_lease)
+                continue
+            indices = work_queue.chunk_indices(chunk)
+            with lock:
+                remaining[chunk] = len(indices)
+            yield from batched(((chunk, config_of(config_index)) for config_index in indices), batch_size)
+
+    def config_done(chunk):
+        with lock:
+            remaining[chunk] -= 1
+            finished = remaining[chunk] == 0
+        if finished:
+            work_queue.complete(chunk)
+
+    return batches(), config_done
+
+
+def main_async_client(args, ports, ledger=None, node_configs=None, telemetry=None, packer=None, supervisor=None):
+    # All backends driven from one event loop, each with --queue_depth jobs submitted ahead
+    work_queue = None
+    if args.work_queue_dir:
+        work_queue = LeaseQueue(args.work_queue_dir, args.count, chunk_size=args.chunk_size, lease_seconds=args.lease_seconds)
+        items, config_done = lease_config_batches(work_queue, "async", args.configs_per_batch,
+                                                  lambda config_index: config_path(args, config_index))
+    else:
+        items = batched(((None, config) for config in node_configs), args.configs_per_batch)
+        config_done = None
+
+    # Each item is a list of up to --configs_per_batch (chunk, config) pairs, sent as one batch
+
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+
+    def prepare(item, url):
+        payload = build_request([config for _, config in item], args, ledger)
+        if telemetry is not None and payload is not None:
+            # Submitted as soon as it is prepared, into the backend's own queue
+            submitted = [settings["batch_name"] for settings in payload["deforum_settings"]]
+            telemetry.mark(submitted, "submitted", gpu=urls.index(url), port=ports[urls.index(url)])
+        return payload
 
+    def on_finished(item, results, url):
+        if results is None:
+            print(f"Giving up on {[config for _, config in item]}")
+        else:
+            for name, job_id, job_status in results:
+                if telemetry is not None:
+                    telemetry.mark([name], "finished", **backend_times(job_status))
+                handle_job_status(name, job_id, job_status, args, ledger, telemetry, packer)
+        if telemetry is not None:
+            names = batch_names([config for _, config in item])
+            telemetry.finish(names, "gave_up" if results is None else "skipped", only_open=True)
+        if config_done is not None:
+            for chunk, _ in item:
+                config_done(chunk)
+
+    restart_count = None
+    if supervisor is not None:
+        restart_count = lambda url: supervisor.restart_count(urls.index(url))
+    run_async_client(urls, items, prepare, on_finished, depth=args.queue_depth, max_attempts=args.max_attempts,
+                     restart_count=restart_count)
+    if work_queue is not None:
+        work_queue.stop()
+        report_unfinished_chunks(work_queue)
+
+
+def order_by_cost(node_configs, args, ledger=None):
+    # Drop finished configs, then order the rest longest first by their estimated work
+    pending = [config for config in node_configs if not is_processed(config, args, ledger)]
+    settings = load_base_settings(args.settings_path)
+    indices = [int(config_number(config)) - 1 for config in pending]
+    works = estimate_works(pending, indices, settings, load_cost_index(args.dataset_path))
+    pending, works = lpt_order(pending, works)
+    if works:
+        print(f"Cost ordering: {len(pending)} configs, work from {works[0]:.0f} down to {works[-1]:.0f} units")
+    return pending, works
+
+
+def run(args, ports, local_world_size, supervisor, telemetry=None, packer=None):
+    ledger = open_ledger(args)
+    pack_leftovers(args, ledger, packer)
+
+    if args.work_queue_dir:
+        if args.async_client:
+            main_async_client(args, ports, ledger, telemetry=telemetry, packer=packer, supervisor=supervisor)
+        else:
+            main_lease_queue(args, ports, local_world_size, ledger, supervisor, telemetry, packer)
+        return
+
+    node_configs = get_config(args)
+    works = None
+    if not args.index_order:
+        node_configs, works = order_by_cost(node_configs, args, ledger)
+
+    if args.async_client:
+        main_async_client(args, ports, ledger, node_configs, telemetry, packer, supervisor)
+        return
+
+    jobs = list(batched(node_configs, args.configs_per_batch))
+    tracker = None
+    if works is not None:
+        job_works = [sum(batch) for batch in batched(works, args.configs_per_batch)]
+        tracker = MakespanTracker(job_works, local_world_size)
     task_queue = Queue(maxsize=10)
+    prefetcher = open_prefetcher(args, ledger)
+    live_workers = LiveWorkers(task_queue, local_world_size, telemetry, prefetcher)
 
     workers = []
     for gpu_id in range(local_world_size):
-        thread = Thread(target=worker, args=(gpu_id, ports, task_queue, args))
+        thread = Thread(target=worker,
+                        args=(gpu_id, ports, task_queue, args, ledger, supervisor, tracker, telemetry, packer, prefetcher,
+                              live_workers))
         thread.start()
         workers.append(thread)
 
-    for config in node_configs:
-        task_queue.put(config)
-
-    task_queue.join()
+    items = enumerate(jobs)
+    if prefetcher is not None:
+        # Requests are read and serialized ahead, so a worker submits its next one as soon as it is free
+        items = prefetcher.prefetch(items)
+    else:
+        items = ((job, configs, None) for job, configs in items)
+    for job, configs, payload in items:
+        if telemetry is not None:
+            telemetry.mark(batch_names(configs), "queued")
+        live_workers.put((job, configs, payload))
+
+    if not live_workers.join():
+        if prefetcher is not None:
+            prefetcher.close()
+        sys.exit(1)
+    if tracker is not None:
+        tracker.report()
 
     for _ in range(local_world_size):
         task_queue.put(None)
 
     for thread in workers:
         thread.join()
+    if prefetcher is not None:
+        prefetcher.close()
+
+
+def get_ports(args):
+    # Ports of the node's backends: the given running ones, or one per local GPU
+    if args.backend_ports:
+        ports = [int(port) for port in args.backend_ports.split(",")]
+        return ports, len(ports)
+    local_world_size, backend, device = get_device_config()
+    return [52361 + i for i in range(local_world_size)], local_world_size
+
+
+def open_prefetcher(args, ledger=None):
+    if args.prefetch_threads <= 0:
+        return None
+    return RequestPrefetcher(lambda configs: prepare_request(configs, args, ledger), threads=args.prefetch_threads,
+                             max_bytes=args.prefetch_bytes)
+
+
+def open_packer(args):
+    if not args.shard_dir:
+        return None
+    return ShardPacker(args.shard_dir, args.dataset_path, args.shard_bytes)
+
+
+def pack_leftovers(args, ledger, packer):
+    # Samples finished by a crashed run or one without --shard_dir; each node packs its own slice
+    # of the indices, so no sample goes into two shards
+    if packer is None or ledger is None:
+        return
+    queued = pack_existing(packer, ledger, get_output_root(args), args.count, node_indices(args))
+    print(f"Packing {queued} finished samples left in the output root")
+
+
+def close_render_stage(supervisor, telemetry, packer):
+    supervisor.stop()
+    if telemetry is not None:
+        telemetry.close()
+    if packer is not None:
+        # Commits the last shard
+        packer.close()
+
+
+def main(args):
+    ports, local_world_size = get_ports(args)
+
+    supervisor = start_backends(args, ports, external=bool(args.backend_ports))
+    telemetry = open_telemetry(args)
+    packer = open_packer(args)
+    try:
+        run(args, ports, local_world_size, supervisor, telemetry, packer)
+    finally:
+        close_render_stage(supervisor, telemetry, packer)
+
+
+def add_render_arguments(parser):
+    # Options of the render stage, shared with the streaming pipeline
+    parser.add_argument("--settings_path", type=str, required=True, help="Path to the Deforum settings file")
+    parser.add_argument("--path", type=str, help="Path to store the outputs")
+    parser.add_argument("--ledger_dir", type=str, help="Completion ledger directory (default: <output root>/completion_ledger)")
+    parser.add_argument("--reconcile_ledger", action="store_true", help="Scan existing outputs into the ledger before starting")
+    parser.add_argument("--no_ledger", action="store_true", help="Check each output directory for an mp4 instead of using the ledger")
+    parser.add_argument("--backend_ports", type=str, help="Comma-separated ports of already running backends to use instead of launching one per GPU")
+    parser.add_argument("--backend_ready_timeout", type=int, default=1800, help="Seconds a backend gets to start before it is restarted")
+    parser.add_argument("--backend_max_restarts", type=int, default=5, help="Restarts per backend before its GPU is left idle")
+    parser.add_argument("--backend_log_dir", type=str, help="Keep each backend's output in <dir>/backend_<gpu>.log")
+    parser.add_argument("--metrics_dir", type=str, help="Where metrics are written (default: <output root>/metrics)")
+    parser.add_argument("--no_telemetry", action="store_true", help="Do not write per-job records to <metrics dir>/jobs_<host>_<pid>.jsonl")
+    parser.add_argument("--shard_dir", type=str, help="Pack finished samples into tar shards here and delete their output directories")
+    parser.add_argument("--shard_bytes", type=int, default=SHARD_BYTES, help="Shard size at which a new shard is started")
+    parser.add_argument("--max_attempts", type=int, default=3, help="Attempts per config before it is skipped")
+    parser.add_argument("--prefetch_threads", type=int, default=2,
+                        help="Threads reading and serializing upcoming requests ahead of the GPU workers (0: on the worker)")
+    parser.add_argument("--prefetch_bytes", type=int, default=PREFETCH_BYTES, help="Bytes of prefetched requests held at most")
+
+
+def check_render_arguments(parser, args):
+    if args.shard_dir and args.no_ledger:
+        # Packed samples leave no output directory behind, only the ledger knows they are done
+        parser.error("--shard_dir needs the completion ledger")
 
 
 if __name__ == "__main__":
@@ -198,8 +772,15 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--local", action="store_true", help="Run the script locally")
     parser.add_argument("--dataset_path", type=str, required=True, help="Path to the dataset")
-    parser.add_argument("--settings_path", type=str, required=True, help="Path to the Deforum settings file")
-    parser.add_argument("--path", type=str, help="Path to store the outputs")
     parser.add_argument("--count", type=int, default=40000, help="Total number of configurations")
+    parser.add_argument("--work_queue_dir", type=str, help="Shared directory for lease-based work distribution across nodes (replaces the static split by array task)")
+    parser.add_argument("--chunk_size", type=int, default=8, help="Configs claimed at a time from the work queue")
+    parser.add_argument("--lease_seconds", type=int, default=600, help="Seconds before an unrenewed lease can be reclaimed")
+    parser.add_argument("--async_client", action="store_true", help="Drive all backends from one asyncio client that submits jobs ahead (needs aiohttp)")
+    parser.add_argument("--queue_depth", type=int, default=2, help="Jobs kept submitted on each backend with --async_client")
+    parser.add_argument("--configs_per_batch", type=int, default=1, help="Configs packed into each Deforum batch submission")
+    parser.add_argument("--index_order", action="store_true", help="Dispatch a node's configs in index order instead of longest estimated render first")
+    add_render_arguments(parser)
     parsed_args = parser.parse_args()
+    check_render_arguments(parser, parsed_args)
     main(parsed_args)
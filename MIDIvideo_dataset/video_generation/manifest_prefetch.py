@@ -0,0 +1,111 @@
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+PREFETCH_BYTES = 256 << 20
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+class PreparedRequest:
+    """A Deforum batch request serialized ahead of time: the batch names of its jobs, in submission
+    order, and the JSON body to POST as is. No names means every config was already done; invalid
+    lists the batch names of configs left out because their manifest could not be used."""
+
+    def __init__(self, names, body, invalid=()):
+        self.names = names
+        self.body = body
+        self.invalid = list(invalid)
+
+
+def expand_rendered_frames(rendered_frames):
+    # Rows written with --sparse_keyframes are only the frames where a value changes and the last
+    # frame; each holds until the next one, with zero deltas. Dense rows are returned as they are
+    if rendered_frames[-1]["frame"] + 1 == len(rendered_frames):
+        return rendered_frames
+    dense = []
+    for row, next_row in zip(rendered_frames, rendered_frames[1:]):
+        dense.append(row)
+        held = {key: (0 if type(row[key[:-len("_delta")]]) is int else 0.0) if key.endswith("_delta") else value
+                for key, value in row.items()}
+        dense.extend(dict(held, frame=frame) for frame in range(row["frame"] + 1, next_row["frame"]))
+    dense.append(rendered_frames[-1])
+    return dense
+
+
+def read_manifest(config):
+    # The Parseq manifest of a config, re-serialized compactly; ValueError if it is not one
+    with open(config, 'r') as parseq_file:
+        parseq_data = json.load(parseq_file)
+    if not isinstance(parseq_data, dict):
+        raise ValueError("not a JSON object")
+    rendered_frames = parseq_data.get("rendered_frames")
+    if not isinstance(rendered_frames, list) or not rendered_frames:
+        # Deforum renders from the per-frame rows
+        raise ValueError("no rendered_frames rows")
+    parseq_data["rendered_frames"] = expand_rendered_frames(rendered_frames)
+    return json.dumps(parseq_data)
+
+
+def serialize_request(payload, invalid=()):
+    # payload is a request_payload() dict, or None if there is nothing to submit
+    if payload is None:
+        return PreparedRequest([], b"", invalid)
+    names = [settings["batch_name"] for settings in payload["deforum_settings"]]
+    return PreparedRequest(names, json.dumps(payload).encode('utf-8'), invalid)
+
+
+class RequestPrefetcher:
+    """Builds the requests of upcoming jobs in a small thread pool, ahead of the GPU workers.
+
+    prefetch() yields jobs in their original order with their PreparedRequest. The bodies handed
+    out and not yet released stay under max_bytes (a single larger body still goes through, alone),
+    and at most lookahead requests are being built beyond that. Workers release() a request once
+    it has been submitted.
+    """
+
+    def __init__(self, build, threads=2, max_bytes=PREFETCH_BYTES, lookahead=None):
+        self.build = build  # configs -> PreparedRequest
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="prefetch")
+        self.max_bytes = max_bytes
+        self.lookahead = lookahead or 2 * threads
+        self.buffered = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def _reserve(self, size):
+        with self.condition:
+            while self.buffered > 0 and self.buffered + size > self.max_bytes:
+                self.condition.wait()
+            self.buffered += size
+            self.peak = max(self.peak, self.buffered)
+
+    def release(self, prepared):
+        with self.condition:
+            self.buffered -= len(prepared.body)
+            self.condition.notify_all()
+
+    def _take(self, pending):
+        job, configs, future = pending.popleft()
+        prepared = future.result()
+        self._reserve(len(prepared.body))
+        return job, configs, prepared
+
+    def prefetch(self, jobs):
+        # (job, configs) pairs in, (job, configs, PreparedRequest) out. A pair with no configs means
+        # the source has nothing to give yet: a request read ahead is handed out before asking it
+        # again, and once none is left the pair itself is, as (job, None, None)
+        pending = deque()
+        for job, configs in jobs:
+            if configs is None:
+                yield self._take(pending) if pending else (job, None, None)
+                continue
+            pending.append((job, configs, self.pool.submit(self.build, configs)))
+            if len(pending) >= self.lookahead:
+                yield self._take(pending)
+        while pending:
+            yield self._take(pending)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        print(f"Request prefetch: peak buffer {self.peak / (1 << 20):.1f} MB")
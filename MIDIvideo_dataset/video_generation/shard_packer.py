@@ -0,0 +1,209 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import socket
+import tarfile
+import threading
+from queue import Queue
+
+from completion_ledger import CompletionLedger, mp4_is_complete
+from dataset_layout import batch_name, config_path, midi_path
+
+SHARD_BYTES = 1 << 30
+
+
+def sample_key(index):
+    # Tar member names are <key>.<ext>; webdataset groups consecutive members by key
+    return batch_name(index)
+
+
+def sample_members(index, sample_dir, dataset_path):
+    # ext -> path of every file that goes into the sample: the rendered video and subtitles from
+    # the output directory, the MIDI file and Parseq manifest straight from the dataset
+    members = {}
+    for file_name in sorted(os.listdir(sample_dir)):
+        path = os.path.join(sample_dir, file_name)
+        if file_name.endswith(".mp4") and "mp4" not in members and mp4_is_complete(path):
+            members["mp4"] = path
+        elif file_name.endswith(".srt") and "srt" not in members:
+            members["srt"] = path
+    members["mid"] = midi_path(dataset_path, index)
+    # A streamed sample has no manifest on disk unless the pipeline persisted it
+    if os.path.exists(config_path(dataset_path, index)):
+        members["json"] = config_path(dataset_path, index)
+    return members
+
+
+def read_index(shard_dir):
+    # Every sample in a committed shard, from all index files; a line cut short by a crash is ignored
+    entries = []
+    for path in sorted(glob.glob(os.path.join(shard_dir, "index_*.jsonl"))):
+        with open(path, 'r') as index_file:
+            for line in index_file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    return entries
+
+
+def shard_list(shard_dir):
+    # Shards in the order they were committed per writer; orphans without index entries are left out
+    shards = []
+    for entry in read_index(shard_dir):
+        if entry["shard"] not in shards:
+            shards.append(entry["shard"])
+    return [os.path.join(shard_dir, shard) for shard in shards]
+
+
+class ShardPacker:
+    """Packs finished samples into tar shards of about shard_bytes, in a background thread.
+
+    Each process writes its own shard-<host>-<pid>-<n>.tar, first as a .tmp file that is renamed
+    once complete. Only then are the shard's samples appended to index_<host>_<pid>.jsonl (with
+    the offset and size of each member) and their output directories deleted. A crash before
+    that leaves the samples on disk and a .tmp file to ignore, never a sample that is lost.
+    """
+
+    def __init__(self, shard_dir, dataset_path, shard_bytes=SHARD_BYTES, delete_packed=True):
+        self.shard_dir = shard_dir
+        self.dataset_path = dataset_path
+        self.shard_bytes = shard_bytes
+        self.delete_packed = delete_packed
+        os.makedirs(shard_dir, exist_ok=True)
+        self.packed = set(entry["index"] for entry in read_index(shard_dir))
+
+        self.prefix = f"shard-{socket.gethostname()}-{os.getpid()}"
+        index_path = os.path.join(shard_dir, f"index_{socket.gethostname()}_{os.getpid()}.jsonl")
+        self.index_fd = os.open(index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.shard_number = 0
+        self.tar = None
+        self.entries = []  # index entries of the open shard
+        self.sample_dirs = []  # deleted once the open shard is committed
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._pack_loop, daemon=True)
+        self.thread.start()
+
+    def is_packed(self, index):
+        return index in self.packed
+
+    def add(self, index, sample_dir):
+        self.queue.put((index, sample_dir))
+
+    def _shard_name(self):
+        return f"{self.prefix}-{self.shard_number:05d}.tar"
+
+    def _open_shard(self):
+        path = os.path.join(self.shard_dir, self._shard_name() + ".tmp")
+        self.tar = tarfile.open(path, 'w', format=tarfile.USTAR_FORMAT)
+
+    def _pack(self, index, sample_dir):
+        members = sample_members(index, sample_dir, self.dataset_path)
+        if "mp4" not in members:
+            print(f"No complete video in {sample_dir}, not packing it")
+            return
+        if self.tar is None:
+            self._open_shard()
+        key = sample_key(index)
+        offsets = {}
+        for ext, path in members.items():
+            info = self.tar.gettarinfo(path, arcname=f"{key}.{ext}")
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            info.mode = 0o644
+            with open(path, 'rb') as member_file:
+                self.tar.addfile(info, member_file)
+            # The data ends where the archive now does, less its padding to a 512-byte block
+            padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            offsets[ext] = [self.tar.offset - padded, info.size]
+        self.entries.append({"index": index, "key": key, "shard": self._shard_name(), "members": offsets})
+        self.sample_dirs.append(sample_dir)
+        if self.tar.fileobj.tell() >= self.shard_bytes:
+            self._commit()
+
+    def _commit(self):
+        if self.tar is None:
+            return
+        path = os.path.join(self.shard_dir, self._shard_name())
+        self.tar.close()
+        with open(path + ".tmp", 'rb') as shard_file:
+            os.fsync(shard_file.fileno())
+        os.replace(path + ".tmp", path)
+        index_lines = "".join(json.dumps(entry) + "\n" for entry in self.entries)
+        os.write(self.index_fd, index_lines.encode('utf-8'))
+        os.fsync(self.index_fd)
+        print(f"Shard {path} committed with {len(self.entries)} samples")
+
+        self.packed.update(entry["index"] for entry in self.entries)
+        if self.delete_packed:
+            # Frames, video and subtitles are all in the shard now
+            for sample_dir in self.sample_dirs:
+                shutil.rmtree(sample_dir, ignore_errors=True)
+        self.tar = None
+        self.entries = []
+        self.sample_dirs = []
+        self.shard_number += 1
+
+    def _pack_loop(self):
+        item = self.queue.get()
+        while item is not None:
+            index, sample_dir = item
+            try:
+                if index not in self.packed:
+                    self._pack(index, sample_dir)
+            except Exception as e:
+                print(f"Packing {sample_dir} failed: {e}")
+            item = self.queue.get()
+        self._commit()
+
+    def close(self):
+        # Packs what is queued, commits the last (smaller) shard
+        self.queue.put(None)
+        self.thread.join()
+        os.close(self.index_fd)
+
+
+def pack_existing(packer, ledger, output_root, count, indices=None):
+    # Finish what a crashed or earlier run left: delete directories of samples that are already in
+    # a shard, pack finished samples that are not. Only `indices` are looked at if given
+    queued = 0
+    for index in (range(count) if indices is None else indices):
+        sample_dir = os.path.join(output_root, sample_key(index))
+        if not ledger.is_done(index) or not os.path.isdir(sample_dir):
+            continue
+        if packer.is_packed(index):
+            if packer.delete_packed:
+                shutil.rmtree(sample_dir, ignore_errors=True)
+        else:
+            packer.add(index, sample_dir)
+            queued += 1
+    return queued
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pack finished samples into tar shards, or list the committed shards. Run it while no "
+                    "video generation is writing to the output root; during a run, use main_video_generation.py --shard_dir.")
+    parser.add_argument("--shard_dir", type=str, required=True, help="Where shards and their index files go")
+    parser.add_argument("--list", action="store_true", help="Print the committed shards, one path per line, and exit")
+    parser.add_argument("--output_root", type=str, help="Output root with the batch_<n> directories")
+    parser.add_argument("--dataset_path", type=str, help="Dataset with the MIDI files and Parseq configs")
+    parser.add_argument("--ledger_dir", type=str, help="Completion ledger (default: <output root>/completion_ledger)")
+    parser.add_argument("--count", type=int, default=40000, help="Total number of configurations")
+    parser.add_argument("--shard_bytes", type=int, default=SHARD_BYTES, help="Shard size at which a new shard is started")
+    parser.add_argument("--keep_packed", action="store_true", help="Do not delete output directories once packed")
+    args = parser.parse_args()
+
+    if args.list:
+        for shard in shard_list(args.shard_dir):
+            print(shard)
+    else:
+        if args.output_root is None or args.dataset_path is None:
+            parser.error("--output_root and --dataset_path are required to pack")
+        ledger = CompletionLedger(args.ledger_dir or os.path.join(args.output_root, "completion_ledger"), args.count)
+        packer = ShardPacker(args.shard_dir, args.dataset_path, args.shard_bytes, delete_packed=not args.keep_packed)
+        print(f"Packing {pack_existing(packer, ledger, args.output_root, args.count)} samples")
+        packer.close()
+        ledger.close()
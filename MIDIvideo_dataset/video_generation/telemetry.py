@@ -0,0 +1,69 @@
+import json
+import os
+import socket
+import threading
+import time
+
+# Phases of a job, in order; each record has a <phase>_at timestamp for those it went through
+PHASES = ("queued", "dequeued", "submitted", "accepted", "finished", "handled")
+
+
+class JobTelemetry:
+    """One JSON line per job in <metrics_dir>/jobs_<host>_<pid>.jsonl, written when the job ends.
+
+    Phases are marked by batch name as the job moves through the scheduler, and the record is kept
+    in memory until finish(). Writing is one os.write on an O_APPEND descriptor per job, with no
+    fsync: a record lost in a crash only costs a data point.
+    """
+
+    def __init__(self, metrics_dir):
+        self.host = socket.gethostname()
+        self.node = os.getenv("SLURM_ARRAY_TASK_ID")
+        self.records = {}
+        self.lock = threading.Lock()
+        os.makedirs(metrics_dir, exist_ok=True)
+        path = os.path.join(metrics_dir, f"jobs_{self.host}_{os.getpid()}.jsonl")
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _record(self, batch_name):
+        record = self.records.get(batch_name)
+        if record is None:
+            record = self.records[batch_name] = {"batch_name": batch_name, "host": self.host, "node": self.node,
+                                                 "attempts": 0, "restarts": 0}
+        return record
+
+    def mark(self, batch_names, phase, **fields):
+        # A later attempt overwrites the timestamps of the earlier one; "submitted" counts attempts
+        now = time.time()
+        with self.lock:
+            for batch_name in batch_names:
+                record = self._record(batch_name)
+                record[f"{phase}_at"] = now
+                if phase == "submitted":
+                    record["attempts"] += 1
+                record.update(fields)
+
+    def count(self, batch_names, field):
+        with self.lock:
+            for batch_name in batch_names:
+                self._record(batch_name)[field] += 1
+
+    def finish(self, batch_names, outcome, only_open=False, **fields):
+        # With only_open, names with no record in progress (already finished) are left alone
+        now = time.time()
+        lines = []
+        with self.lock:
+            for batch_name in batch_names:
+                if only_open and batch_name not in self.records:
+                    continue
+                record = self._record(batch_name)
+                del self.records[batch_name]
+                record.update(fields)
+                record["handled_at"] = now
+                record["outcome"] = outcome
+                lines.append(json.dumps(record) + "\n")
+            if lines:
+                os.write(self.fd, "".join(lines).encode('utf-8'))
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,154 @@
+import argparse
+import glob
+import json
+import os
+from collections import defaultdict
+
+# Durations reported per job: (name, start timestamp, end timestamp)
+LATENCIES = (
+    ("queue_wait", "queued_at", "dequeued_at"),
+    ("prepare", "dequeued_at", "submitted_at"),
+    ("submit", "submitted_at", "accepted_at"),
+    ("backend", "backend_started_at", "backend_updated_at"),
+    ("poll_lag", "backend_updated_at", "finished_at"),
+    ("handle", "finished_at", "handled_at"),
+)
+FAILED_OUTCOMES = ("failed", "cancelled", "gave_up", "invalid")
+
+
+def read_jsonl(pattern):
+    records = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r') as records_file:
+            for line in records_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+    return records
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+    return {"n": len(values), "p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": round(values[-1], 3)}
+
+
+def first_seen(record):
+    for phase in ("queued_at", "dequeued_at", "submitted_at", "handled_at"):
+        if record.get(phase) is not None:
+            return record[phase]
+
+
+def busy_interval(job):
+    # The backend's own times leave out the polling lag, during which the GPU is idle
+    if job.get("backend_started_at") is not None and job.get("backend_updated_at") is not None:
+        return job["backend_started_at"], job["backend_updated_at"]
+    if job.get("submitted_at") is not None and job.get("finished_at") is not None:
+        return job["submitted_at"], job["finished_at"]
+    return None
+
+
+def busy_seconds(intervals):
+    # Length of the union of the intervals: with several jobs submitted ahead they overlap
+    busy, end = 0.0, None
+    for start, finish in sorted(intervals):
+        if end is None or start > end:
+            busy += finish - start
+            end = finish
+        elif finish > end:
+            busy += finish - end
+            end = finish
+    return busy
+
+
+def summarize(jobs, startups):
+    outcomes = defaultdict(int)
+    for job in jobs:
+        outcomes[job.get("outcome")] += 1
+    succeeded_total = outcomes.get("succeeded", 0)
+    ended = succeeded_total + sum(outcomes.get(outcome, 0) for outcome in FAILED_OUTCOMES)
+
+    # Each node is timed from its own first job to its own last one
+    by_host = defaultdict(list)
+    for job in jobs:
+        by_host[job["host"]].append(job)
+    hosts = {}
+    node_seconds = 0.0
+    for host, host_jobs in sorted(by_host.items()):
+        started = min(first_seen(job) for job in host_jobs)
+        wall = max(job["handled_at"] for job in host_jobs) - started
+        node_seconds += wall
+        succeeded = sum(job["outcome"] == "succeeded" for job in host_jobs)
+        gpus = defaultdict(list)
+        for job in host_jobs:
+            interval = busy_interval(job)
+            if job.get("gpu") is not None and interval is not None:
+                gpus[job["gpu"]].append(interval)
+        hosts[host] = {
+            "wall_seconds": round(wall, 1),
+            "succeeded": succeeded,
+            "jobs_per_hour": round(succeeded / wall * 3600, 1) if wall > 0 else None,
+            "gpu_utilization": {gpu: round(busy_seconds(intervals) / wall, 3) if wall > 0 else None
+                                for gpu, intervals in sorted(gpus.items())},
+        }
+
+    latencies = {}
+    for name, start, end in LATENCIES:
+        latencies[name] = percentiles([job[end] - job[start] for job in jobs
+                                       if job.get(start) is not None and job.get(end) is not None])
+    latencies["total"] = percentiles([job["handled_at"] - first_seen(job) for job in jobs
+                                      if job.get("outcome") == "succeeded"])
+
+    restarts = [startup for startup in startups if startup.get("restart")]
+    return {
+        "jobs": len(jobs),
+        "outcomes": dict(outcomes),
+        "failure_rate": round((ended - succeeded_total) / ended, 4) if ended else None,
+        "attempts_over_one": sum(job.get("attempts", 0) > 1 for job in jobs),
+        "resubmitted_after_restart": sum(job.get("restarts", 0) > 0 for job in jobs),
+        "succeeded_per_node_hour": round(succeeded_total / node_seconds * 3600, 1) if node_seconds > 0 else None,
+        "latency_seconds": latencies,
+        "backend_startups": {"count": len(startups), "restarts": len(restarts),
+                             "startup_seconds": percentiles([startup["startup_seconds"] for startup in startups])},
+        "hosts": hosts,
+    }
+
+
+def print_report(report):
+    print(f"Jobs: {report['jobs']} {report['outcomes']}, failure rate {report['failure_rate']}")
+    print(f"Retried: {report['attempts_over_one']}, resubmitted after a backend restart: {report['resubmitted_after_restart']}")
+    print(f"Throughput: {report['succeeded_per_node_hour']} videos per node-hour")
+    print("Latency (s)      n      p50      p95      p99      max")
+    for name, stats in report["latency_seconds"].items():
+        if stats is not None:
+            print(f"  {name:<12} {stats['n']:>6} {stats['p50']:>8} {stats['p95']:>8} {stats['p99']:>8} {stats['max']:>8}")
+    startups = report["backend_startups"]
+    print(f"Backend startups: {startups['count']} ({startups['restarts']} restarts), seconds {startups['startup_seconds']}")
+    for host, stats in report["hosts"].items():
+        utilization = " ".join(f"gpu{gpu}={value}" for gpu, value in stats["gpu_utilization"].items())
+        print(f"  {host}: {stats['succeeded']} videos in {stats['wall_seconds']} s "
+              f"({stats['jobs_per_hour']}/h), utilization {utilization}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate the per-job telemetry of every node of a video generation run")
+    parser.add_argument("metrics_dirs", nargs="+", help="Metrics directories (--metrics_dir of main_video_generation.py)")
+    parser.add_argument("--json", type=str, help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    jobs, startups = [], []
+    for metrics_dir in args.metrics_dirs:
+        jobs.extend(read_jsonl(os.path.join(metrics_dir, "jobs_*.jsonl")))
+        startups.extend(read_jsonl(os.path.join(metrics_dir, "backend_startups_*.jsonl")))
+    report = summarize(jobs, startups)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
@@ -0,0 +1,74 @@
+import json
+import os
+import socket
+import threading
+import time
+from completion_ledger import CompletionLedger
+from dataset_layout import batch_index
+
+DEAD_PID = 2 ** 22 + 1  # above Linux's pid_max, so never a live process
+
+
+def write_outputs(output_root, count):
+    # A complete mp4 (an ftyp and a moov box) in batch_1 .. batch_<count>
+    for number in range(1, count + 1):
+        os.makedirs(os.path.join(output_root, f"batch_{number}"))
+        with open(os.path.join(output_root, f"batch_{number}", "video.mp4"), 'wb') as mp4_file:
+            mp4_file.write(b'\x00\x00\x00\x08ftyp\x00\x00\x00\x08moov')
+
+
+def leave_lock(ledger_dir, host, pid, heartbeat):
+    # The lock of a node that never wrote the reconciled marker
+    os.makedirs(ledger_dir, exist_ok=True)
+    with open(os.path.join(ledger_dir, "reconcile.lock"), 'w') as lock_file:
+        json.dump({"host": host, "pid": pid, "heartbeat": heartbeat}, lock_file)
+
+
+def test_lock_of_exited_process_is_taken_over(tmp_path):
+    output_root, ledger_dir = str(tmp_path / "outputs"), str(tmp_path / "ledger")
+    write_outputs(output_root, 3)
+    leave_lock(ledger_dir, socket.gethostname(), DEAD_PID, time.time())
+
+    ledger = CompletionLedger(ledger_dir, 10)
+    started = time.time()
+    assert ledger.reconcile_once(output_root, batch_index, poll_seconds=0.1) == 3
+    assert time.time() - started < 1
+    assert os.path.exists(os.path.join(ledger_dir, "reconciled"))
+    assert [ledger.is_done(index) for index in range(4)] == [True, True, True, False]
+    ledger.close()
+
+
+def test_lock_without_heartbeat_is_taken_over(tmp_path):
+    # Another host's process cannot be checked: only its heartbeat tells that it is gone
+    output_root, ledger_dir = str(tmp_path / "outputs"), str(tmp_path / "ledger")
+    write_outputs(output_root, 2)
+    leave_lock(ledger_dir, "other-node", 1234, time.time() - 1)
+
+    ledger = CompletionLedger(ledger_dir, 10)
+    started = time.time()
+    assert ledger.reconcile_once(output_root, batch_index, poll_seconds=0.1, stale_seconds=2) == 2
+    assert 1 < time.time() - started < 3
+    ledger.close()
+
+
+def test_live_lock_is_waited_for(tmp_path):
+    output_root, ledger_dir = str(tmp_path / "outputs"), str(tmp_path / "ledger")
+    write_outputs(output_root, 2)
+    holder = CompletionLedger(ledger_dir, 10)
+    leave_lock(ledger_dir, "other-node", 1234, time.time())
+
+    def finish():
+        # The holder records what it found, then writes the marker
+        time.sleep(0.5)
+        holder.reconcile(output_root, batch_index)
+        with open(os.path.join(ledger_dir, "reconciled"), 'w') as marker_file:
+            marker_file.write("{}")
+
+    thread = threading.Thread(target=finish)
+    thread.start()
+    waiter = CompletionLedger(ledger_dir, 10)
+    assert waiter.reconcile_once(output_root, batch_index, poll_seconds=0.1) is None
+    thread.join()
+    assert waiter.completed() == 2
+    holder.close()
+    waiter.close()
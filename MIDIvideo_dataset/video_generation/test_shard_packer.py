@@ -0,0 +1,37 @@
+import os
+from completion_ledger import CompletionLedger
+from dataset_layout import midi_path, sample_dir
+from shard_packer import ShardPacker, pack_existing, read_index
+
+
+def write_finished_sample(output_root, dataset_path, ledger, index):
+    # A rendered sample the ledger knows about, with its MIDI file in the dataset
+    output_dir = os.path.join(output_root, f"batch_{index + 1}")
+    os.makedirs(output_dir)
+    video = os.path.join(output_dir, "video.mp4")
+    with open(video, 'wb') as mp4_file:
+        mp4_file.write(b'\x00\x00\x00\x08ftyp\x00\x00\x00\x08moov')
+    ledger.record(index, video)
+    os.makedirs(sample_dir(dataset_path, index), exist_ok=True)
+    with open(midi_path(dataset_path, index), 'wb') as midi_file:
+        midi_file.write(b'MThd\x00\x00\x00\x06\x00\x00\x00\x00\x01\xe0')
+    return output_dir
+
+
+def test_leftovers_of_a_node_slice_are_packed(tmp_path):
+    output_root, dataset_path, shard_dir = str(tmp_path / "outputs"), str(tmp_path / "dataset"), str(tmp_path / "shards")
+    ledger = CompletionLedger(os.path.join(output_root, "completion_ledger"), 4)
+    output_dirs = [write_finished_sample(output_root, dataset_path, ledger, index) for index in range(4)]
+
+    packer = ShardPacker(shard_dir, dataset_path)
+    assert pack_existing(packer, ledger, output_root, 4, range(0, 2)) == 2
+    packer.close()
+    assert sorted(entry["index"] for entry in read_index(shard_dir)) == [0, 1]
+    assert [os.path.isdir(output_dir) for output_dir in output_dirs] == [False, False, True, True]
+
+    # A rerun over the whole range packs the rest, not what is already in a shard
+    packer = ShardPacker(shard_dir, dataset_path)
+    assert pack_existing(packer, ledger, output_root, 4) == 2
+    packer.close()
+    assert sorted(entry["index"] for entry in read_index(shard_dir)) == [0, 1, 2, 3]
+    ledger.close()
@@ -0,0 +1,82 @@
+import time
+from argparse import Namespace
+from main_video_generation import ClaimedChunks
+from manifest_prefetch import RequestPrefetcher, serialize_request
+from work_queue import LeaseQueue
+
+
+def die(queue):
+    # A worker killed mid-chunk: its leases stay on disk and nobody renews them
+    queue.stopped.set()
+    queue.renewer.join()
+
+
+def test_chunk_of_dead_worker_is_taken_over(tmp_path):
+    dead = LeaseQueue(str(tmp_path), 4, chunk_size=2, lease_seconds=1, poll_seconds=0.2)
+    assert dead.claim("gpu0") == 0
+    die(dead)
+
+    survivor = LeaseQueue(str(tmp_path), 4, chunk_size=2, lease_seconds=1, poll_seconds=0.2)
+    assert survivor.claim("gpu0") == 1
+    survivor.complete(1)
+    started = time.time()
+    # Chunk 0 is held by a lease nobody renews: claim waits for it to expire instead of giving up
+    assert survivor.claim("gpu0") == 0
+    assert time.time() - started < 3
+    survivor.complete(0)
+    assert survivor.claim("gpu0") is None
+    assert survivor.finished()
+    survivor.stop()
+
+
+def test_claim_waits_for_live_lease_to_finish(tmp_path):
+    holder = LeaseQueue(str(tmp_path), 2, chunk_size=2, lease_seconds=1, poll_seconds=0.2)
+    assert holder.claim("gpu0") == 0
+    other = LeaseQueue(str(tmp_path), 2, chunk_size=2, lease_seconds=1, poll_seconds=0.2)
+    assert other.try_claim("gpu0") is None
+    # Renewed past its first expiry, then finished: the other worker stops without taking it
+    time.sleep(1.5)
+    assert other.try_claim("gpu0") is None
+    holder.complete(0)
+    assert other.claim("gpu0") is None
+    holder.stop()
+    other.stop()
+
+
+def test_lease_of_exited_process_is_taken_over_at_once(tmp_path):
+    # A run killed and relaunched on the same host does not wait out its old leases
+    dead = LeaseQueue(str(tmp_path), 2, chunk_size=2, lease_seconds=600)
+    assert dead.claim("gpu0") == 0
+    die(dead)
+    dead_pid = 2 ** 22 + 1  # above Linux's pid_max, so never a live process
+    with open(dead._lease_path(0), 'w') as lease_file:
+        lease_file.write(dead._lease_record(0, f"{dead.node.rsplit(':', 1)[0]}:{dead_pid}:gpu0"))
+
+    relaunched = LeaseQueue(str(tmp_path), 2, chunk_size=2, lease_seconds=600)
+    started = time.time()
+    assert relaunched.claim("gpu0") == 0
+    assert time.time() - started < 1
+    relaunched.stop()
+
+
+def test_next_chunk_is_claimed_while_last_job_renders(tmp_path):
+    queue = LeaseQueue(str(tmp_path / "queue"), 4, chunk_size=2, lease_seconds=30)
+    chunks = ClaimedChunks(0, queue, Namespace(dataset_path=str(tmp_path), configs_per_batch=1))
+    prefetcher = RequestPrefetcher(lambda configs: serialize_request(None))
+    handed = []
+    for job, configs, payload in prefetcher.prefetch(chunks):
+        if configs is None:
+            job.wait()
+            continue
+        chunks.handed()
+        handed.append((job, list(chunks.claimed)))
+        prefetcher.release(payload)
+        chunk, last = job
+        if last:
+            queue.complete(chunk)
+            chunks.claimed.remove(chunk)
+    # Chunk 1 is claimed, and its first request built, by the time the last job of chunk 0 is handed out
+    assert handed == [((0, False), [0]), ((0, True), [0, 1]), ((1, False), [1]), ((1, True), [1])]
+    assert queue.finished()
+    prefetcher.close()
+    queue.stop()
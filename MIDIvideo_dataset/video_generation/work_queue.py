@@ -0,0 +1,234 @@
+import json
+import os
+import socket
+import threading
+import time
+from math import ceil
+
+
+def process_exited(host, pid):
+    # True only for a process of this host that no longer runs; other hosts cannot be checked
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class LeaseQueue:
+    """Chunks of config indices shared by every node through lease files on a shared filesystem.
+
+    A worker claims a chunk by creating leases/chunk_<c> with O_CREAT | O_EXCL, which only one
+    creator can win. The lease holds its owner and an expiry time that a background thread keeps
+    pushing forward. A finished chunk gets a done/chunk_<c> marker and keeps its lease file, so
+    later claim attempts fail fast. A lease that has expired without a done marker belongs to a
+    dead worker and is taken over. Releasing a chunk rewrites its lease as already expired, so any
+    node can take it over right away.
+
+    Once every chunk is done or held, claim() waits for the earliest lease held elsewhere to expire,
+    checking for done markers every poll_seconds, so a chunk whose worker died is taken over within
+    the run. It returns None once every chunk is done. try_claim() and wait_for_lease() are the two
+    halves, for callers that must not block while holding a lock.
+    """
+
+    def __init__(self, queue_dir, count, chunk_size=8, lease_seconds=600, poll_seconds=5):
+        self.queue_dir = queue_dir
+        self.count = count
+        self.chunk_size = chunk_size
+        self.chunk_count = ceil(count / chunk_size)
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.lease_dir = os.path.join(queue_dir, "leases")
+        self.done_dir = os.path.join(queue_dir, "done")
+        os.makedirs(self.lease_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+
+        self.node = f"{socket.gethostname()}:{os.getpid()}"
+        self.held = {}  # chunk -> owner
+        self.lock = threading.Lock()
+        self.lease_lock = threading.Lock()  # a renewal never rewrites a lease being released
+        self.cursor = 0  # Chunks below the cursor have all been claimed at least once
+        self.stopped = threading.Event()
+        self.renewer = threading.Thread(target=self._renew_loop, daemon=True)
+        self.renewer.start()
+
+    def chunk_indices(self, chunk):
+        return range(chunk * self.chunk_size, min((chunk + 1) * self.chunk_size, self.count))
+
+    def _lease_path(self, chunk):
+        return os.path.join(self.lease_dir, f"chunk_{chunk}")
+
+    def _done_path(self, chunk):
+        return os.path.join(self.done_dir, f"chunk_{chunk}")
+
+    def _lease_record(self, chunk, owner, expires=None):
+        if expires is None:
+            expires = time.time() + self.lease_seconds
+        return json.dumps({"chunk": chunk, "owner": owner, "expires": expires})
+
+    def _write_lease(self, chunk, owner, expires=None):
+        lease_path = self._lease_path(chunk)
+        temporary_path = f"{lease_path}.{owner.replace(':', '_')}.tmp"
+        with open(temporary_path, 'w') as lease_file:
+            lease_file.write(self._lease_record(chunk, owner, expires))
+        os.replace(temporary_path, lease_path)
+
+    def _read_lease(self, path):
+        try:
+            with open(path, 'r') as lease_file:
+                return json.load(lease_file)
+        except (OSError, ValueError):
+            # Gone, or caught between create and write
+            return None
+
+    def _try_create(self, chunk, owner):
+        try:
+            fd = os.open(self._lease_path(chunk), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as lease_file:
+            lease_file.write(self._lease_record(chunk, owner))
+        with self.lock:
+            self.held[chunk] = owner
+        return True
+
+    def _try_reclaim(self, chunk, owner):
+        # Move the expired lease aside first: only one reclaimer can win the rename
+        lease_path = self._lease_path(chunk)
+        stale_path = f"{lease_path}.stale.{owner.replace(':', '_')}"
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return False
+        lease = self._read_lease(stale_path)
+        if lease is not None and not self._expired(lease, time.time()):
+            # Renewed between our check and the rename: put it back
+            try:
+                os.link(stale_path, lease_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        print(f"Reclaiming chunk {chunk} from {lease['owner'] if lease else 'unknown owner'}")
+        return self._try_create(chunk, owner)
+
+    def _owner_gone(self, lease):
+        # The lease belongs to a process of this host that has exited, e.g. a run killed and relaunched
+        host, pid, _ = lease["owner"].rsplit(':', 2)
+        return int(pid) != os.getpid() and process_exited(host, int(pid))
+
+    def _expired(self, lease, now):
+        return lease["expires"] < now or self._owner_gone(lease)
+
+    def _take_over(self, owner):
+        # A chunk taken over from a dead or releasing worker, or None
+        now = time.time()
+        done = set(os.listdir(self.done_dir))
+        for chunk in range(self.chunk_count):
+            if f"chunk_{chunk}" in done:
+                continue
+            lease = self._read_lease(self._lease_path(chunk))
+            if lease is None:
+                if not os.path.exists(self._lease_path(chunk)) and self._try_create(chunk, owner):
+                    return chunk
+            elif self._expired(lease, now) and self._try_reclaim(chunk, owner):
+                return chunk
+        return None
+
+    def _earliest_expiry(self):
+        # When the first lease of an unfinished chunk expires; None once every chunk is done
+        done = set(os.listdir(self.done_dir))
+        earliest = None
+        for chunk in range(self.chunk_count):
+            if f"chunk_{chunk}" in done:
+                continue
+            lease = self._read_lease(self._lease_path(chunk))
+            # A lease caught mid-write or mid-takeover is worth a new look right away
+            expires = time.time() if lease is None or self._owner_gone(lease) else lease["expires"]
+            earliest = expires if earliest is None else min(earliest, expires)
+        return earliest
+
+    def finished(self):
+        return len(os.listdir(self.done_dir)) >= self.chunk_count
+
+    def try_claim(self, worker_name):
+        # A chunk for this worker if one is free or its lease has expired, else None; never waits
+        owner = f"{self.node}:{worker_name}"
+        while True:
+            with self.lock:
+                chunk = self.cursor
+                self.cursor += 1
+            if chunk >= self.chunk_count:
+                break
+            if not os.path.exists(self._done_path(chunk)) and self._try_create(chunk, owner):
+                return chunk
+        return self._take_over(owner)
+
+    def wait_for_lease(self):
+        # Sleep until the earliest lease may have expired, at most poll_seconds so finished chunks are
+        # noticed; False once every chunk is done or the queue is stopped
+        earliest = self._earliest_expiry()
+        if earliest is None:
+            return False
+        delay = min(max(earliest - time.time(), 0.1), self.poll_seconds)
+        return not self.stopped.wait(delay)
+
+    def claim(self, worker_name):
+        # Next chunk for this worker, taking over the chunks of dead workers; None once every chunk is done
+        while not self.stopped.is_set():
+            chunk = self.try_claim(worker_name)
+            if chunk is not None:
+                return chunk
+            if not self.wait_for_lease():
+                return None
+        return None
+
+    def complete(self, chunk):
+        with open(self._done_path(chunk), 'w') as done_file:
+            done_file.write(self.held.get(chunk, self.node))
+        with self.lock:
+            self.held.pop(chunk, None)
+
+    def release(self, chunk):
+        # Hand an unfinished chunk back right away instead of waiting for the lease to expire. The
+        # lease is kept, expired, because other nodes only look for chunks to take over among leases
+        with self.lease_lock:
+            with self.lock:
+                owner = self.held.pop(chunk, None)
+            lease = self._read_lease(self._lease_path(chunk))
+            if owner is not None and lease is not None and lease["owner"] == owner:
+                self._write_lease(chunk, owner, expires=0)
+
+    def _renew(self, chunk, owner):
+        with self.lease_lock:
+            with self.lock:
+                if self.held.get(chunk) != owner:
+                    # Completed or released since the renewal loop listed it
+                    return
+            lease = self._read_lease(self._lease_path(chunk))
+            if lease is None or lease["owner"] != owner:
+                print(f"Lost the lease on chunk {chunk}")
+                with self.lock:
+                    self.held.pop(chunk, None)
+                return
+            self._write_lease(chunk, owner)
+
+    def _renew_loop(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                held = list(self.held.items())
+            for chunk, owner in held:
+                try:
+                    self._renew(chunk, owner)
+                except OSError as e:
+                    print(f"Could not renew the lease on chunk {chunk}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        for chunk in list(self.held):
+            self.release(chunk)